@@ -1,63 +1,123 @@
 from flask import Flask, request, jsonify
-from services.task_handlers import TASK_HANDLERS
-from services.task_tree import build_task_tree, execute_task_tree
-from services.prompt_builder import build_prompt, build_error_prompt
+from flask_limiter import Limiter
+from flask_limiter.errors import RateLimitExceeded
+from flask_limiter.util import get_remote_address
+from config import REQUEST_RATE_LIMIT
+from services.admission import AdmissionRejected
+from services.pipeline import RequestError, admit_request, end_session, parse_request, run_tasks
+from services.instrumentation import RequestProfiler, RequestTimer, profiling_requested, record_request
+from services.blob_store import BLOB_STORE, blob_content_type
+from services.compression import encode_body, negotiate_encoding
+from services.response_builder import (
+    CONTENT_TYPES,
+    build_ended_response,
+    build_error_response,
+    build_response,
+    negotiate,
+)
+from utils.metrics import PROMETHEUS_CONTENT_TYPE, REGISTRY
 from werkzeug.exceptions import RequestEntityTooLarge
 from logger import LOGGER
 import asyncio
+import math
+import time
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB limit
 
+# Requests per client address; the cost of each batch is limited by admission control
+limiter = Limiter(
+    get_remote_address,
+    app=app,
+    default_limits=[REQUEST_RATE_LIMIT] if REQUEST_RATE_LIMIT else [],
+    storage_uri="memory://",
+    strategy="moving-window",
+    enabled=bool(REQUEST_RATE_LIMIT),
+)
+
 @app.errorhandler(RequestEntityTooLarge)
 def handle_large_request(e):
     return jsonify({"error": "Request too large"}), 413
 
+@app.errorhandler(RateLimitExceeded)
+def handle_rate_limit(e):
+    response_format = negotiate(request.headers.get("Accept"))
+    retry_after = max(1, math.ceil(limiter.current_limit.reset_at - time.time()))
+    body = build_error_response(response_format, "Too many requests", f"Limit: {e.description}")
+    return body, 429, {"Content-Type": CONTENT_TYPES[response_format], "Retry-After": str(retry_after)}
+
 @app.route("/tasks", methods=["POST"])
 async def process_tasks():
+    timer = RequestTimer()
+    # The text prompt by default; JSON or NDJSON when the Accept header asks for it
+    response_format = negotiate(request.headers.get("Accept"))
+    if profiling_requested(request.headers.get("X-Profile")):
+        with RequestProfiler("tasks") as profiler:
+            body, status, headers = await handle_tasks(timer, response_format)
+        headers["X-Profile-Path"] = profiler.path
+    else:
+        body, status, headers = await handle_tasks(timer, response_format)
+    with timer.phase("compress"):
+        body, encoding = encode_body(body, negotiate_encoding(request.headers.get("Accept-Encoding")))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    record_request(timer, status)
+    headers["Server-Timing"] = timer.server_timing()
+    headers["Content-Type"] = CONTENT_TYPES[response_format]
+    headers["Vary"] = "Accept, Accept-Encoding"
+    return body, status, headers
+
+async def handle_tasks(timer, response_format):
+    """Run a /tasks request, return (body, status, headers)"""
     try:
         if not request.is_json:
             LOGGER.warning("Non-JSON request received")
-            return build_error_prompt("Request content type must be application/json"), 400
-            
-        data = request.get_json()
-
-        # Validate and log session_id
-        session_id = data.get("session_id")
-        if not session_id:
-            return build_error_prompt("Missing session_id"), 400
-        LOGGER.info(f"Processing tasks for session: {session_id}")
-
-        if not data or "request" not in data or "tasks" not in data["request"]:
-            LOGGER.warning("Invalid request format received")
-            return build_error_prompt("Invalid request format"), 400
-            
-        tasks = data["request"]["tasks"]
-        if not isinstance(tasks, list) or not tasks:
-            LOGGER.warning("Invalid tasks format or empty tasks list")
-            return build_error_prompt("Tasks must be a non-empty array"), 400
-            
-        # Validate the format of each task
-        for task in tasks:
-            if not isinstance(task, dict) or "type" not in task or "id" not in task:
-                LOGGER.warning(f"Invalid task format: {task}")
-                return build_error_prompt("Each task must include 'type' and 'id'", f"Invalid task: {task}"), 400
-            
-            if task["type"] == "end":
-                return "Session ended", 200
-        
-        # Build the task tree from the list of tasks
-        root_nodes = await build_task_tree(tasks)
-        # Execute the task tree and collect results
-        results = await execute_task_tree(root_nodes, lambda task: TASK_HANDLERS[task.type](task))
-        # Build the prompt based on the results
-        prompt = build_prompt(results)
-        return prompt, 200
+            return build_error_response(response_format, "Request content type must be application/json"), 400, {}
+
+        with timer.phase("parse"):
+            task_request = parse_request(request.get_json())
+        if task_request.ended:
+            await end_session(task_request.session_id)
+            return build_ended_response(response_format, task_request.session_id), 200, {}
+
+        # Wait for the session's and the server's token buckets to cover the batch
+        with timer.phase("admission"):
+            await admit_request(task_request)
+        # Build and execute the task tree, collecting results
+        results = await run_tasks(task_request, timer=timer)
+        # Build the prompt (or structured response) based on the results
+        with timer.phase("render"):
+            body = build_response(response_format, task_request.session_id, results, task_request.response_budget)
+        return body, 200, {}
+    except AdmissionRejected as e:
+        body = build_error_response(response_format, e.message, f"Retry after {e.retry_after} seconds")
+        return body, e.status, {"Retry-After": str(e.retry_after)}
+    except RequestError as e:
+        return build_error_response(response_format, e.message, e.details), 400, {}
     except ValueError as e:
-        return build_error_prompt(str(e)), 400
+        return build_error_response(response_format, str(e)), 400, {}
     except Exception as e:
         LOGGER.error(f"Unexpected error: {str(e)}")
-        return build_error_prompt("Internal server error"), 500
+        return build_error_response(response_format, "Internal server error"), 500, {}
+
+@app.route("/blobs/<blob_id>", methods=["GET"])
+@limiter.exempt
+def get_blob(blob_id):
+    """Payload of a structured response that was sent by reference"""
+    data = BLOB_STORE.get(blob_id)
+    if data is None:
+        return jsonify({"error": "Blob not found or expired"}), 404
+    content_type = blob_content_type(data)
+    data, encoding = encode_body(data, negotiate_encoding(request.headers.get("Accept-Encoding"), content_type))
+    headers = {"Content-Type": content_type, "Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return data, 200, headers
+
+@app.route("/metrics", methods=["GET"])
+@limiter.exempt
+def metrics():
+    return REGISTRY.render(), 200, {"Content-Type": PROMETHEUS_CONTENT_TYPE}
 
 if __name__ == "__main__":
     app.run(port=3000, debug=True)
@@ -0,0 +1,350 @@
+"""
+ASGI entry point for the task server.
+
+Serves the same /tasks contract as app.py on one long-lived event loop, so
+every request shares the scheduler's limits and the exec engine. POST
+/tasks/stream returns the same prompt, but each task's result line is sent
+as soon as that task finishes. Clients that accept application/json get a
+structured response instead; the stream then sends NDJSON, one task per line.
+
+Run with: uvicorn asgi:app --port 3000
+"""
+import asyncio
+import json
+import math
+import time
+from limits import parse as parse_rate_limit
+from limits.storage import MemoryStorage
+from limits.strategies import MovingWindowRateLimiter
+from config import REQUEST_RATE_LIMIT
+from services.admission import AdmissionRejected
+from services.pipeline import RequestError, admit_request, end_session, parse_request, request_tasks, run_tasks
+from services.blob_store import BLOB_STORE, blob_content_type
+from services.compression import StreamEncoder, encode_body, negotiate_encoding
+from services.prompt_builder import build_prompt_head, build_prompt_tail, format_task_result
+from services.response_budget import StreamBudget, task_priority
+from services.response_builder import (
+    CONTENT_TYPES,
+    NDJSON,
+    TEXT,
+    build_ended_response,
+    build_error_response,
+    build_ndjson_line,
+    build_response,
+    negotiate,
+    summary_entry,
+    task_entry,
+)
+from services.instrumentation import RequestProfiler, RequestTimer, profiling_requested, record_request
+from utils.io_executor import run_io
+from utils.metrics import PROMETHEUS_CONTENT_TYPE, REGISTRY
+from logger import LOGGER
+
+MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB limit
+TEXT_CONTENT_TYPE = b"text/html; charset=utf-8"
+
+# Same per-client limit as flask-limiter applies in app.py, from the library it is built on
+RATE_LIMIT = parse_rate_limit(REQUEST_RATE_LIMIT) if REQUEST_RATE_LIMIT else None
+RATE_LIMITER = MovingWindowRateLimiter(MemoryStorage()) if RATE_LIMIT else None
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+async def read_body(receive):
+    """Read the whole request body, enforcing MAX_CONTENT_LENGTH"""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ConnectionError("Client disconnected")
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > MAX_CONTENT_LENGTH:
+            raise RequestTooLarge()
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def send_response(send, status, body, content_type=TEXT_CONTENT_TYPE, headers=()):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode()), *headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def parse_task_request(scope, receive, response_format=TEXT):
+    """Return (TaskRequest, None) or (None, (status, body, content_type)) for an invalid request"""
+    headers = dict(scope.get("headers", []))
+    error_type = CONTENT_TYPES[response_format].encode()
+    content_type = headers.get(b"content-type", b"").split(b";")[0].strip().lower()
+    try:
+        body = await read_body(receive)
+    except RequestTooLarge:
+        return None, (413, json.dumps({"error": "Request too large"}), b"application/json")
+
+    if content_type != b"application/json" and not content_type.endswith(b"+json"):
+        LOGGER.warning("Non-JSON request received")
+        return None, (400, build_error_response(response_format, "Request content type must be application/json"),
+                      error_type)
+
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None, (400, build_error_response(response_format, "Request body is not valid JSON"), error_type)
+
+    try:
+        return parse_request(data), None
+    except RequestError as e:
+        return None, (400, build_error_response(response_format, e.message, e.details), error_type)
+
+
+def rate_limited(scope):
+    """Seconds until the client may retry if it is over REQUEST_RATE_LIMIT, else None"""
+    if RATE_LIMITER is None:
+        return None
+    client = (scope.get("client") or ("unknown",))[0]
+    if RATE_LIMITER.hit(RATE_LIMIT, client):
+        return None
+    reset_time = RATE_LIMITER.get_window_stats(RATE_LIMIT, client).reset_time
+    return max(1, math.ceil(reset_time - time.time()))
+
+
+def rejection(response_format, status, message, retry_after):
+    """(status, body, content_type, headers) of a request turned away with a Retry-After hint"""
+    body = build_error_response(response_format, message, f"Retry after {retry_after} seconds")
+    return status, body, CONTENT_TYPES[response_format].encode(), [(b"retry-after", str(retry_after).encode())]
+
+
+def header_value(scope, name):
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def process_tasks(scope, receive, send):
+    timer = RequestTimer()
+    response_format = negotiate(header_value(scope, b"accept"))
+    if profiling_requested(header_value(scope, b"x-profile")):
+        with RequestProfiler("tasks") as profiler:
+            status, body, content_type, headers = await handle_tasks(scope, receive, timer, response_format)
+        headers.append((b"x-profile-path", profiler.path.encode("utf-8")))
+    else:
+        status, body, content_type, headers = await handle_tasks(scope, receive, timer, response_format)
+    with timer.phase("compress"):
+        body, encoding = encode_body(body, negotiate_encoding(header_value(scope, b"accept-encoding")))
+    if encoding:
+        headers.append((b"content-encoding", encoding.encode()))
+    record_request(timer, status)
+    headers.append((b"server-timing", timer.server_timing().encode("latin-1")))
+    headers.append((b"vary", b"accept, accept-encoding"))
+    await send_response(send, status, body, content_type, headers)
+
+
+async def handle_tasks(scope, receive, timer, response_format):
+    """Run a /tasks request, return (status, body, content_type, headers)"""
+    content_type = CONTENT_TYPES[response_format].encode()
+    retry_after = rate_limited(scope)
+    if retry_after is not None:
+        return rejection(response_format, 429, "Too many requests", retry_after)
+    with timer.phase("parse"):
+        task_request, error = await parse_task_request(scope, receive, response_format)
+    if error:
+        return (*error, [])
+    if task_request.ended:
+        await end_session(task_request.session_id)
+        return 200, build_ended_response(response_format, task_request.session_id), content_type, []
+
+    try:
+        with timer.phase("admission"):
+            await admit_request(task_request)
+        results = await run_tasks(task_request, timer=timer)
+        with timer.phase("render"):
+            body = await off_loop(build_response, response_format, task_request.session_id, results,
+                                  task_request.response_budget)
+            return 200, body, content_type, []
+    except AdmissionRejected as e:
+        return rejection(response_format, e.status, e.message, e.retry_after)
+    except ValueError as e:
+        return 400, build_error_response(response_format, str(e)), content_type, []
+    except Exception as e:
+        LOGGER.error(f"Unexpected error: {str(e)}")
+        return 500, build_error_response(response_format, "Internal server error"), content_type, []
+
+
+async def off_loop(function, *args):
+    """
+    Run a rendering step that may store blobs. With several workers blobs live in
+    SQLite, so the step runs on the I/O executor instead of blocking the event loop.
+    """
+    if BLOB_STORE.shared is None:
+        return function(*args)
+    return await run_io(function, *args)
+
+
+async def metrics(scope, receive, send):
+    # Shared-state gauges query SQLite
+    await send_response(send, 200, await off_loop(REGISTRY.render), PROMETHEUS_CONTENT_TYPE.encode())
+
+
+async def get_blob(scope, receive, send, blob_id):
+    """Payload of a structured response that was sent by reference"""
+    data = await off_loop(BLOB_STORE.get, blob_id)
+    if data is None:
+        await send_response(send, 404, json.dumps({"error": "Blob not found or expired"}), b"application/json")
+        return
+    content_type = blob_content_type(data)
+    data, encoding = encode_body(data, negotiate_encoding(header_value(scope, b"accept-encoding"), content_type))
+    headers = [(b"vary", b"accept-encoding")]
+    if encoding:
+        headers.append((b"content-encoding", encoding.encode()))
+    await send_response(send, 200, data, content_type.encode(), headers)
+
+
+async def process_tasks_stream(scope, receive, send):
+    timer = RequestTimer()
+    # Structured clients get NDJSON, the only structured format that can be streamed
+    response_format = TEXT if negotiate(header_value(scope, b"accept")) == TEXT else NDJSON
+    content_type = CONTENT_TYPES[response_format].encode()
+    retry_after = rate_limited(scope)
+    if retry_after is not None:
+        record_request(timer, 429)
+        await send_response(send, *rejection(response_format, 429, "Too many requests", retry_after))
+        return
+    with timer.phase("parse"):
+        task_request, error = await parse_task_request(scope, receive, response_format)
+    if error:
+        record_request(timer, error[0])
+        await send_response(send, *error)
+        return
+    if task_request.ended:
+        await end_session(task_request.session_id)
+        record_request(timer, 200)
+        await send_response(send, 200, build_ended_response(response_format, task_request.session_id), content_type)
+        return
+    try:
+        with timer.phase("admission"):
+            await admit_request(task_request)
+    except AdmissionRejected as e:
+        record_request(timer, e.status)
+        await send_response(send, *rejection(response_format, e.status, e.message, e.retry_after))
+        return
+
+    finished = asyncio.Queue()
+    execution = asyncio.ensure_future(run_tasks(task_request, on_result=finished.put_nowait, timer=timer))
+    execution.add_done_callback(lambda _: finished.put_nowait(None))
+
+    # Validation errors surface before the first task finishes; report them with a proper status
+    first = await finished.get()
+    if first is None and execution.exception() is not None:
+        e = execution.exception()
+        if isinstance(e, ValueError):
+            record_request(timer, 400)
+            await send_response(send, 400, build_error_response(response_format, str(e)), content_type)
+        else:
+            LOGGER.error(f"Unexpected error: {str(e)}")
+            record_request(timer, 500)
+            await send_response(send, 500, build_error_response(response_format, "Internal server error"),
+                                content_type)
+        return
+
+    encoder = StreamEncoder(negotiate_encoding(header_value(scope, b"accept-encoding")))
+    headers = [(b"content-type", content_type), (b"cache-control", b"no-cache"), (b"vary", b"accept, accept-encoding")]
+    if encoder.encoding:
+        headers.append((b"content-encoding", encoder.encoding.encode()))
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    try:
+        budget = None
+        if response_format == TEXT:
+            head = build_prompt_head()
+            if task_request.response_budget:
+                weights = [task_priority(task) for task in request_tasks(task_request)]
+                budget = StreamBudget(task_request.response_budget - len(head.encode("utf-8")), weights,
+                                      task_request.session_id)
+            await send({"type": "http.response.body", "body": encoder.encode(head), "more_body": True})
+        sent = 0
+        result = first
+        while result is not None:
+            if response_format == TEXT:
+                if budget is not None:
+                    result = await off_loop(budget.fit, result,
+                                            len(format_task_result(dict(result, description=""))) + 1)
+                line = format_task_result(result)
+                # Separate lines the same way build_prompt joins them
+                chunk = (line if not sent else "\n" + line).encode("utf-8")
+            else:
+                chunk = build_ndjson_line(await off_loop(task_entry, result, task_request.session_id))
+            sent += 1
+            await send({"type": "http.response.body", "body": encoder.encode(chunk), "more_body": True})
+            result = await finished.get()
+
+        if execution.exception() is not None:
+            LOGGER.error(f"Unexpected error: {str(execution.exception())}")
+            if response_format == TEXT:
+                tail = ("\n\n" + build_error_response(TEXT, "Internal server error")).encode("utf-8")
+            else:
+                tail = build_error_response(response_format, "Internal server error")
+        elif response_format == TEXT:
+            tail = build_prompt_tail(execution.result()).encode("utf-8")
+        else:
+            tail = build_ndjson_line(summary_entry(task_request.session_id, execution.result()))
+        await send({"type": "http.response.body", "body": encoder.finish(tail)})
+        # The phase breakdown cannot go into headers that were sent before the tasks ran
+        record_request(timer, 200)
+    except (ConnectionError, OSError):
+        LOGGER.warning("Client disconnected during streamed response")
+        execution.cancel()
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+ROUTES = {
+    ("POST", "/tasks"): process_tasks,
+    ("POST", "/tasks/stream"): process_tasks_stream,
+    ("GET", "/metrics"): metrics,
+}
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(scope, receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    if scope["path"].startswith("/blobs/"):
+        if scope["method"] != "GET":
+            await send_response(send, 405, json.dumps({"error": "Method not allowed"}), b"application/json")
+            return
+        await get_blob(scope, receive, send, scope["path"][len("/blobs/"):])
+        return
+
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    if handler is None:
+        allowed = any(path == scope["path"] for _, path in ROUTES)
+        status = 405 if allowed else 404
+        await send_response(send, status, json.dumps({"error": "Method not allowed" if allowed else "Not found"}),
+                            b"application/json")
+        return
+    await handler(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run("asgi:app", port=3000)
@@ -0,0 +1,114 @@
+"""
+Benchmark scaffolding a project: one write task per file against a single
+sync (manifest) or extract (tar.gz archive) task.
+
+Generates a synthetic tree of --files source files and sends it to /tasks
+through the ASGI app in three ways, each into its own directory: a batch of
+write tasks, a sync task and an extract task. Each is sent twice, to a new
+directory and again unchanged (every file skipped), and reports request
+time and payload size. Finally packs the tree back with an archive task.
+
+Usage: python -m benchmarks.bench_bundles [--files 2000] [--file-size 1024] [--repeat 3]
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+import tarfile
+import tempfile
+import time
+from benchmarks.harness import ASGIClient
+
+
+def scaffold(files, file_size):
+    """Relative path -> text content of a synthetic project"""
+    tree = {}
+    for i in range(files):
+        line = f"def function_{i}(value):\n    return value * {i}\n"
+        body = (line * (file_size // len(line) + 1))[:file_size]
+        tree[f"pkg{i % 20}/module{i % 9}/file{i}.py"] = body
+    return tree
+
+
+def tar_gz(tree):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for path, content in tree.items():
+            data = content.encode("utf-8")
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def payloads(tree, target):
+    encoded = tar_gz(tree)
+    writes = [{"id": i, "type": "write", "parameters": {"path": f"{target}/writes/{path}", "content": content}}
+              for i, (path, content) in enumerate(tree.items())]
+    return {
+        "write x N": writes,
+        "sync": [{"id": 1, "type": "sync", "parameters": {"path": f"{target}/sync", "files": tree}}],
+        "extract": [{"id": 1, "type": "extract", "parameters": {"path": f"{target}/extract", "archive": encoded}}],
+    }
+
+
+async def send(client, tasks, session_id):
+    payload = json.dumps({"session_id": session_id, "request": {"tasks": tasks}}).encode("utf-8")
+    start = time.perf_counter()
+    status, _, body = await client.post("/tasks", payload, headers=[(b"accept", b"application/json")])
+    elapsed = time.perf_counter() - start
+    failed = [entry for entry in json.loads(body)["response"] if entry["status"] != "completed"]
+    if status != 200 or failed:
+        raise RuntimeError(f"Request failed with {status}: {failed[:1]}")
+    return elapsed, len(payload), json.loads(body)["response"]
+
+
+async def run(args):
+    from asgi import app
+
+    client = ASGIClient(app)
+    tree = scaffold(args.files, args.file_size)
+    results = {}
+    for repeat in range(args.repeat):
+        for name, tasks in payloads(tree, f"run{repeat}").items():
+            first, size, _ = await send(client, tasks, f"{name}-{repeat}")
+            again, _, _ = await send(client, tasks, f"{name}-{repeat}")
+            best = results.setdefault(name, {"payload_bytes": size, "new_s": first, "unchanged_s": again})
+            best["new_s"] = min(best["new_s"], first)
+            best["unchanged_s"] = min(best["unchanged_s"], again)
+    archive, _, response = await send(client, [{"id": 1, "type": "archive", "parameters": {"path": "run0/sync"}}],
+                                      "archive")
+    return results, archive, response[0]["result"]["archive"]["bytes"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--file-size", type=int, default=1024, help="Bytes per file")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per way, the best is reported")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench-bundles-") as base_dir:
+        os.environ["APP_BASE_DIR"] = base_dir
+        os.environ["APP_SEARCH_INDEX_PATH"] = ""
+        os.environ.setdefault("APP_LOG_QUEUE_POLICY", "drop")
+        # Measure the tasks, not the rate limits
+        os.environ["APP_ADMISSION_RATE"] = "0"
+        os.environ["APP_ADMISSION_SESSION_RATE"] = "0"
+        import logger  # noqa: F401  Configure logging before lowering the level
+        logging.getLogger("LLMApp").setLevel(logging.WARNING)
+        results, archive_s, archive_bytes = asyncio.run(run(args))
+
+    print(f"{args.files} files of {args.file_size} bytes, best of {args.repeat}")
+    print(f"{'':<10} {'payload':>10} {'new dir ms':>11} {'unchanged ms':>13}")
+    for name, result in results.items():
+        print(f"{name:<10} {result['payload_bytes']:>10} {result['new_s'] * 1e3:>11.1f} "
+              f"{result['unchanged_s'] * 1e3:>13.1f}")
+    print(f"archive of the tree: {archive_s * 1e3:.1f} ms, {archive_bytes} bytes (tar.gz)")
+
+
+if __name__ == "__main__":
+    main()
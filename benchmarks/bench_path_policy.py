@@ -0,0 +1,59 @@
+"""
+Microbenchmark: PathPolicy.resolve against the original is_safe_path.
+
+Builds a small directory tree in a temporary base directory and authorizes
+the same mix of paths with both implementations.
+
+Usage: python -m benchmarks.bench_path_policy [--iterations 20000]
+"""
+import argparse
+import os
+import tempfile
+import time
+from utils.file_utils import is_safe_path
+from utils.path_policy import PathPolicy
+
+
+def build_tree(base_dir, depth=6, files=20):
+    paths = []
+    directory = ""
+    for level in range(depth):
+        directory = os.path.join(directory, f"level{level}")
+        os.makedirs(os.path.join(base_dir, directory), exist_ok=True)
+        for i in range(files):
+            name = os.path.join(directory, f"file{i}.txt")
+            open(os.path.join(base_dir, name), "w").close()
+            paths.append(name)
+    return paths
+
+
+def measure(label, check, paths, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        check(paths[i % len(paths)])
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {elapsed * 1e3:>10.1f} ms {elapsed / iterations * 1e6:>10.2f} us/path")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        paths = build_tree(base_dir)
+        paths += ["../outside.txt", "level0/../../etc/passwd"]
+        policy = PathPolicy(base_dir)
+
+        # Both implementations must agree on which paths are allowed
+        for path in paths:
+            assert bool(is_safe_path(base_dir, path)) == (policy.resolve(path) is not None), path
+
+        baseline = measure("is_safe_path", lambda p: is_safe_path(base_dir, p), paths, args.iterations)
+        optimized = measure("PathPolicy.resolve", policy.resolve, paths, args.iterations)
+        print(f"speedup: {baseline / optimized:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""
+Load test of the whole /tasks pipeline through the ASGI app, in-process.
+
+Generates synthetic task batches (size, DAG shape, task mix) or replays a
+trace of /tasks payloads, sends them with a fixed number of concurrent
+clients and reports requests/s, request and per-task-type latency
+percentiles, peak RSS and event-loop lag. Tasks run against a temporary
+workspace, so no network or existing files are needed.
+
+Traces are JSON lines (one /tasks payload per line) or .http files such as
+request.http; entries that are not /tasks payloads are skipped.
+
+Usage:
+  python -m benchmarks.bench_pipeline [--requests 200] [--concurrency 8]
+      [--batch-size 20] [--shape chain|wide|diamond|flat]
+      [--mix write=3,read=3,list=1,mkdir=1,exec=1] [--trace request.http]
+      [--format text|json|ndjson] [--output results.json] [--compare baseline.json]
+      [--admission]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from benchmarks.harness import ASGIClient, LoopLagMonitor, peak_rss_mb, summarize
+
+SHAPES = ("chain", "wide", "diamond", "flat")
+ACCEPT = {"text": b"text/html", "json": b"application/json", "ndjson": b"application/x-ndjson"}
+DEFAULT_MIX = "write=3,read=3,list=1,mkdir=1,exec=1"
+SEED_FILES = 50
+
+
+def parse_mix(text):
+    """'write=3,read=1' -> [("write", 3), ("read", 1)]"""
+    mix = []
+    for item in text.split(","):
+        kind, _, weight = item.partition("=")
+        mix.append((kind.strip(), int(weight or 1)))
+    return mix
+
+
+def dependencies(shape, i, size):
+    if shape == "chain":
+        return [i - 1] if i else []
+    if shape == "wide":
+        return [0] if i else []
+    if shape == "diamond":
+        # One root, a wide middle layer, one task joining them all
+        if i == 0:
+            return []
+        if i == size - 1 and size > 2:
+            return list(range(1, size - 1))
+        return [0]
+    return []
+
+
+def make_task(kind, i, batch, rng, content):
+    if kind == "write":
+        parameters = {"path": f"bench/out/{batch}/{i}.txt", "content": content}
+    elif kind == "read":
+        parameters = {"path": f"bench/seed/{rng.randrange(SEED_FILES)}.txt"}
+    elif kind == "list":
+        parameters = {"path": "bench/seed"}
+    elif kind == "mkdir":
+        parameters = {"path": f"bench/dirs/{batch}/{i}"}
+    elif kind == "exec":
+        parameters = {"command": f"echo bench {batch} {i}"}
+    else:
+        raise ValueError(f"Unknown task type in mix: {kind}")
+    return {"id": i + 1, "type": kind, "parameters": parameters}
+
+
+def synthetic_payloads(args):
+    rng = random.Random(args.seed)
+    kinds = [kind for kind, weight in parse_mix(args.mix) for _ in range(weight)]
+    content = "x" * args.content_size
+    for batch in itertools.count():
+        tasks = []
+        for i in range(args.batch_size):
+            task = make_task(rng.choice(kinds), i, batch, rng, content)
+            task["depends_on"] = [d + 1 for d in dependencies(args.shape, i, args.batch_size)]
+            tasks.append(task)
+        yield {"session_id": f"bench-{batch % args.sessions}", "request": {"tasks": tasks}}
+
+
+def load_trace(path):
+    """Read /tasks payloads from a JSON lines file or an .http file"""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    candidates = []
+    if path.endswith(".http"):
+        for block in text.split("###"):
+            # Headers end at the first blank line after the request line
+            head, _, body = block.partition("\n\n")
+            if "POST" in head and "/tasks" in head:
+                candidates.append(body.strip())
+    else:
+        candidates = [line for line in text.splitlines() if line.strip()]
+
+    payloads = []
+    for candidate in candidates:
+        try:
+            payload = json.loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(payload, dict) and isinstance(payload.get("request"), dict):
+            payloads.append(payload)
+    return payloads
+
+
+def trace_payloads(payloads, sessions):
+    for n, payload in enumerate(itertools.cycle(payloads)):
+        payload = dict(payload)
+        payload["session_id"] = f"{payload.get('session_id', 'trace')}-{n % sessions}"
+        yield payload
+
+
+def seed_workspace(base_dir):
+    seed = os.path.join(base_dir, "bench", "seed")
+    os.makedirs(seed, exist_ok=True)
+    for i in range(SEED_FILES):
+        with open(os.path.join(seed, f"{i}.txt"), "w", encoding="utf-8") as f:
+            f.write("".join(f"line {n} of seed file {i}\n" for n in range(200)))
+
+
+async def run_load(args, payloads):
+    # Imported here, after APP_BASE_DIR points at the temporary workspace
+    import services.pipeline as pipeline
+    from asgi import app
+    from services.admission import ADMISSION
+    from services.exec_pool import EXEC_POOL
+    from utils.io_executor import IO_EXECUTOR
+
+    task_latencies = {}
+    task_failures = {}
+    dispatch_task = pipeline.dispatch_task
+
+    async def timed_dispatch(task):
+        start = time.perf_counter()
+        try:
+            return await dispatch_task(task)
+        except Exception:
+            task_failures[task.type] = task_failures.get(task.type, 0) + 1
+            raise
+        finally:
+            task_latencies.setdefault(task.type, []).append(time.perf_counter() - start)
+
+    pipeline.dispatch_task = timed_dispatch
+    client = ASGIClient(app)
+    path = "/tasks/stream" if args.stream else "/tasks"
+    request_latencies = []
+    statuses = {}
+    tasks_sent = 0
+
+    async def worker():
+        nonlocal tasks_sent
+        while len(request_latencies) < args.requests:
+            # No await between taking a payload and reserving its slot, so workers never race here
+            payload = next(payloads, None)
+            if payload is None:
+                return
+            request_latencies.append(None)
+            slot = len(request_latencies) - 1
+            tasks_sent += len(payload["request"].get("tasks", []))
+            start = time.perf_counter()
+            status, _, _ = await client.post(path, payload, headers=[(b"accept", ACCEPT[args.format])])
+            request_latencies[slot] = time.perf_counter() - start
+            statuses[status] = statuses.get(status, 0) + 1
+
+    monitor = LoopLagMonitor()
+    monitor.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    await monitor.stop()
+    pipeline.dispatch_task = dispatch_task
+
+    server_rss, children_rss = peak_rss_mb()
+    completed = [latency for latency in request_latencies if latency is not None]
+    return {
+        "requests": len(completed),
+        "tasks": tasks_sent,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(completed) / elapsed, 2),
+        "tasks_per_s": round(tasks_sent / elapsed, 2),
+        "status": {str(status): count for status, count in sorted(statuses.items(), key=lambda s: str(s[0]))},
+        "request_latency_ms": summarize(completed),
+        "task_latency_ms": {kind: summarize(values) for kind, values in sorted(task_latencies.items())},
+        "task_failures": task_failures,
+        "event_loop_lag_ms": summarize(monitor.samples),
+        "peak_rss_mb": {"server": server_rss, "children": children_rss},
+        "io_executor": IO_EXECUTOR.stats(),
+        "exec_pool": EXEC_POOL.stats(),
+        "admission": ADMISSION.stats(),
+    }
+
+
+def print_report(config, results):
+    print(f"workload:        {config['workload']}, {results['requests']} requests, {results['tasks']} tasks, "
+          f"concurrency {config['concurrency']}")
+    print(f"throughput:      {results['requests_per_s']} requests/s, {results['tasks_per_s']} tasks/s "
+          f"({results['elapsed_s']} s)")
+    print(f"status:          {results['status']}")
+    latency = results["request_latency_ms"]
+    print(f"request latency: p50 {latency.get('p50')} ms, p99 {latency.get('p99')} ms, max {latency.get('max')} ms")
+    for kind, latency in results["task_latency_ms"].items():
+        failures = results["task_failures"].get(kind, 0)
+        print(f"  {kind:<8} n={latency['count']:<6} p50 {latency['p50']:>8} ms  p99 {latency['p99']:>8} ms"
+              f"{f'  ({failures} failed)' if failures else ''}")
+    lag = results["event_loop_lag_ms"]
+    print(f"loop lag:        p50 {lag.get('p50')} ms, p99 {lag.get('p99')} ms, max {lag.get('max')} ms")
+    print(f"peak RSS:        {results['peak_rss_mb']['server']} MB server, "
+          f"{results['peak_rss_mb']['children']} MB largest child")
+
+
+def compare(results, baseline_path):
+    """Print the change of the headline metrics against a previous run"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    metrics = [
+        ("requests/s", lambda r: r["requests_per_s"], True),
+        ("request p50 ms", lambda r: r["request_latency_ms"].get("p50"), False),
+        ("request p99 ms", lambda r: r["request_latency_ms"].get("p99"), False),
+        ("loop lag p99 ms", lambda r: r["event_loop_lag_ms"].get("p99"), False),
+        ("peak RSS MB", lambda r: r["peak_rss_mb"]["server"], False),
+    ]
+    print(f"\ncompared with {baseline_path}:")
+    for name, get, higher_is_better in metrics:
+        try:
+            old, new = get(baseline), get(results)
+        except (KeyError, TypeError):
+            continue
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        better = change > 0 if higher_is_better else change < 0
+        print(f"  {name:<16} {old:>10} -> {new:<10} {change:+7.1f}% {'better' if better else 'worse'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight at once")
+    parser.add_argument("--batch-size", type=int, default=20, help="Tasks per synthetic request")
+    parser.add_argument("--shape", choices=SHAPES, default="diamond")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Task type weights")
+    parser.add_argument("--content-size", type=int, default=1024, help="Bytes per write task")
+    parser.add_argument("--sessions", type=int, default=8, help="Distinct session ids to rotate through")
+    parser.add_argument("--trace", help="Replay /tasks payloads from a .jsonl or .http file")
+    parser.add_argument("--stream", action="store_true", help="Use /tasks/stream instead of /tasks")
+    parser.add_argument("--format", choices=sorted(ACCEPT), default="text", help="Response format to request")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--compare", help="Results JSON of a previous run to compare against")
+    parser.add_argument("--log", action="store_true", help="Keep INFO logging (slows the run down)")
+    parser.add_argument("--admission", action="store_true",
+                        help="Keep admission control enabled; by default the pipeline is measured without it")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench-workspace-") as base_dir:
+        os.environ["APP_BASE_DIR"] = base_dir
+        os.environ.setdefault("APP_LOG_QUEUE_POLICY", "drop")
+        if not args.admission:
+            os.environ["APP_ADMISSION_RATE"] = "0"
+            os.environ["APP_ADMISSION_SESSION_RATE"] = "0"
+        seed_workspace(base_dir)
+        if args.trace:
+            trace = load_trace(args.trace)
+            if not trace:
+                sys.exit(f"No /tasks payloads found in {args.trace}")
+            payloads = trace_payloads(trace, args.sessions)
+            workload = f"trace {args.trace} ({len(trace)} payloads)"
+        else:
+            payloads = synthetic_payloads(args)
+            workload = f"{args.shape} x{args.batch_size}, mix {args.mix}"
+
+        if not args.log:
+            import logger  # noqa: F401  Configure logging before lowering the level
+            logging.getLogger("LLMApp").setLevel(logging.WARNING)
+
+        results = asyncio.run(run_load(args, payloads))
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "compare", "log")}
+    config["workload"] = workload
+    print_report(config, results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "results": results, "time": time.time()}, f, indent=2)
+        print(f"\nresults written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
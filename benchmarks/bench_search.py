@@ -0,0 +1,145 @@
+"""
+Benchmark search tasks: trigram index against a brute-force scan.
+
+Generates a synthetic source tree, builds the index, then runs the same
+queries (rare and common literals, regular expressions with and without a
+usable literal) through SearchIndex.search and through a scan that reads
+and matches every file. Both must find the same matches; timings use the
+result limit of a search task. Also reports the cost of re-indexing files
+after they change.
+
+Usage: python -m benchmarks.bench_search [--files 20000] [--lines 80] [--repeat 3] [--max-results 100]
+"""
+import argparse
+import os
+import random
+import re
+import tempfile
+import time
+
+QUERIES = [
+    # (query, regex)
+    ("handle_zygote", False),  # Appears in a few files
+    ("return", False),  # Appears in every file
+    (r"def \w+_cache\(self", True),
+    (r"class [A-Z]\w+Error\b", True),
+    (r"\d{5,}", True),  # No literal: every file is a candidate
+    # Escapes longer than two characters must not leave their digits behind as literals
+    (r"\x68andle_zygote", True),
+    (r"handle_\172ygote", True),
+    (r"\N{LATIN SMALL LETTER H}andle_\u007aygote", True),
+    (r"(ha)ndle_zygote\(self\)\1?", True),
+]
+
+WORDS = ["task", "path", "cache", "read", "write", "index", "node", "result", "session", "entry", "buffer",
+         "request", "config", "policy", "handle", "stream", "token", "limit", "queue", "worker"]
+
+
+def generate_tree(base_dir, files, lines, seed=0):
+    rng = random.Random(seed)
+    for i in range(files):
+        directory = os.path.join(base_dir, f"pkg{i % 50}", f"mod{i % 7}")
+        os.makedirs(directory, exist_ok=True)
+        body = []
+        for j in range(lines):
+            a, b, c = rng.choice(WORDS), rng.choice(WORDS), rng.choice(WORDS)
+            if j % 20 == 0:
+                body.append(f"class {a.title()}{b.title()}Error(Exception):")
+            elif j % 4 == 0:
+                body.append(f"    def {a}_{b}(self, {c}):")
+            else:
+                body.append(f"        return self.{a}.{b}({c}, {rng.randint(0, 99999)})")
+        if i % 1000 == 0:
+            body.append("def handle_zygote(self):")
+        with open(os.path.join(directory, f"file{i}.py"), "w") as f:
+            f.write("\n".join(body) + "\n")
+
+
+def brute_force(root, pattern, lister_class, max_results=None):
+    """Read every file and match it, the way a search without the index works"""
+    found = []
+    for entry in lister_class(root).iter_entries():
+        if entry.is_dir:
+            continue
+        with open(os.path.join(root, entry.path), "rb") as f:
+            text = f.read().decode("utf-8", errors="replace")
+        last_line = 0
+        line, position = 1, 0
+        for match in pattern.finditer(text):
+            line += text.count("\n", position, match.start())
+            position = match.start()
+            if line != last_line:
+                if len(found) == max_results:
+                    return found
+                found.append((entry.path, line))
+                last_line = line
+    return found
+
+
+def timed(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--lines", type=int, default=80, help="Lines per generated file")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per query, the best is reported")
+    parser.add_argument("--max-results", type=int, default=100, help="Matches returned per query")
+    parser.add_argument("--changed", type=int, default=100, help="Files rewritten before measuring re-indexing")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        # Imported here, after APP_BASE_DIR points at the temporary workspace
+        os.environ["APP_BASE_DIR"] = base_dir
+        os.environ["APP_SEARCH_INDEX_PATH"] = ""
+        os.environ["APP_FS_CACHE_WATCH"] = "0"
+        from utils.listing import DirectoryLister
+        from utils.search_index import SearchIndex, required_literals
+
+        start = time.perf_counter()
+        generate_tree(base_dir, args.files, args.lines)
+        print(f"generated {args.files} files in {time.perf_counter() - start:.1f} s")
+
+        index = SearchIndex(base_dir, path="")
+        _, build = timed(index.update, 1)
+        postings = sum(len(ids) for ids in index.postings.values())
+        print(f"index build: {build * 1e3:.0f} ms, {len(index.docs)} files, {len(index.postings)} trigrams, "
+              f"{postings} postings (~{postings * 4 / 1024 / 1024:.1f} MB)")
+
+        # Timed with the same result limit as a search task; both stop at the limit
+        print(f"{'query':<42} {'matches':>8} {'files':>7} {'scan ms':>9} {'index ms':>9} {'speedup':>8}")
+        for query, regex in QUERIES:
+            pattern = re.compile(query if regex else re.escape(query))
+            literals = required_literals(query, regex)
+            expected = brute_force(base_dir, pattern, DirectoryLister)
+            matches, _, _ = index.search(pattern, literals, max_results=len(expected) + 1)
+            assert sorted((m.path, m.line) for m in matches) == sorted(expected), query
+
+            _, scan = timed(lambda: brute_force(base_dir, pattern, DirectoryLister, args.max_results), args.repeat)
+            (_, scanned, _), indexed = timed(
+                lambda: index.search(pattern, literals, max_results=args.max_results), args.repeat)
+            print(f"{query:<42} {len(expected):>8} {scanned:>7} {scan * 1e3:>9.1f} {indexed * 1e3:>9.1f} "
+                  f"{scan / indexed:>7.1f}x")
+
+        rng = random.Random(1)
+        changed = rng.sample(sorted(index.files), min(args.changed, len(index.files)))
+        for rel in changed:
+            path = os.path.join(base_dir, rel)
+            with open(path, "a") as f:
+                f.write("def handle_zygote(self):\n")
+            index.invalidate(path)
+        _, update = timed(index.update, 1)
+        print(f"re-index {len(changed)} changed files: {update * 1e3:.1f} ms")
+        matches, _, _ = index.search(re.compile("handle_zygote"), [b"handle_zygote"], max_results=args.files)
+        assert {m.path for m in matches} >= set(changed)
+
+
+if __name__ == "__main__":
+    main()
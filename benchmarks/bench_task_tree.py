@@ -0,0 +1,67 @@
+"""
+Benchmark task tree validation/construction and scheduling overhead.
+
+Per-task cost should stay flat as the batch grows, for every DAG shape.
+
+Usage: python -m benchmarks.bench_task_tree [--sizes 1000 10000 100000]
+"""
+import argparse
+import asyncio
+import time
+from services.task_tree import build_task_tree, execute_task_tree
+
+
+def chain(size):
+    """Every task depends on the previous one"""
+    return [{"id": i, "type": "noop", "depends_on": [i - 1] if i else []} for i in range(size)]
+
+
+def wide(size):
+    """One root with every other task depending on it"""
+    return [{"id": i, "type": "noop", "depends_on": [0] if i else []} for i in range(size)]
+
+
+def layered(size, width=10):
+    """Layers of `width` tasks, each depending on every task of the previous layer"""
+    tasks = []
+    for i in range(size):
+        layer = i // width
+        previous = range((layer - 1) * width, layer * width) if layer else []
+        tasks.append({"id": i, "type": "noop", "depends_on": list(previous)})
+    return tasks
+
+
+SHAPES = {"chain": chain, "wide": wide, "layered": layered}
+
+
+async def noop(task):
+    return ""
+
+
+async def measure(tasks, execute):
+    start = time.perf_counter()
+    roots = await build_task_tree(tasks)
+    built = time.perf_counter()
+    if execute:
+        await execute_task_tree(roots, noop)
+    finished = time.perf_counter()
+    return built - start, finished - built
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--no-execute", action="store_true", help="Only measure tree building")
+    args = parser.parse_args()
+
+    print(f"{'shape':<8} {'tasks':>8} {'build ms':>10} {'build us/task':>14} {'exec ms':>10} {'exec us/task':>13}")
+    for name, shape in SHAPES.items():
+        for size in args.sizes:
+            tasks = shape(size)
+            build, execute = asyncio.run(measure(tasks, not args.no_execute))
+            print(f"{name:<8} {size:>8} {build * 1e3:>10.1f} {build / size * 1e6:>14.2f} "
+                  f"{execute * 1e3:>10.1f} {execute / size * 1e6:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
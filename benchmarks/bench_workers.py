@@ -0,0 +1,154 @@
+"""
+Throughput of the server with 1, 2, 4 and 8 worker processes.
+
+Starts serve.py with each worker count against a fresh temporary workspace,
+sends the synthetic batches of bench_pipeline over HTTP from concurrent
+clients for a fixed number of requests, and reports requests/s, tasks/s and
+latency percentiles next to the single-worker run. Each session's batches
+write their own files, so workers mostly contend on the shared seed files
+they read (shared locks) and on session leases.
+
+Usage: python -m benchmarks.bench_workers [--workers 1,2,4,8] [--requests 400] [--clients 16]
+    [--batch-size 20] [--mix write=3,read=3,list=1,mkdir=1,exec=1] [--output results.json]
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from benchmarks.bench_pipeline import DEFAULT_MIX, SHAPES, seed_workspace, synthetic_payloads
+from benchmarks.harness import summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"serve.py exited with {process.returncode}")
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/metrics")
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("serve.py did not start in time")
+
+
+def run_clients(port, payloads, requests, clients):
+    """Send requests payloads from clients threads, each on its own keep-alive connection"""
+    lock = threading.Lock()
+    sent = itertools.count()
+    latencies = []
+    statuses = {}
+    tasks = [0]
+
+    def client():
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+        while True:
+            with lock:
+                if next(sent) >= requests:
+                    break
+                payload = next(payloads)
+            body = json.dumps(payload).encode("utf-8")
+            start = time.perf_counter()
+            connection.request("POST", "/tasks", body, {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+                tasks[0] += len(payload["request"]["tasks"])
+        connection.close()
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies, statuses, tasks[0]
+
+
+def measure(workers, args):
+    with tempfile.TemporaryDirectory(prefix="bench-workers-") as base_dir:
+        workspace = os.path.join(base_dir, "workspace")
+        seed_workspace(workspace)
+        port = free_port()
+        env = dict(os.environ, APP_BASE_DIR=workspace, APP_SHARED_STATE_PATH=os.path.join(base_dir, "state.db"),
+                   APP_SEARCH_INDEX_PATH="", APP_LOG_QUEUE_POLICY="drop",
+                   # Measure the workers, not the rate limits
+                   APP_ADMISSION_RATE="0", APP_ADMISSION_SESSION_RATE="0")
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "serve.py"), "--workers", str(workers), "--port", str(port)],
+            cwd=base_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_ready(port, process)
+            payloads = synthetic_payloads(args)
+            run_clients(port, payloads, args.warmup, args.clients)
+            elapsed, latencies, statuses, tasks = run_clients(port, payloads, args.requests, args.clients)
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+    return {
+        "workers": workers,
+        "requests": len(latencies),
+        "tasks": tasks,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(latencies) / elapsed, 2),
+        "tasks_per_s": round(tasks / elapsed, 2),
+        "status": {str(status): count for status, count in sorted(statuses.items())},
+        "request_latency_ms": summarize(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4,8", help="Worker counts to measure")
+    parser.add_argument("--requests", type=int, default=400, help="Measured requests per worker count")
+    parser.add_argument("--warmup", type=int, default=40, help="Requests sent before measuring")
+    parser.add_argument("--clients", type=int, default=16, help="Requests in flight at once")
+    parser.add_argument("--batch-size", type=int, default=20, help="Tasks per synthetic request")
+    parser.add_argument("--shape", choices=SHAPES, default="diamond")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Task type weights")
+    parser.add_argument("--content-size", type=int, default=1024, help="Bytes per write task")
+    parser.add_argument("--sessions", type=int, default=32, help="Distinct session ids to rotate through")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the results as JSON")
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs, {args.clients} clients, {args.shape} x{args.batch_size}, mix {args.mix}")
+    print(f"{'workers':>7} {'req/s':>8} {'tasks/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'speedup':>8}  status")
+    results = []
+    for workers in [int(n) for n in args.workers.split(",")]:
+        result = measure(workers, args)
+        results.append(result)
+        latency = result["request_latency_ms"]
+        speedup = result["requests_per_s"] / results[0]["requests_per_s"]
+        print(f"{workers:>7} {result['requests_per_s']:>8.1f} {result['tasks_per_s']:>9.1f} "
+              f"{latency['p50']:>9.1f} {latency['p99']:>9.1f} {speedup:>7.2f}x  {result['status']}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "cpus": os.cpu_count(), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Shared helpers for the benchmarks: percentiles, an in-process ASGI client
+and an event-loop lag monitor.
+"""
+import asyncio
+import json
+import resource
+import sys
+import time
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(values, scale=1e3):
+    """count/p50/p90/p99/max of a list of seconds, in milliseconds by default"""
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 0.50) * scale, 3),
+        "p90": round(percentile(values, 0.90) * scale, 3),
+        "p99": round(percentile(values, 0.99) * scale, 3),
+        "max": round(max(values) * scale, 3),
+    }
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process and of its finished children, in MB"""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    per_mb = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(own / per_mb, 1), round(children / per_mb, 1)
+
+
+class ASGIClient:
+    """Call an ASGI app in-process, without a server or network"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def post(self, path, payload, content_type=b"application/json", headers=()):
+        """Return (status, headers, body)"""
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+        sent = False
+        disconnected = asyncio.Event()
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        response = {"status": None, "headers": [], "chunks": []}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = message.get("headers", [])
+            elif message["type"] == "http.response.body":
+                response["chunks"].append(message.get("body", b""))
+
+        scope = {
+            "type": "http",
+            "method": "POST",
+            "path": path,
+            "headers": [(b"content-type", content_type), *headers],
+        }
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            disconnected.set()
+        return response["status"], response["headers"], b"".join(response["chunks"])
+
+
+class LoopLagMonitor:
+    """Measure how late the event loop wakes up a coroutine sleeping for `interval` seconds"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
@@ -7,6 +7,49 @@ BASE_DIR = os.getenv("APP_BASE_DIR", os.path.dirname(os.path.dirname(__file__)))
 # File size limit
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 
+# Default byte budget of a single read task
+MAX_READ_BYTES = int(os.getenv("APP_MAX_READ_BYTES", 256 * 1024))  # 256KB
+
+# Task scheduling limits
+MAX_CONCURRENT_TASKS = int(os.getenv("APP_MAX_CONCURRENT_TASKS", 8))  # Per request
+GLOBAL_MAX_CONCURRENT_TASKS = int(os.getenv("APP_GLOBAL_MAX_CONCURRENT_TASKS", 32))  # Whole process
+
+# What a failed task does to its batch unless the request says otherwise:
+# "skip_dependents", "fail_fast" or "continue"
+FAILURE_POLICY = os.getenv("APP_FAILURE_POLICY", "skip_dependents")
+
+# Merge redundant tasks of a request and order tasks that touch the same paths
+COALESCE_TASKS = os.getenv("APP_COALESCE_TASKS", "1") == "1"
+
+# Threads of the shared pool that runs blocking filesystem calls
+IO_THREADS = int(os.getenv("APP_IO_THREADS", 16))
+
+# Worker processes serving requests (set by serve.py). With more than one, path locks,
+# session state and payloads sent by reference are shared through a SQLite database
+WORKERS = int(os.getenv("APP_WORKERS", 1))
+SHARED_STATE_PATH = os.getenv("APP_SHARED_STATE_PATH", os.path.join("logs", "shared_state.db"))
+CHANGE_LOG_SIZE = 10000  # Changed paths kept for other workers; one that falls behind drops its caches
+LOCK_POLL_INTERVAL = 0.002  # Seconds before retrying a contended path lock or session, doubling up to 50ms
+
+# Directory listing: entries per page and names skipped unless ignore_defaults is false
+LIST_MAX_ENTRIES = int(os.getenv("APP_LIST_MAX_ENTRIES", 1000))
+LIST_DEFAULT_IGNORES = [".git", "node_modules", "__pycache__"]
+
+# Bulk tasks (extract, sync, archive): entries and unpacked bytes a single task may handle
+BUNDLE_MAX_ENTRIES = int(os.getenv("APP_BUNDLE_MAX_ENTRIES", 20000))
+BUNDLE_MAX_BYTES = int(os.getenv("APP_BUNDLE_MAX_BYTES", 256 * 1024 * 1024))  # 256MB
+
+# Maximum bytes of stdout/stderr captured per command
+MAX_COMMAND_OUTPUT = 1 * 1024 * 1024  # 1MB
+
+# Commands running at once (whole process, and per session); the rest wait in a fair queue
+EXEC_MAX_WORKERS = int(os.getenv("APP_EXEC_MAX_WORKERS", 8))
+EXEC_SESSION_QUOTA = int(os.getenv("APP_EXEC_SESSION_QUOTA", 2))
+
+# Resource limits of each command (POSIX only, 0 disables a limit)
+EXEC_CPU_SECONDS = int(os.getenv("APP_EXEC_CPU_SECONDS", 120))  # CPU time
+EXEC_MEMORY_MB = int(os.getenv("APP_EXEC_MEMORY_MB", 4096))  # Data segment (heap) size
+
 # Allowed commands whitelist
 ALLOWED_COMMANDS = [
     "git",
@@ -20,6 +63,106 @@ ALLOWED_COMMANDS = [
     "echo"
 ]
 
+# Commands without side effects, whose output may be served from the session cache
+IDEMPOTENT_COMMANDS = [
+    "git status",
+    "git diff",
+    "git log",
+    "git show",
+    "git branch",
+    "git rev-parse",
+    "pip list",
+    "pip show",
+    "pip --version",
+    "npm --version",
+    "npm ls",
+    "cat",
+    "type",
+    "echo"
+]
+
+# Session store limits
+SESSION_TTL = int(os.getenv("APP_SESSION_TTL", 3600))  # Seconds of inactivity before a session expires
+MAX_SESSIONS = int(os.getenv("APP_MAX_SESSIONS", 256))
+SESSION_CACHE_MAX_BYTES = int(os.getenv("APP_SESSION_CACHE_MAX_BYTES", 64 * 1024 * 1024))  # All sessions
+SESSION_RESULT_TTL = int(os.getenv("APP_SESSION_RESULT_TTL", 300))  # Cached list/exec results
+SESSION_HASH_MAX_BYTES = 1 * 1024 * 1024  # Larger files are validated by size/mtime only
+
+# Execution journal of each session: successful workspace changes a resumed batch can skip
+JOURNAL_MAX_ENTRIES = int(os.getenv("APP_JOURNAL_MAX_ENTRIES", 1000))
+JOURNAL_MAX_BYTES = int(os.getenv("APP_JOURNAL_MAX_BYTES", 8 * 1024 * 1024))  # Per session
+
+# Structured (JSON/NDJSON) responses: larger file contents and command outputs are
+# sent by reference and fetched from GET /blobs/<id> (0 always inlines)
+RESPONSE_INLINE_BYTES = int(os.getenv("APP_RESPONSE_INLINE_BYTES", 64 * 1024))  # 64KB
+BLOB_STORE_MAX_BYTES = int(os.getenv("APP_BLOB_STORE_MAX_BYTES", 256 * 1024 * 1024))  # All blobs
+BLOB_TTL = int(os.getenv("APP_BLOB_TTL", 600))  # Seconds a blob stays retrievable
+
+# Text responses: task descriptions share a byte budget per request, weighted by task
+# priority; longer ones keep their head and tail, the full text is kept as a blob
+RESPONSE_BUDGET_BYTES = int(os.getenv("APP_RESPONSE_BUDGET_BYTES", 1024 * 1024))  # 0 disables the budget
+RESPONSE_MIN_TASK_BYTES = 512  # Every task gets at least this much, even over the budget
+BYTES_PER_TOKEN = 4  # Converts max_response_tokens to bytes
+
+# gzip (or zstd, when the zstandard package is installed) for clients that accept it
+RESPONSE_COMPRESSION = os.getenv("APP_RESPONSE_COMPRESSION", "1") == "1"
+RESPONSE_COMPRESS_MIN_BYTES = 1024  # Smaller bodies are sent as they are
+RESPONSE_GZIP_LEVEL = 6
+RESPONSE_ZSTD_LEVEL = 3
+
+# Cache of file metadata, directory listings and small file contents. Entries are
+# invalidated by filesystem events when watchdog is installed, otherwise by size/mtime
+FS_CACHE_MAX_BYTES = int(os.getenv("APP_FS_CACHE_MAX_BYTES", 64 * 1024 * 1024))  # 0 disables the cache
+FS_CACHE_MAX_FILE_BYTES = int(os.getenv("APP_FS_CACHE_MAX_FILE_BYTES", 256 * 1024))  # Larger files are not cached
+# Off by default with several workers: an event for another worker's write may arrive after our next read
+FS_CACHE_WATCH = os.getenv("APP_FS_CACHE_WATCH", "1" if WORKERS == 1 else "0") == "1"
+
+# Search tasks: trigram index of the text files under BASE_DIR, saved between restarts
+SEARCH_INDEX_PATH = os.getenv("APP_SEARCH_INDEX_PATH", os.path.join("logs", "search_index.pickle"))  # "" keeps it in memory
+SEARCH_MAX_FILE_BYTES = int(os.getenv("APP_SEARCH_MAX_FILE_BYTES", 1024 * 1024))  # Larger files are not indexed
+SEARCH_RESCAN_INTERVAL = float(os.getenv("APP_SEARCH_RESCAN_INTERVAL", 30))  # Seconds; finds changes made outside tasks
+SEARCH_MAX_RESULTS = int(os.getenv("APP_SEARCH_MAX_RESULTS", 100))  # Default matches per search task
+SEARCH_SNIPPET_CHARS = 200  # Longer matching lines are cut around the match
+
+# Admission control for /tasks: each batch is charged a cost (a weight per task type,
+# plus one token per ADMISSION_BYTES_PER_TOKEN of written content) against a token
+# bucket of its session and one of the server. A rate of 0 disables that bucket
+ADMISSION_RATE = float(os.getenv("APP_ADMISSION_RATE", 500))  # Tokens per second, all sessions
+ADMISSION_BURST = float(os.getenv("APP_ADMISSION_BURST", 1000))
+ADMISSION_SESSION_RATE = float(os.getenv("APP_ADMISSION_SESSION_RATE", 100))  # Tokens per second, each session
+ADMISSION_SESSION_BURST = float(os.getenv("APP_ADMISSION_SESSION_BURST", 300))
+ADMISSION_MAX_WAIT = float(os.getenv("APP_ADMISSION_MAX_WAIT", 10))  # Seconds a batch may queue before 429/503
+ADMISSION_QUEUE_SIZE = int(os.getenv("APP_ADMISSION_QUEUE_SIZE", 64))  # Batches waiting at once
+ADMISSION_BYTES_PER_TOKEN = 64 * 1024
+ADMISSION_TASK_COSTS = {
+    "exec": int(os.getenv("APP_ADMISSION_EXEC_COST", 10)),  # Commands hold a process and a concurrency slot
+    "search": 3,
+    "archive": 3,  # Reads and compresses a whole tree
+    "list": 2,
+}  # Other task types cost 1
+
+# Requests per client address on /tasks, enforced by flask-limiter (app.py) or the
+# limits library it is built on (asgi.py), e.g. "120/minute". "" disables the limit
+REQUEST_RATE_LIMIT = os.getenv("APP_REQUEST_RATE_LIMIT", "")
+
+# Re-read prompt templates when their files change (development only)
+TEMPLATE_HOT_RELOAD = os.getenv("APP_TEMPLATE_HOT_RELOAD", "0") == "1"
+
+# Logging: a background writer batches records and flushes on size or time
+LOG_ASYNC = os.getenv("APP_LOG_ASYNC", "1") == "1"
+LOG_JSON = os.getenv("APP_LOG_JSON", "0") == "1"  # JSON lines in app.log
+LOG_QUEUE_SIZE = int(os.getenv("APP_LOG_QUEUE_SIZE", 10000))
+LOG_QUEUE_POLICY = os.getenv("APP_LOG_QUEUE_POLICY", "drop")  # "drop" or "block" when the queue is full
+LOG_BATCH_SIZE = int(os.getenv("APP_LOG_BATCH_SIZE", 256))
+LOG_FLUSH_INTERVAL = float(os.getenv("APP_LOG_FLUSH_INTERVAL", 0.5))  # Seconds
+LOG_MAX_BYTES = int(os.getenv("APP_LOG_MAX_BYTES", 10 * 1024 * 1024))  # Rotate app.log at this size
+LOG_BACKUP_COUNT = int(os.getenv("APP_LOG_BACKUP_COUNT", 5))
+COMMAND_LOG_SAMPLE_LINES = int(os.getenv("APP_COMMAND_LOG_SAMPLE_LINES", 20))  # Output lines logged per command stream
+
+# Honor the X-Profile request header: profile the request with cProfile and save the stats
+PROFILE_REQUESTS = os.getenv("APP_PROFILE_REQUESTS", "0") == "1"
+PROFILE_DIR = os.getenv("APP_PROFILE_DIR", os.path.join("logs", "profiles"))
+
 # Log directory path
 LOG_DIR = "logs"
 if not os.path.exists(LOG_DIR):
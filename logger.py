@@ -1,15 +1,209 @@
+import atexit
+import contextvars
+import json
 import logging
 import os
+import queue
+import sys
+import threading
+import time
+from config import (
+    LOG_ASYNC,
+    LOG_JSON,
+    LOG_QUEUE_SIZE,
+    LOG_QUEUE_POLICY,
+    LOG_BATCH_SIZE,
+    LOG_FLUSH_INTERVAL,
+    LOG_MAX_BYTES,
+    LOG_BACKUP_COUNT,
+    WORKERS,
+)
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# One file per worker process: rotating a file that other processes append to loses records
+LOG_FILE = os.path.join(os.path.dirname(__file__), 'app.log' if WORKERS == 1 else f'app.{os.getpid()}.log')
+
+# Request context attached to every record logged while a task runs
+SESSION_ID = contextvars.ContextVar("session_id", default=None)
+TASK_ID = contextvars.ContextVar("task_id", default=None)
+
+
+class ContextFilter(logging.Filter):
+    """Copy the current session and task id onto the record"""
+
+    def filter(self, record):
+        if not hasattr(record, "session_id"):
+            record.session_id = SESSION_ID.get()
+        if not hasattr(record, "task_id"):
+            record.task_id = TASK_ID.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "session_id", None) is not None:
+            entry["session_id"] = record.session_id
+        if getattr(record, "task_id", None) is not None:
+            entry["task_id"] = record.task_id
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RotatingBatchFile:
+    """Append batches of lines to a file, rotating it when it grows past max_bytes"""
+
+    def __init__(self, path, max_bytes, backup_count):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.stream = open(path, "a", encoding="utf-8")
+
+    def write(self, text):
+        self.stream.write(text)
+        self.stream.flush()
+        if self.max_bytes and self.stream.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.stream.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                source = f"{self.path}.{i}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.stream = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        self.stream.close()
+
+
+class BatchingQueueHandler(logging.Handler):
+    """
+    Hand records to a background writer through a bounded queue.
+
+    The writer formats records in batches and writes each batch to the
+    console and the log file in one call, flushing when the batch is full
+    or flush_interval seconds have passed. When the queue is full, records
+    are dropped (and counted) or the caller blocks, depending on policy.
+    """
+
+    def __init__(self, outputs, queue_size=LOG_QUEUE_SIZE, policy=LOG_QUEUE_POLICY,
+                 batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL):
+        super().__init__()
+        self.outputs = outputs
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.policy = policy
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._stop = object()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            # Render the message now, arguments may change before the writer runs
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            if self.policy == "block":
+                self.queue.put(record)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        reported_drops = 0
+        while True:
+            timeout = max(0.0, deadline - time.monotonic())
+            try:
+                record = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                record = None
+            if record is self._stop:
+                self._write(batch)
+                return
+            if record is not None:
+                batch.append(record)
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                if self.dropped > reported_drops:
+                    batch.append(logging.makeLogRecord({
+                        "name": "LLMApp", "levelno": logging.WARNING, "levelname": "WARNING",
+                        "msg": f"Log queue full, dropped {self.dropped - reported_drops} records",
+                    }))
+                    reported_drops = self.dropped
+                self._write(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+    def _write(self, batch):
+        if not batch:
+            return
+        for output, formatter in self.outputs:
+            try:
+                output.write("".join(formatter.format(record) + "\n" for record in batch))
+            except Exception:
+                pass
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(self._stop)
+            self._thread.join(timeout=5)
+        for output, _ in self.outputs:
+            if isinstance(output, RotatingBatchFile):
+                output.close()
+        super().close()
+
+
+class _ConsoleOutput:
+    def write(self, text):
+        sys.stderr.write(text)
+        sys.stderr.flush()
+
+
+def _file_formatter():
+    return JsonFormatter() if LOG_JSON else logging.Formatter(LOG_FORMAT)
+
 
 # Configure the logger
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',  # Corrected format string
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler(os.path.join(os.path.dirname(__file__), 'app.log'))
-    ]
-)
+if LOG_ASYNC:
+    _handler = BatchingQueueHandler([
+        (_ConsoleOutput(), logging.Formatter(LOG_FORMAT)),
+        (RotatingBatchFile(LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT), _file_formatter()),
+    ])
+    _handler.addFilter(ContextFilter())
+    logging.basicConfig(level=logging.INFO, handlers=[_handler])
+    atexit.register(_handler.close)
+else:
+    from logging.handlers import RotatingFileHandler
+    _console = logging.StreamHandler()
+    _console.setFormatter(logging.Formatter(LOG_FORMAT))
+    _file = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    _file.setFormatter(_file_formatter())
+    for _h in (_console, _file):
+        _h.addFilter(ContextFilter())
+    logging.basicConfig(level=logging.INFO, handlers=[_console, _file])
 
 # Create LOGGER object
 LOGGER = logging.getLogger('LLMApp')
@@ -0,0 +1,31 @@
+"""
+Run the ASGI app with one or more worker processes.
+
+Workers share the listening socket, so any of them may receive a request.
+With more than one worker, tasks lock the paths they touch, a session runs
+its batches on one worker at a time and payloads sent by reference can be
+fetched from any worker, through the SQLite database at
+APP_SHARED_STATE_PATH. Per-process limits (concurrent tasks, exec slots,
+admission rates) apply to each worker.
+
+Usage: python serve.py [--workers 4] [--host 127.0.0.1] [--port 3000]
+"""
+import argparse
+import os
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("APP_WORKERS", os.cpu_count() or 1)))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3000)
+    args = parser.parse_args()
+
+    # Read by config.py in every worker, which imports the app after this is set
+    os.environ["APP_WORKERS"] = str(args.workers)
+    import uvicorn
+    uvicorn.run("asgi:app", host=args.host, port=args.port, workers=args.workers, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Admission control for /tasks.
+
+Each batch is charged a cost estimated from its tasks (commands weigh the
+most) against two token buckets: one per session and one for the whole
+server. A batch that finds enough tokens starts at once. Otherwise it
+reserves its tokens and waits, in a bounded queue, until the buckets would
+have refilled - provided that takes at most ADMISSION_MAX_WAIT seconds.
+Beyond that, or when the queue is full, the batch is rejected at once with
+a Retry-After hint instead of slowing down every batch already admitted:
+429 when the session is over its own rate, 503 when the server is.
+"""
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict
+from config import (
+    ADMISSION_BURST,
+    ADMISSION_BYTES_PER_TOKEN,
+    ADMISSION_MAX_WAIT,
+    ADMISSION_QUEUE_SIZE,
+    ADMISSION_RATE,
+    ADMISSION_SESSION_BURST,
+    ADMISSION_SESSION_RATE,
+    ADMISSION_TASK_COSTS,
+    MAX_SESSIONS,
+)
+from logger import LOGGER
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status  # 429 when the session is over its rate, 503 when the server is
+        self.message = message
+        self.retry_after = retry_after  # Whole seconds
+
+
+def _written_bytes(parameters):
+    """Size of what a task writes: write content, an extract archive or a sync manifest"""
+    if not isinstance(parameters, dict):
+        return 0
+    size = sum(len(parameters[name]) for name in ("content", "archive") if isinstance(parameters.get(name), str))
+    files = parameters.get("files")
+    if isinstance(files, dict):
+        for value in files.values():
+            if isinstance(value, dict):
+                value = value.get("content") or value.get("base64")
+            if isinstance(value, str):
+                size += len(value)
+    return size
+
+
+def estimate_cost(tasks):
+    """Cost of a batch: a weight per task type, plus the size of the content it writes"""
+    cost = 0.0
+    for task in tasks or ():
+        cost += ADMISSION_TASK_COSTS.get(task.get("type"), 1)
+        cost += _written_bytes(task.get("parameters")) / ADMISSION_BYTES_PER_TOKEN
+    return cost
+
+
+class TokenBucket:
+    """
+    Tokens refill at rate per second up to burst. Admitted batches may take
+    the balance below zero: that is the reservation of the batches waiting.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def charge(self, cost):
+        """Part of cost this bucket takes; a batch larger than the burst drains a full bucket"""
+        return min(cost, self.burst)
+
+    def wait_time(self, cost):
+        """Seconds until cost tokens are available"""
+        return max(0.0, (self.charge(cost) - self.tokens) / self.rate)
+
+
+class AdmissionController:
+    def __init__(self, rate=ADMISSION_RATE, burst=ADMISSION_BURST, session_rate=ADMISSION_SESSION_RATE,
+                 session_burst=ADMISSION_SESSION_BURST, max_wait=ADMISSION_MAX_WAIT, max_queue=ADMISSION_QUEUE_SIZE,
+                 max_sessions=MAX_SESSIONS):
+        now = time.monotonic()
+        self.server_bucket = TokenBucket(rate, burst, now) if rate > 0 else None  # None: no limit
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.max_sessions = max_sessions
+        self._session_buckets = OrderedDict()  # Session id -> TokenBucket, least recently used first
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.max_queue_depth = 0
+        self.admitted = 0
+        self.delayed = 0  # Admitted after waiting in the queue
+        self.rejected_session = 0
+        self.rejected_server = 0
+        self.rejected_queue_full = 0
+
+    def _session_bucket(self, session_id, now):
+        if self.session_rate <= 0:
+            return None
+        bucket = self._session_buckets.get(session_id)
+        if bucket is None:
+            bucket = self._session_buckets[session_id] = TokenBucket(self.session_rate, self.session_burst, now)
+            while len(self._session_buckets) > self.max_sessions:
+                self._session_buckets.popitem(last=False)
+        else:
+            self._session_buckets.move_to_end(session_id)
+        return bucket
+
+    def forget(self, session_id):
+        with self._lock:
+            self._session_buckets.pop(session_id, None)
+
+    async def admit(self, session_id, cost, max_wait=None):
+        """
+        Wait until a batch of the given cost may run.
+        :param max_wait: Tighter bound on the wait than ADMISSION_MAX_WAIT, e.g. the batch's deadline
+        :return: Seconds waited
+        :raises AdmissionRejected: If the batch cannot be admitted within the wait bound
+        """
+        with self._lock:
+            now = time.monotonic()
+            buckets = [b for b in (self._session_bucket(session_id, now), self.server_bucket) if b is not None]
+            for bucket in buckets:
+                bucket.refill(now)
+            session_wait = buckets[0].wait_time(cost) if self.session_rate > 0 else 0.0
+            server_wait = self.server_bucket.wait_time(cost) if self.server_bucket is not None else 0.0
+            wait = max(session_wait, server_wait)
+            limit = self.max_wait if max_wait is None else min(self.max_wait, max_wait)
+            if wait > limit:
+                if session_wait >= server_wait:
+                    self.rejected_session += 1
+                    raise AdmissionRejected(429, "Session is over its task rate limit", math.ceil(session_wait))
+                self.rejected_server += 1
+                raise AdmissionRejected(503, "Server is over its task rate limit", math.ceil(server_wait))
+            if wait > 0 and self.queued >= self.max_queue:
+                self.rejected_queue_full += 1
+                raise AdmissionRejected(503, "Server busy: admission queue is full", max(1, math.ceil(wait)))
+            charges = [(bucket, bucket.charge(cost)) for bucket in buckets]
+            for bucket, charge in charges:
+                bucket.tokens -= charge
+            if wait == 0:
+                self.admitted += 1
+                return 0.0
+            self.queued += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queued)
+
+        LOGGER.info(f"Batch of session {session_id} (cost {cost:.0f}) queued for {wait:.2f} s")
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            # The client went away: give the reservation back to the batches behind it
+            with self._lock:
+                now = time.monotonic()
+                for bucket, charge in charges:
+                    bucket.refill(now)
+                    bucket.tokens = min(bucket.burst, bucket.tokens + charge)
+            raise
+        finally:
+            with self._lock:
+                self.queued -= 1
+        with self._lock:
+            self.admitted += 1
+            self.delayed += 1
+        return wait
+
+    def stats(self):
+        server_tokens = 0
+        if self.server_bucket is not None:
+            with self._lock:
+                self.server_bucket.refill(time.monotonic())
+                server_tokens = round(self.server_bucket.tokens, 1)
+        return {
+            "queued": self.queued,
+            "max_queue_depth": self.max_queue_depth,
+            "admitted": self.admitted,
+            "delayed": self.delayed,
+            "rejected_session": self.rejected_session,
+            "rejected_server": self.rejected_server,
+            "rejected_queue_full": self.rejected_queue_full,
+            "server_tokens": server_tokens,  # Negative while batches wait on the server bucket
+        }
+
+
+ADMISSION = AdmissionController()
@@ -0,0 +1,104 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from config import BLOB_STORE_MAX_BYTES, BLOB_TTL
+from logger import LOGGER
+from services.shared_state import SHARED_STATE
+
+TEXT_CONTENT_TYPE = "text/plain; charset=utf-8"
+
+# Archives made by archive tasks, told apart from text payloads by their leading bytes
+ARCHIVE_SIGNATURES = (
+    (0, b"\x1f\x8b", "application/gzip"),
+    (0, b"PK\x03\x04", "application/zip"),
+    (257, b"ustar", "application/x-tar"),
+)
+
+
+def blob_content_type(data):
+    for offset, signature, content_type in ARCHIVE_SIGNATURES:
+        if data[offset:offset + len(signature)] == signature:
+            return content_type
+    return TEXT_CONTENT_TYPE
+
+
+class Blob:
+    def __init__(self, data, session_id, expires):
+        self.data = data
+        self.session_id = session_id
+        self.expires = expires
+
+
+class BlobStore:
+    """
+    Task payloads that structured responses send by reference instead of inline.
+    Blobs are addressed by unguessable ids, expire after ttl seconds and are
+    evicted oldest first beyond max_bytes. With shared state (several workers)
+    they are kept there, so any worker can serve them.
+    """
+
+    def __init__(self, max_bytes=BLOB_STORE_MAX_BYTES, ttl=BLOB_TTL, shared=SHARED_STATE):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.shared = shared
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        self._blobs = OrderedDict()  # Oldest first
+
+    def __len__(self):
+        return len(self._blobs)
+
+    def put(self, data, session_id=None):
+        """Store bytes, return the blob id"""
+        blob_id = secrets.token_urlsafe(16)
+        if self.shared is not None:
+            self.shared.put_blob(blob_id, data, session_id, self.ttl, self.max_bytes)
+            return blob_id
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            self._blobs[blob_id] = Blob(data, session_id, now + self.ttl)
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes and len(self._blobs) > 1:
+                evicted_id, _ = next(iter(self._blobs.items()))
+                self._remove(evicted_id)
+                LOGGER.info(f"Evicted blob {evicted_id}")
+        return blob_id
+
+    def get(self, blob_id):
+        """Return the stored bytes, or None if the blob is unknown or expired"""
+        if self.shared is not None:
+            return self.shared.get_blob(blob_id)
+        with self._lock:
+            self._expire(time.monotonic())
+            blob = self._blobs.get(blob_id)
+            return blob.data if blob is not None else None
+
+    def stored_bytes(self):
+        if self.shared is not None:
+            return self.shared.blob_bytes()
+        return self.total_bytes
+
+    def drop_session(self, session_id):
+        """Forget the blobs of an ended session"""
+        if self.shared is not None:
+            return  # Dropped with the shared session
+        with self._lock:
+            for blob_id in [k for k, blob in self._blobs.items() if blob.session_id == session_id]:
+                self._remove(blob_id)
+
+    def _remove(self, blob_id):
+        blob = self._blobs.pop(blob_id)
+        self.total_bytes -= len(blob.data)
+
+    def _expire(self, now):
+        # Every blob lives for the same ttl, so insertion order is expiry order
+        while self._blobs:
+            blob_id, blob = next(iter(self._blobs.items()))
+            if blob.expires > now:
+                break
+            self._remove(blob_id)
+
+
+BLOB_STORE = BlobStore()
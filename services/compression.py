@@ -0,0 +1,105 @@
+"""
+Content-Encoding of response bodies, negotiated with Accept-Encoding.
+
+zstd is preferred when the zstandard package is installed and the client
+accepts it, gzip otherwise. Streamed responses flush the compressor after
+every chunk, so each task result still reaches the client as it finishes.
+"""
+import gzip
+import zlib
+from config import RESPONSE_COMPRESSION, RESPONSE_COMPRESS_MIN_BYTES, RESPONSE_GZIP_LEVEL, RESPONSE_ZSTD_LEVEL
+from services.instrumentation import RESPONSE_BYTES
+
+try:
+    import zstandard  # Optional, faster and smaller than gzip
+except ImportError:
+    zstandard = None
+
+GZIP = "gzip"
+ZSTD = "zstd"
+IDENTITY = "identity"
+
+# Server preference, best first
+SUPPORTED_ENCODINGS = (ZSTD, GZIP) if zstandard is not None else (GZIP,)
+
+# Bodies already compressed, sent as they are
+COMPRESSED_TYPES = {"application/gzip", "application/zip"}
+
+
+def negotiate_encoding(accept_encoding, content_type=None):
+    """Encoding for an Accept-Encoding header value, None to send the body as it is"""
+    if not RESPONSE_COMPRESSION or not accept_encoding or content_type in COMPRESSED_TYPES:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, *params = item.split(";")
+        q = 1.0
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding.strip().lower()] = q
+    best, best_q = None, 0.0
+    for encoding in SUPPORTED_ENCODINGS:
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def encode_body(body, encoding):
+    """
+    Compress a whole response body.
+    :return: (body bytes, encoding applied or None)
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if encoding is None or len(body) < RESPONSE_COMPRESS_MIN_BYTES:
+        encoding = None
+    elif encoding == ZSTD:
+        body = zstandard.ZstdCompressor(level=RESPONSE_ZSTD_LEVEL).compress(body)
+    else:
+        body = gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL)
+    RESPONSE_BYTES.inc(encoding or IDENTITY, amount=len(body))
+    return body, encoding
+
+
+class StreamEncoder:
+    """Compresses a streamed body chunk by chunk"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == ZSTD:
+            self._compressor = zstandard.ZstdCompressor(level=RESPONSE_ZSTD_LEVEL).compressobj()
+        elif encoding == GZIP:
+            self._compressor = zlib.compressobj(RESPONSE_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        else:
+            self._compressor = None
+
+    def _count(self, data):
+        RESPONSE_BYTES.inc(self.encoding or IDENTITY, amount=len(data))
+        return data
+
+    def encode(self, chunk):
+        """Compressed chunk, flushed so the client can decode it at once"""
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        if self._compressor is None:
+            return self._count(chunk)
+        data = self._compressor.compress(chunk)
+        if self.encoding == ZSTD:
+            data += self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        else:
+            data += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return self._count(data)
+
+    def finish(self, chunk=b""):
+        """Last chunk of the body, ending the compressed stream"""
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        if self._compressor is None:
+            return self._count(chunk)
+        return self._count(self._compressor.compress(chunk) + self._compressor.flush())
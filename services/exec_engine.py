@@ -0,0 +1,218 @@
+import asyncio
+import os
+import signal
+import subprocess
+from config import MAX_COMMAND_OUTPUT, COMMAND_LOG_SAMPLE_LINES, EXEC_CPU_SECONDS, EXEC_MEMORY_MB
+from logger import LOGGER
+
+# Size of each read from the child's pipes
+READ_CHUNK_SIZE = 64 * 1024
+# How long to wait for the pipes to close after the process group was killed
+KILL_GRACE_PERIOD = 5
+
+# Environment of child processes, built once: the server's own settings are not passed on
+CHILD_ENV = {key: value for key, value in os.environ.items() if not key.startswith("APP_")}
+
+
+def limit_resources(command, cpu_seconds=EXEC_CPU_SECONDS, memory_mb=EXEC_MEMORY_MB):
+    """
+    Prefix a shell command with ulimit calls, so the shell and everything it
+    starts run under CPU time and heap size limits. Done in the child's shell
+    rather than with preexec_fn, which is unsafe in a threaded server.
+    """
+    if os.name == "nt":
+        return command
+    limits = []
+    if cpu_seconds:
+        limits.append(f"ulimit -t {int(cpu_seconds)} 2>/dev/null;")
+    if memory_mb:
+        # The data segment covers heap allocations but not address space reservations,
+        # so runtimes that reserve large virtual ranges (node) still start
+        limits.append(f"ulimit -d {int(memory_mb) * 1024} 2>/dev/null;")
+    if not limits:
+        return command
+    return " ".join(limits) + " " + command
+
+
+class CommandResult:
+    def __init__(self, command, returncode, stdout, stderr, stdout_truncated=False, stderr_truncated=False):
+        self.command = command
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.stdout_truncated = stdout_truncated
+        self.stderr_truncated = stderr_truncated
+
+    def __repr__(self):
+        return f"CommandResult(command={self.command!r}, returncode={self.returncode})"
+
+
+class _OutputCollector:
+    """Collect a pipe's output up to a byte limit, discarding (but counting) the rest"""
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.chunks = []
+        self.size = 0
+        self.dropped = 0
+        self.lines = 0
+        self._partial = b""
+        self._last_byte = b""
+
+    def feed(self, chunk):
+        room = self.limit - self.size
+        if room <= 0:
+            self.dropped += len(chunk)
+            return
+        kept = chunk[:room]
+        self.chunks.append(kept)
+        self.size += len(kept)
+        self.dropped += len(chunk) - len(kept)
+        self._log_lines(kept)
+
+    def _log_lines(self, chunk):
+        """Log the first COMMAND_LOG_SAMPLE_LINES lines, only count the rest"""
+        self._last_byte = chunk[-1:]
+        if self.lines >= COMMAND_LOG_SAMPLE_LINES:
+            self.lines += chunk.count(b"\n")
+            return
+        lines = (self._partial + chunk).split(b"\n")
+        self._partial = lines.pop()[-READ_CHUNK_SIZE:]
+        for line in lines:
+            self.lines += 1
+            if self.lines <= COMMAND_LOG_SAMPLE_LINES:
+                LOGGER.info(f"Command {self.name}: {line.decode('utf-8', errors='replace').rstrip()}")
+
+    def flush(self):
+        if self._last_byte not in (b"", b"\n"):
+            # Count (and log) the final line that has no trailing newline
+            self._log_lines(b"\n")
+        if self.lines > COMMAND_LOG_SAMPLE_LINES:
+            LOGGER.info(f"Command {self.name}: {self.lines} lines, {self.size + self.dropped} bytes "
+                        f"({COMMAND_LOG_SAMPLE_LINES} lines logged)")
+
+    def text(self):
+        content = b"".join(self.chunks).decode("utf-8", errors="replace")
+        if self.dropped:
+            content += f"\n... [{self.dropped} more bytes of {self.name} truncated]"
+        return content
+
+
+async def _drain(stream, collector):
+    while True:
+        chunk = await stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        collector.feed(chunk)
+    collector.flush()
+
+
+async def _spawn(command, cwd, env):
+    if os.name == "nt":
+        return await asyncio.create_subprocess_shell(
+            command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.DEVNULL,
+            cwd=cwd,
+            env=env,
+            creationflags=subprocess.CREATE_NEW_PROCESS_GROUP,
+        )
+    # A new session makes the shell the leader of its own process group,
+    # so the whole group can be killed on timeout
+    return await asyncio.create_subprocess_shell(
+        command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        stdin=asyncio.subprocess.DEVNULL,
+        cwd=cwd,
+        env=env,
+        start_new_session=True,
+    )
+
+
+def kill_process_group(process):
+    """Kill the process and every child it started"""
+    try:
+        if os.name == "nt":
+            if process.returncode is not None:
+                return
+            subprocess.run(
+                ["taskkill", "/F", "/T", "/PID", str(process.pid)],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # The whole group has already exited
+        pass
+    except OSError:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+
+
+async def run_command(command, timeout=60, cwd=None, env=None, max_output=MAX_COMMAND_OUTPUT,
+                      cpu_seconds=EXEC_CPU_SECONDS, memory_mb=EXEC_MEMORY_MB):
+    """
+    Run a shell command without blocking the event loop.
+
+    stdout and stderr are read concurrently, each capped at max_output bytes.
+    The timeout is a wall-clock limit for the whole command; when it expires,
+    or when the calling task is cancelled, the process group is killed.
+    CPU time and heap size are limited with ulimit on POSIX systems.
+
+    Args:
+        command: Command to execute
+        timeout: Timeout in seconds
+        cwd: Working directory
+        env: Environment for the child, CHILD_ENV when None
+        max_output: Maximum bytes captured per stream
+        cpu_seconds: CPU time limit, 0 for none
+        memory_mb: Heap size limit in MB, 0 for none
+
+    Returns:
+        CommandResult
+
+    Raises:
+        subprocess.TimeoutExpired: The command did not finish in time
+    """
+    process = await _spawn(limit_resources(command, cpu_seconds, memory_mb), cwd, CHILD_ENV if env is None else env)
+    stdout = _OutputCollector("stdout", max_output)
+    stderr = _OutputCollector("stderr", max_output)
+    readers = asyncio.gather(_drain(process.stdout, stdout), _drain(process.stderr, stderr), process.wait())
+
+    try:
+        await asyncio.wait_for(asyncio.shield(readers), timeout)
+    except asyncio.TimeoutError:
+        LOGGER.warning(f"Command timed out after {timeout} seconds, killing process group {process.pid}")
+        kill_process_group(process)
+        await _reap(process, readers)
+        raise subprocess.TimeoutExpired(command, timeout, stdout.text(), stderr.text())
+    except asyncio.CancelledError:
+        LOGGER.warning(f"Command cancelled, killing process group {process.pid}")
+        kill_process_group(process)
+        await _reap(process, readers)
+        raise
+
+    return CommandResult(
+        command,
+        process.returncode,
+        stdout.text(),
+        stderr.text(),
+        stdout_truncated=bool(stdout.dropped),
+        stderr_truncated=bool(stderr.dropped),
+    )
+
+
+async def _reap(process, readers):
+    """Wait briefly for a killed process and its pipes, so nothing is left behind"""
+    try:
+        await asyncio.wait_for(readers, KILL_GRACE_PERIOD)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        readers.cancel()
+    except Exception:
+        pass
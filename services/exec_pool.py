@@ -0,0 +1,159 @@
+import asyncio
+import threading
+from collections import deque
+from config import EXEC_MAX_WORKERS, EXEC_SESSION_QUOTA
+
+
+class _Waiter:
+    __slots__ = ("loop", "future", "session_id")
+
+    def __init__(self, loop, future, session_id):
+        self.loop = loop
+        self.future = future
+        self.session_id = session_id
+
+
+class ExecPool:
+    """
+    Bounded pool of command slots, shared fairly between sessions.
+
+    At most max_workers commands run at once in the whole process, and at
+    most session_quota per session. Commands beyond that wait in one queue
+    per session; a freed slot goes to the next session in round-robin order,
+    so one session sending hundreds of commands cannot starve the others.
+    Like ConcurrencyLimiter, it can be shared between event loops.
+    """
+
+    def __init__(self, max_workers, session_quota):
+        if max_workers < 1 or session_quota < 1:
+            raise ValueError("Exec pool sizes must be at least 1")
+        self.max_workers = max_workers
+        self.session_quota = session_quota
+        self.running = 0
+        self._running_by_session = {}
+        self._queues = {}  # Session id -> deque of waiters
+        self._rotation = deque()  # Sessions with queued waiters, next to be served first
+        self._lock = threading.Lock()
+        self.started = 0
+        self.queued_total = 0  # Commands that had to wait for a slot
+        self.max_queue_depth = 0
+
+    @property
+    def waiting(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def _dispatch(self):
+        """Hand free slots to waiters, round-robin over sessions. Caller holds the lock."""
+        granted = []
+        skipped = 0
+        while self.running < self.max_workers and skipped < len(self._rotation):
+            session_id = self._rotation[0]
+            self._rotation.rotate(-1)
+            if self._running_by_session.get(session_id, 0) >= self.session_quota:
+                skipped += 1
+                continue
+            queue = self._queues[session_id]
+            waiter = queue.popleft()
+            if not queue:
+                del self._queues[session_id]
+                self._rotation.remove(session_id)
+            self._take(session_id)
+            granted.append(waiter)
+            skipped = 0
+        return granted
+
+    def _take(self, session_id):
+        self.running += 1
+        self.started += 1
+        self._running_by_session[session_id] = self._running_by_session.get(session_id, 0) + 1
+
+    async def acquire(self, session_id=None):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if (not self._queues and self.running < self.max_workers
+                    and self._running_by_session.get(session_id, 0) < self.session_quota):
+                self._take(session_id)
+                return
+            waiter = _Waiter(loop, loop.create_future(), session_id)
+            if session_id not in self._queues:
+                self._queues[session_id] = deque()
+                self._rotation.append(session_id)
+            self._queues[session_id].append(waiter)
+            self.queued_total += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.waiting)
+            granted = self._dispatch()
+        self._notify(granted)
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                queue = self._queues.get(session_id)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self._queues[session_id]
+                        self._rotation.remove(session_id)
+                    granted = False
+                else:
+                    # Dispatched to us: the slot is ours to give back only if _grant already ran,
+                    # otherwise _grant finds the future cancelled and releases it
+                    granted = waiter.future.done() and not waiter.future.cancelled()
+            if granted:
+                self.release(session_id)
+            raise
+
+    def release(self, session_id=None):
+        with self._lock:
+            self.running -= 1
+            count = self._running_by_session.get(session_id, 0) - 1
+            if count > 0:
+                self._running_by_session[session_id] = count
+            else:
+                self._running_by_session.pop(session_id, None)
+            granted = self._dispatch()
+        self._notify(granted)
+
+    def _notify(self, granted):
+        for waiter in granted:
+            waiter.loop.call_soon_threadsafe(self._grant, waiter)
+
+    def _grant(self, waiter):
+        if waiter.future.done():
+            # The waiter was cancelled before it could take the slot
+            self.release(waiter.session_id)
+        else:
+            waiter.future.set_result(None)
+
+    def slot(self, session_id=None):
+        """Async context manager holding one command slot for a session"""
+        return _Slot(self, session_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "session_quota": self.session_quota,
+                "running": self.running,
+                "waiting": self.waiting,
+                "sessions_waiting": len(self._rotation),
+                "started": self.started,
+                "queued_total": self.queued_total,
+                "max_queue_depth": self.max_queue_depth,
+            }
+
+
+class _Slot:
+    def __init__(self, pool, session_id):
+        self.pool = pool
+        self.session_id = session_id
+
+    async def __aenter__(self):
+        await self.pool.acquire(self.session_id)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.pool.release(self.session_id)
+
+
+EXEC_POOL = ExecPool(EXEC_MAX_WORKERS, EXEC_SESSION_QUOTA)
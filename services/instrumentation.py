@@ -0,0 +1,142 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import time
+from contextlib import contextmanager
+from config import PROFILE_REQUESTS, PROFILE_DIR
+from logger import LOGGER
+from services.admission import ADMISSION
+from services.blob_store import BLOB_STORE
+from services.exec_pool import EXEC_POOL
+from services.session_store import SESSION_STORE
+from services.shared_state import SHARED_STATE
+from utils.fs_cache import FS_CACHE
+from utils.io_executor import IO_EXECUTOR
+from utils.search_index import SEARCH_INDEX
+from utils.metrics import REGISTRY, Counter, Gauge, Histogram
+
+TASKS = REGISTRY.register(Counter(
+    "llmapp_tasks_total", "Finished tasks by type and outcome", ("type", "status")))
+TASK_DURATION = REGISTRY.register(Histogram(
+    "llmapp_task_duration_seconds", "Time spent running a task handler", ("type",)))
+TASK_QUEUE_TIME = REGISTRY.register(Histogram(
+    "llmapp_task_queue_seconds", "Time a ready task waited for a concurrency slot", ("type",)))
+TASKS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "llmapp_tasks_in_flight", "Tasks whose handler is running"))
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "llmapp_session_cache_lookups_total", "Session result cache lookups", ("result",)))
+EXEC_EXIT_CODES = REGISTRY.register(Counter(
+    "llmapp_exec_exit_codes_total", "Exit codes of exec commands, \"timeout\" for killed commands", ("code",)))
+BYTES_READ = REGISTRY.register(Counter(
+    "llmapp_bytes_read_total", "File bytes returned by read tasks"))
+BYTES_WRITTEN = REGISTRY.register(Counter(
+    "llmapp_bytes_written_total", "File bytes written by write tasks"))
+REQUESTS = REGISTRY.register(Counter(
+    "llmapp_requests_total", "Handled /tasks requests by HTTP status", ("status",)))
+REQUEST_PHASES = REGISTRY.register(Histogram(
+    "llmapp_request_phase_seconds", "Time spent in each phase of a /tasks request", ("phase",)))
+RESPONSE_BYTES = REGISTRY.register(Counter(
+    "llmapp_response_bytes_total", "Bytes of /tasks and /blobs response bodies as sent, by content encoding",
+    ("encoding",)))
+RESPONSE_OMITTED_BYTES = REGISTRY.register(Counter(
+    "llmapp_response_omitted_bytes_total", "Task output left out of text responses by the response budget"))
+
+# Read at scrape time from the components that already track them
+REGISTRY.register(Gauge(
+    "llmapp_io_executor", "Shared I/O executor state and totals", ("stat",),
+    callback=lambda: {(k,): v for k, v in IO_EXECUTOR.stats().items()}))
+REGISTRY.register(Gauge(
+    "llmapp_exec_pool", "Exec command pool state and totals", ("stat",),
+    callback=lambda: {(k,): v for k, v in EXEC_POOL.stats().items()}))
+REGISTRY.register(Gauge(
+    "llmapp_sessions", "Live sessions", callback=lambda: {(): len(SESSION_STORE)}))
+REGISTRY.register(Gauge(
+    "llmapp_session_cache_bytes", "Bytes of cached results and file hashes in all sessions",
+    callback=lambda: {(): SESSION_STORE.cache_bytes}))
+REGISTRY.register(Gauge(
+    "llmapp_blob_store_bytes", "Bytes of task payloads held for GET /blobs",
+    callback=lambda: {(): BLOB_STORE.stored_bytes()}))
+REGISTRY.register(Gauge(
+    "llmapp_fs_cache", "File metadata and content cache state and totals", ("stat",),
+    callback=lambda: {(k,): v for k, v in FS_CACHE.stats().items()}))
+REGISTRY.register(Gauge(
+    "llmapp_search_index", "Files, documents and trigrams held by the search index", ("stat",),
+    callback=lambda: {(k,): v for k, v in SEARCH_INDEX.stats().items()}))
+REGISTRY.register(Gauge(
+    "llmapp_admission", "Admission queue depth, admitted and rejected batches", ("stat",),
+    callback=lambda: {(k,): v for k, v in ADMISSION.stats().items()}))
+if SHARED_STATE is not None:
+    REGISTRY.register(Gauge(
+        "llmapp_shared_state", "Path locks and session leases shared by the workers", ("stat",),
+        callback=lambda: {(k,): v for k, v in SHARED_STATE.stats().items()}))
+
+
+class RequestTimer:
+    """Wall time of the phases of one /tasks request"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+            REQUEST_PHASES.observe(elapsed, name)
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        """Value of a Server-Timing response header, durations in milliseconds"""
+        entries = [f"{name};dur={elapsed * 1e3:.2f}" for name, elapsed in self.phases.items()]
+        entries.append(f"total;dur={self.total() * 1e3:.2f}")
+        return ", ".join(entries)
+
+    def describe(self):
+        return ", ".join(f"{name} {elapsed * 1e3:.1f} ms" for name, elapsed in self.phases.items())
+
+
+def record_request(timer, status):
+    """Count a finished request and log its phase breakdown"""
+    REQUESTS.inc(status)
+    if timer is not None and timer.phases:
+        LOGGER.info(f"Request finished with {status} in {timer.total() * 1e3:.1f} ms ({timer.describe()})")
+
+
+def profiling_requested(header_value):
+    """True if the X-Profile header asks for a profile and profiling is enabled"""
+    return PROFILE_REQUESTS and str(header_value or "").strip().lower() in ("1", "true", "yes")
+
+
+class RequestProfiler:
+    """
+    cProfile the calling thread while a request runs, then save the stats to
+    PROFILE_DIR (open with pstats or snakeviz) and log the top functions.
+    On a shared event loop, concurrent requests show up in the profile as well.
+    """
+
+    def __init__(self, label):
+        self.label = re.sub(r"[^A-Za-z0-9_.-]", "_", str(label))[:64]
+        self.profile = cProfile.Profile()
+        self.path = None
+
+    def __enter__(self):
+        self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profile.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        self.path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{self.label}-{os.getpid()}.prof")
+        self.profile.dump_stats(self.path)
+        summary = io.StringIO()
+        pstats.Stats(self.profile, stream=summary).sort_stats("cumulative").print_stats(15)
+        LOGGER.info(f"Request profile saved to {self.path}\n{summary.getvalue()}")
+        return False
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from config import JOURNAL_MAX_ENTRIES, JOURNAL_MAX_BYTES
+from utils.path_policy import PATH_POLICY
+
+# Parameters naming the paths a task changes, whose state is checked before a result is reused
+WRITTEN_PATH_PARAMETERS = {
+    "write": ("path",),
+    "delete": ("path",),
+    "mkdir": ("path",),
+    "move": ("source", "destination"),
+    "copy": ("destination",),
+}
+
+# Task types that always run again on resume: the files they write are not known from
+# their parameters, and rerunning them skips every file that already matches
+NOT_JOURNALED = {"extract", "sync"}
+
+
+def assign_fingerprints(ordered_nodes):
+    """
+    Fingerprint every node from its type, parameters and the fingerprints of
+    its declared dependencies, so a task whose inputs upstream changed gets a new one.
+    :param ordered_nodes: Nodes in topological order
+    """
+    by_id = {}
+    for node in ordered_nodes:
+        upstream = sorted(by_id[dep] for dep in node.declared_depends_on if dep in by_id)
+        payload = json.dumps([node.type, node.parameters, upstream], sort_keys=True, default=str)
+        node.fingerprint = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        by_id[node.id] = node.fingerprint
+
+
+def _snapshot(task):
+    """(path, size, mtime_ns) of every path the task changed, size None for missing paths"""
+    effects = []
+    for name in WRITTEN_PATH_PARAMETERS.get(task.type, ()):
+        path = PATH_POLICY.resolve(task.parameters.get(name))
+        if path is None:
+            continue
+        try:
+            stat = os.stat(path)
+            effects.append((path, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            effects.append((path, None, None))
+    return tuple(effects)
+
+
+def _key(task_id):
+    # Ids come from JSON, where 1 and "1" name different tasks
+    return json.dumps(task_id, sort_keys=True, default=str)
+
+
+class JournalEntry:
+    __slots__ = ("fingerprint", "description", "effects", "size", "recorded_at")
+
+    def __init__(self, fingerprint, description, effects):
+        self.fingerprint = fingerprint
+        self.description = description
+        self.effects = effects  # Workspace state the task left behind
+        self.size = len(description) + 256  # Rough per-entry overhead
+        self.recorded_at = time.time()
+
+
+class ExecutionJournal:
+    """
+    Successful tasks of a session that changed the workspace, keyed by task id.
+    A resumed batch reuses an entry when the task's fingerprint is unchanged
+    and the paths it changed still look the way it left them.
+    """
+
+    def __init__(self, max_entries=JOURNAL_MAX_ENTRIES, max_bytes=JOURNAL_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # Task id -> JournalEntry, oldest first
+        self.total_bytes = 0
+        self.last_tasks = None  # Tasks of the latest batch, replayed by a resume without tasks
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, task):
+        """Return the recorded description of the task, or None if it has to run"""
+        if task.type in NOT_JOURNALED:
+            return None
+        entry = self.entries.get(_key(task.id))
+        if entry is None or entry.fingerprint != task.fingerprint:
+            return None
+        if _snapshot(task) != entry.effects:
+            return None  # Something else changed what the task wrote
+        return entry.description
+
+    def record(self, task, description):
+        self.forget(task.id)
+        if task.type in NOT_JOURNALED:
+            return
+        entry = JournalEntry(task.fingerprint, description, _snapshot(task))
+        self.entries[_key(task.id)] = entry
+        self.total_bytes += entry.size
+        while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= evicted.size
+
+    def forget(self, task_id):
+        entry = self.entries.pop(_key(task_id), None)
+        if entry is not None:
+            self.total_bytes -= entry.size
@@ -0,0 +1,344 @@
+import asyncio
+import os
+from contextlib import nullcontext
+from services.admission import ADMISSION, estimate_cost
+from services.blob_store import BLOB_STORE
+from services.instrumentation import RequestTimer
+from services.session_store import SESSION_STORE, WORKSPACE_GENERATION, is_mutating
+from services.shared_state import SHARED_STATE
+from services.task_handlers import TASK_HANDLERS
+from services.task_optimizer import ANY_PATH, optimize_task_graph, task_paths
+from services.journal import assign_fingerprints
+from services.task_tree import FAILURE_POLICIES, build_task_tree, collect_nodes, execute_task_tree, topological_order
+from config import BYTES_PER_TOKEN, COALESCE_TASKS, RESPONSE_BUDGET_BYTES
+from logger import LOGGER, SESSION_ID, TASK_ID
+from utils.path_policy import PATH_POLICY
+from utils.fs_cache import FS_CACHE
+from utils.search_index import SEARCH_INDEX
+from utils.io_executor import run_io
+
+
+class RequestError(ValueError):
+    """Raised when a /tasks payload is malformed"""
+
+    def __init__(self, message, details=""):
+        super().__init__(message)
+        self.message = message
+        self.details = details
+
+
+class TaskRequest:
+    def __init__(self, session_id, tasks, max_concurrency=None, ended=False, resume=False,
+                 failure_policy=None, deadline=None, response_budget=None):
+        self.session_id = session_id
+        self.tasks = tasks  # None for a resume of the session's previous batch
+        self.max_concurrency = max_concurrency
+        self.ended = ended
+        self.resume = resume
+        self.failure_policy = failure_policy
+        self.deadline = deadline  # Seconds the whole batch may run
+        self.response_budget = response_budget  # Bytes of task output in a text response, None for no limit
+
+
+def parse_request(data):
+    """
+    Validate a /tasks payload.
+    :param data: Decoded JSON body
+    :return: TaskRequest
+    :raises RequestError: If the payload is invalid
+    """
+    if not isinstance(data, dict):
+        LOGGER.warning("Invalid request format received")
+        raise RequestError("Invalid request format")
+
+    # Validate and log session_id
+    session_id = data.get("session_id")
+    if not session_id:
+        raise RequestError("Missing session_id")
+    LOGGER.info(f"Processing tasks for session: {session_id}")
+
+    if not isinstance(data.get("request"), dict):
+        LOGGER.warning("Invalid request format received")
+        raise RequestError("Invalid request format")
+
+    resume = data["request"].get("resume", False)
+    if not isinstance(resume, bool):
+        raise RequestError("resume must be a boolean")
+    if "tasks" not in data["request"]:
+        if not resume:
+            LOGGER.warning("Invalid request format received")
+            raise RequestError("Invalid request format")
+        return TaskRequest(session_id, None, resume=True, **_execution_options(data))
+
+    tasks = data["request"]["tasks"]
+    if not isinstance(tasks, list) or not tasks:
+        LOGGER.warning("Invalid tasks format or empty tasks list")
+        raise RequestError("Tasks must be a non-empty array")
+
+    # Validate the format of each task
+    for task in tasks:
+        if not isinstance(task, dict) or "type" not in task or "id" not in task:
+            LOGGER.warning(f"Invalid task format: {task}")
+            raise RequestError("Each task must include 'type' and 'id'", f"Invalid task: {task}")
+
+        if task["type"] == "end":
+            return TaskRequest(session_id, tasks, ended=True)
+
+    return TaskRequest(session_id, tasks, resume=resume, **_execution_options(data))
+
+
+def _execution_options(data):
+    """Validated scheduling options of a request"""
+    options = data["request"]
+    max_concurrency = options.get("max_concurrency")
+    if max_concurrency is not None and (not isinstance(max_concurrency, int) or max_concurrency < 1):
+        raise RequestError("max_concurrency must be a positive integer")
+    failure_policy = options.get("on_failure")
+    if failure_policy is not None and failure_policy not in FAILURE_POLICIES:
+        raise RequestError(f"on_failure must be one of: {', '.join(FAILURE_POLICIES)}")
+    deadline = options.get("deadline")
+    if deadline is not None and (isinstance(deadline, bool) or not isinstance(deadline, (int, float)) or deadline <= 0):
+        raise RequestError("deadline must be a positive number of seconds")
+    requested = []
+    for name, scale in (("max_response_bytes", 1), ("max_response_tokens", BYTES_PER_TOKEN)):
+        value = options.get(name)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            raise RequestError(f"{name} must be a positive integer")
+        requested.append(value * scale)
+    # A request may raise the server's default budget as well as lower it
+    response_budget = min(requested) if requested else RESPONSE_BUDGET_BYTES or None
+    return {"max_concurrency": max_concurrency, "failure_policy": failure_policy, "deadline": deadline,
+            "response_budget": response_budget}
+
+
+async def dispatch_task(task):
+    """
+    Run a single task with the handler registered for its type.
+    Cacheable tasks are answered from the session's result cache when their inputs are unchanged.
+    """
+    handler = TASK_HANDLERS.get(task.type)
+    if handler is None:
+        raise ValueError(f"Unknown task type: {task.type}")
+
+    # Runs in the node's own asyncio task, so this only tags records of this task
+    TASK_ID.set(task.id)
+    if task.coalesced_into is not None:
+        coalesced = coalesced_result(task)
+        if coalesced is not None:
+            return coalesced
+    session = task.session
+    if session is None:
+        return await handler(task)
+
+    if task.resume:
+        with SESSION_STORE.lock:
+            journaled = session.journal.lookup(task)
+        if journaled is not None:
+            task.resumed = True
+            return journaled
+    if is_mutating(task) or not task.resume:
+        # This task runs again, so whatever depends on it has to run again too; a read-only
+        # task passes that on when it runs because something upstream of it ran again
+        rerun_dependents(task)
+
+    with SESSION_STORE.lock:
+        # Read before running, so a change made meanwhile by another session invalidates the result
+        generation = WORKSPACE_GENERATION.value
+        key = session.cache_key(task)
+        if key is not None:
+            cached = session.lookup(key)
+            if cached is not None:
+                task.cache_status = "hit"
+                return cached
+            task.cache_status = "miss"
+
+    succeeded = False
+    try:
+        async with path_locks(task):
+            result = await handler(task)
+        succeeded = True
+    except Exception:
+        rerun_dependents(task)
+        with SESSION_STORE.lock:
+            session.journal.forget(task.id)
+        raise
+    finally:
+        if is_mutating(task):
+            # Anything else may have changed the workspace, even when it failed
+            with SESSION_STORE.lock:
+                session.record_mutation(task, succeeded)
+            if task.type == "exec":
+                # Commands can replace directories with symlinks, drop cached resolutions
+                PATH_POLICY.invalidate()
+                FS_CACHE.clear()
+                SEARCH_INDEX.invalidate_all()
+                if SHARED_STATE is not None:
+                    await run_io(SHARED_STATE.record_change, None)
+
+    with SESSION_STORE.lock:
+        if is_mutating(task):
+            session.journal.record(task, result)
+        # Writes grow the session's file hashes, which count against the limit too
+        if session.store(key, task, result, generation) or is_mutating(task):
+            SESSION_STORE.enforce_memory_limit()
+    return result
+
+
+def path_locks(task):
+    """
+    Locks a task holds while it runs when several workers serve requests:
+    shared on the paths it reads, exclusive on the paths it changes.
+    Commands take none, their effects cannot be known.
+    """
+    if SHARED_STATE is None:
+        return nullcontext()
+    reads, writes = task_paths(task)
+    accesses = {}
+    for paths, exclusive in ((reads, False), (writes, True)):
+        for path in paths:
+            if path is ANY_PATH:
+                continue
+            for key in _lock_keys(path):
+                accesses[key] = accesses.get(key, False) or exclusive
+    if not accesses:
+        return nullcontext()
+    return SHARED_STATE.lock_paths(sorted(accesses.items()))
+
+
+def _lock_keys(path):
+    """
+    Keys of the real paths a task parameter names, relative to the base directory:
+    the same file reached through a symlink or another spelling gets the same key.
+    A symlink in the last component is locked along with its target.
+    """
+    keys = set()
+    for follow_symlinks in (True, False):
+        real = PATH_POLICY.resolve(path, follow_symlinks=follow_symlinks)
+        if real is not None:
+            relative = os.path.relpath(real, PATH_POLICY.base_dir).replace(os.sep, "/")
+            keys.add("" if relative == "." else relative)
+    return keys
+
+
+def coalesced_result(task):
+    """
+    Result of a task from the task it was coalesced into, which has already run.
+    Returns None when the task has to run on its own after all.
+    """
+    primary = task.coalesced_into.result
+    if task.type == "mkdir":
+        if not primary["success"]:
+            return None  # The deeper directory failed, the parent may still be creatable
+        return f"Directory '{task.parameters.get('path')}' created with task {task.coalesced_into.id}"
+    if not primary["success"]:
+        raise RuntimeError(primary["description"])
+    return primary["description"]
+
+
+def rerun_dependents(task):
+    """Keep tasks that declared a dependency on this one from reusing journaled results"""
+    for child in task.children:
+        if task.id in child.declared_depends_on:
+            child.resume = False
+
+
+async def end_session(session_id):
+    """Forget the state of a session that sent an 'end' task"""
+    SESSION_STORE.drop(session_id)
+    BLOB_STORE.drop_session(session_id)
+    ADMISSION.forget(session_id)
+    if SHARED_STATE is not None:
+        await run_io(SHARED_STATE.drop_session, session_id)
+    LOGGER.info(f"Session ended: {session_id}")
+
+
+async def admit_request(task_request):
+    """
+    Wait until admission control lets a validated request run.
+    :return: Seconds the request waited in the admission queue
+    :raises AdmissionRejected: If the session or the server is over its rate for longer than the request can wait
+    """
+    return await ADMISSION.admit(task_request.session_id, estimate_cost(request_tasks(task_request)),
+                                 max_wait=task_request.deadline)
+
+
+def request_tasks(task_request):
+    """Tasks a request will run: its own, or the session's previous batch for a resume without tasks"""
+    if task_request.tasks is not None:
+        return task_request.tasks
+    return SESSION_STORE.get(task_request.session_id).journal.last_tasks or []
+
+
+async def run_tasks(task_request, on_result=None, timer=None):
+    """
+    Build and execute the task tree of a validated request.
+    :param task_request: TaskRequest
+    :param on_result: Optional callback invoked with each result as soon as its task finishes
+    :param timer: Optional RequestTimer that receives the build and execute phases
+    :return: List of execution results
+    """
+    timer = timer or RequestTimer()
+    SESSION_ID.set(task_request.session_id)
+    if SHARED_STATE is None:
+        return await _run_batch(task_request, on_result, timer)
+
+    # Other workers may have run this session or changed files since our last batch
+    session_id = task_request.session_id
+    with timer.phase("lease"):
+        version, state = await SHARED_STATE.acquire_session(session_id, SESSION_STORE.get(session_id).shared_version)
+    try:
+        if version != SESSION_STORE.get(session_id).shared_version:
+            SESSION_STORE.restore(session_id, state, version)
+        await apply_shared_changes()
+        return await _run_batch(task_request, on_result, timer)
+    finally:
+        session = SESSION_STORE.get(session_id)
+        with SESSION_STORE.lock:
+            state = session.dumps()
+        # Shielded like the path locks: a cancelled batch must still hand the session back
+        session.shared_version = await asyncio.shield(run_io(SHARED_STATE.release_session, session_id, state))
+
+
+async def apply_shared_changes():
+    """Drop what this worker's caches know about paths that other workers changed"""
+    changes = await run_io(SHARED_STATE.pending_changes)
+    if changes != []:
+        WORKSPACE_GENERATION.bump()
+    if changes is None:
+        PATH_POLICY.invalidate()
+        FS_CACHE.clear()
+        SEARCH_INDEX.invalidate_all()
+        return
+    for path, recursive in changes:
+        FS_CACHE.invalidate(path, recursive=recursive)
+        SEARCH_INDEX.invalidate(path, recursive=recursive)
+
+
+async def _run_batch(task_request, on_result, timer):
+    session = SESSION_STORE.get(task_request.session_id)
+    tasks = task_request.tasks
+    if tasks is None:
+        tasks = session.journal.last_tasks
+        if not tasks:
+            raise ValueError("Nothing to resume: this session has no previous batch")
+    with timer.phase("build"):
+        # Build the task tree from the list of tasks
+        root_nodes = await build_task_tree(tasks)
+        nodes = collect_nodes(root_nodes)
+        if COALESCE_TASKS:
+            # May add dependencies, so roots are recomputed
+            optimize_task_graph(nodes)
+            root_nodes = [node for node in nodes if not node.depends_on]
+        assign_fingerprints(topological_order(nodes))
+    session.journal.last_tasks = tasks
+    for node in nodes:
+        node.session = session
+        node.resume = task_request.resume
+    # Execute the task tree and collect results
+    with timer.phase("execute"):
+        return await execute_task_tree(
+            root_nodes, dispatch_task, max_concurrency=task_request.max_concurrency, on_result=on_result,
+            failure_policy=task_request.failure_policy, deadline=task_request.deadline,
+        )
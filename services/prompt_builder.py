@@ -1,8 +1,15 @@
 import logging
 import os
+import re
+import threading
+from config import TEMPLATE_HOT_RELOAD
 
 logger = logging.getLogger(__name__)
 
+# Relative template paths are resolved against the project root, not the process cwd
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLACEHOLDER_PATTERN = re.compile(r"\{\{([A-Z_]+)\}\}")
+
 def load_template(file_path):
     try:
         # Check if the template file exists
@@ -16,31 +23,117 @@ def load_template(file_path):
         logger.error(f"Error loading template: {str(e)}")
         raise
 
-def build_prompt(results, template_path="templates/prompt_template.txt"):
-    # Load the template content
-    template = load_template(template_path)
-    # Build the task details string from the results
-    task_details = "\n".join(
-        [f"  - Task {r['id']} ({r['type']}): {'Success' if r['success'] else 'Failed'}. {r['description']}"
-         for r in results]
-    )
+class CompiledTemplate:
+    """A template parsed once into literal text and placeholder names"""
+
+    def __init__(self, source):
+        # Even indexes hold literal text, odd indexes hold placeholder names
+        self.segments = PLACEHOLDER_PATTERN.split(source)
+
+    def render(self, values):
+        """Fill every placeholder in a single join; unknown placeholders are kept as-is"""
+        segments = self.segments
+        parts = [segments[0]]
+        for i in range(1, len(segments), 2):
+            name = segments[i]
+            parts.append(values[name] if name in values else "{{" + name + "}}")
+            parts.append(segments[i + 1])
+        return "".join(parts)
+
+    def split(self, name):
+        """Return (before, after) templates around the first occurrence of a placeholder"""
+        segments = self.segments
+        for i in range(1, len(segments), 2):
+            if segments[i] == name:
+                before, after = CompiledTemplate(""), CompiledTemplate("")
+                before.segments = segments[:i]
+                after.segments = segments[i + 1:]
+                return before, after
+        return self, CompiledTemplate("")
+
+_template_cache = {}  # Resolved path -> (mtime_ns, CompiledTemplate)
+_template_lock = threading.Lock()
+
+def get_template(file_path):
+    """
+    Return the compiled template, loading and parsing it only once.
+    With TEMPLATE_HOT_RELOAD enabled, the file is re-parsed when its mtime changes.
+    """
+    path = file_path if os.path.isabs(file_path) else os.path.join(PROJECT_ROOT, file_path)
+    cached = _template_cache.get(path)
+    if cached is not None and not TEMPLATE_HOT_RELOAD:
+        return cached[1]
+
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime_ns = None
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+
+    with _template_lock:
+        compiled = CompiledTemplate(load_template(path))
+        _template_cache[path] = (mtime_ns, compiled)
+    return compiled
+
+STATUS_LABELS = {"success": "Success", "failed": "Failed", "skipped": "Skipped", "cancelled": "Cancelled"}
+
+def format_task_result(result):
+    """Render one task result as a line of the prompt"""
+    status = STATUS_LABELS.get(result.get("status"), "Success" if result["success"] else "Failed")
+    if result.get("cache"):
+        status += f" [cache {result['cache']}]"
+    if result.get("coalesced") is not None:
+        status += f" [coalesced with task {result['coalesced']}]"
+    if result.get("resumed"):
+        status += " [already completed]"
+    if result.get("timing"):
+        status += f" ({result['timing']['run_ms']:.1f} ms)"
+    return f"  - Task {result['id']} ({result['type']}): {status}. {result['description']}"
+
+def build_summary(results):
+    """Return the (summary, next_steps) pair for a list of results"""
     # Determine if all tasks were successful
     all_success = all(r["success"] for r in results)
     # Create a summary based on the success of all tasks
     summary = "All tasks completed successfully." if all_success else "Some tasks failed."
+    not_run = [r.get("status") for r in results if r.get("status") in ("skipped", "cancelled")]
+    if not_run:
+        summary += f" {not_run.count('skipped')} skipped, {not_run.count('cancelled')} cancelled."
     # Determine the next steps based on the success of all tasks
     next_steps = (
         "You may now proceed with the next steps. Send a new JSON command or type 'end' to finish."
         if all_success else
         "Please review the errors and send corrections."
     )
-    # Replace placeholders in the template with actual values
-    return template.replace("{{TASK_DETAILS}}", task_details) \
-        .replace("{{SUMMARY}}", summary) \
-        .replace("{{NEXT_STEPS}}", next_steps)
+    return summary, next_steps
+
+def build_prompt(results, template_path="templates/prompt_template.txt"):
+    # Load the compiled template
+    template = get_template(template_path)
+    # Build the task details string from the results
+    task_details = "\n".join(format_task_result(r) for r in results)
+    summary, next_steps = build_summary(results)
+    # Fill the placeholders in one pass
+    return template.render({"TASK_DETAILS": task_details, "SUMMARY": summary, "NEXT_STEPS": next_steps})
+
+def prompt_overhead(results, template_path="templates/prompt_template.txt"):
+    """Bytes of the prompt for these results besides their descriptions"""
+    return len(build_prompt([dict(r, description="") for r in results], template_path).encode("utf-8"))
+
+def build_prompt_head(template_path="templates/prompt_template.txt"):
+    """Part of the prompt that precedes the task details, for streamed responses"""
+    head, _ = get_template(template_path).split("TASK_DETAILS")
+    return head.render({})
+
+def build_prompt_tail(results, template_path="templates/prompt_template.txt"):
+    """Part of the prompt that follows the task details, for streamed responses"""
+    _, tail = get_template(template_path).split("TASK_DETAILS")
+    summary, next_steps = build_summary(results)
+    return tail.render({"SUMMARY": summary, "NEXT_STEPS": next_steps})
 
 def build_error_prompt(error_message, task_details="", template_path="templates/error_template.txt"):
-    # Load the error template content
-    template = load_template(template_path)
-    # Replace placeholders in the template with actual error message and task details
-    return template.replace("{{ERROR_MESSAGE}}", error_message).replace("{{TASK_DETAILS}}", task_details)
+    # Load the compiled error template
+    template = get_template(template_path)
+    # Fill the placeholders with the actual error message and task details
+    return template.render({"ERROR_MESSAGE": error_message, "TASK_DETAILS": task_details})
@@ -0,0 +1,134 @@
+"""
+Byte budget of a text /tasks response.
+
+The task descriptions of a batch (file contents, command output, ...) share
+the budget left after the fixed parts of the prompt. Shares are weighted by
+task priority and fair: a task that needs less than its share keeps all of
+it and leaves the rest to the others. A description longer than its share
+keeps its head and tail around a marker that names the blob holding the full
+text, so a follow-up request can fetch what was left out.
+"""
+from config import RESPONSE_MIN_TASK_BYTES
+from services.blob_store import BLOB_STORE
+from services.instrumentation import RESPONSE_OMITTED_BYTES
+
+# Part of a truncated description kept from its end; command output ends with the errors
+TAIL_FRACTION = {"exec": 2 / 3}
+DEFAULT_TAIL_FRACTION = 1 / 3
+
+
+def task_priority(task):
+    """Weight of a task (or result) in the budget, from its "priority" field"""
+    priority = task.get("priority", 1)
+    if isinstance(priority, bool) or not isinstance(priority, (int, float)) or priority <= 0:
+        return 1
+    return priority
+
+
+def allocate(needs, weights, available):
+    """
+    Weighted max-min fair shares of available bytes.
+    :param needs: Bytes each task would use
+    :param weights: Priority of each task
+    :return: Bytes granted to each task, never more than it needs
+    """
+    shares = [0] * len(needs)
+    remaining = max(0, available)
+    total_weight = sum(weights)
+    pending = sorted(range(len(needs)), key=lambda i: needs[i] / weights[i])
+    for position, i in enumerate(pending):
+        fair = remaining * weights[i] / total_weight
+        if needs[i] > fair:
+            # This task and every one after it need more than their share
+            for j in pending[position:]:
+                shares[j] = int(remaining * weights[j] / total_weight)
+            break
+        shares[i] = needs[i]
+        remaining -= needs[i]
+        total_weight -= weights[i]
+    return shares
+
+
+def _cut(data, size, from_end):
+    """At most size bytes from one end of data, on a line boundary when one is close"""
+    if size <= 0:
+        return b""
+    if from_end:
+        part = data[-size:]
+        newline = part.find(b"\n")
+        if 0 <= newline < size // 4:
+            part = part[newline + 1:]
+    else:
+        part = data[:size]
+        newline = part.rfind(b"\n")
+        if newline >= size * 3 // 4:
+            part = part[:newline + 1]
+    return part.decode("utf-8", errors="ignore")
+
+
+def truncate(description, limit, task_type=None, session_id=None):
+    """
+    Head and tail of a description in at most about limit bytes, with a
+    marker naming the blob that keeps the full text. Returns shorter
+    descriptions as they are.
+    """
+    data = description.encode("utf-8")
+    limit = max(limit, RESPONSE_MIN_TASK_BYTES)
+    if len(data) <= limit:
+        return description
+    marker_size = 96  # The marker below, with room for the numbers and the id
+    kept = max(0, limit - marker_size)
+    tail_size = int(kept * TAIL_FRACTION.get(task_type, DEFAULT_TAIL_FRACTION))
+    head = _cut(data, kept - tail_size, from_end=False)
+    tail = _cut(data, tail_size, from_end=True)
+    omitted = len(data) - len(head.encode("utf-8")) - len(tail.encode("utf-8"))
+    if omitted <= 0:
+        return description  # Head and tail would repeat or cover the whole text
+    blob_id = BLOB_STORE.put(data, session_id)
+    RESPONSE_OMITTED_BYTES.inc(amount=omitted)
+    marker = f"[... {omitted} of {len(data)} bytes omitted, full text: GET /blobs/{blob_id} ...]"
+    separator = "" if not head or head.endswith("\n") else "\n"
+    return f"{head}{separator}{marker}\n{tail}"
+
+
+def fit_results(results, available, session_id=None):
+    """
+    Results whose descriptions together fit in available bytes.
+    Results that fit are returned as they are, the others as truncated copies.
+    """
+    needs = [len(str(r["description"]).encode("utf-8")) for r in results]
+    if sum(needs) <= available:
+        return results
+    shares = allocate(needs, [task_priority(r) for r in results], available)
+    return [
+        result if need <= share else
+        dict(result, description=truncate(str(result["description"]), share, result["type"], session_id))
+        for result, need, share in zip(results, needs, shares)
+    ]
+
+
+class StreamBudget:
+    """
+    The budget of a streamed response, shared out as results arrive: each
+    result gets its weighted part of what is left, so early results cannot
+    use up the budget of later ones.
+    """
+
+    def __init__(self, available, weights, session_id=None):
+        self.remaining = available
+        self.weight_left = sum(weights)
+        self.session_id = session_id
+
+    def fit(self, result, overhead=0):
+        """
+        Result with its description cut to its share.
+        :param overhead: Bytes the result's line takes besides the description
+        """
+        weight = task_priority(result)
+        self.remaining -= overhead
+        share = int(max(0, self.remaining) * weight / max(self.weight_left, weight))
+        self.weight_left = max(0, self.weight_left - weight)
+        description = str(result["description"])
+        fitted = truncate(description, share, result["type"], self.session_id)
+        self.remaining -= len(fitted.encode("utf-8"))
+        return result if fitted is description else dict(result, description=fitted)
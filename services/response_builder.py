@@ -0,0 +1,185 @@
+"""
+Structured /tasks responses, negotiated with the Accept header.
+
+JSON returns one document with a "response" array of task results; NDJSON
+returns one task result per line followed by a summary line, and is what
+/tasks/stream sends as tasks finish. Both are built directly from the
+result dicts of execute_task_tree, so callers no longer parse the prompt.
+"""
+import json
+from config import RESPONSE_INLINE_BYTES
+from services.blob_store import BLOB_STORE
+from services.prompt_builder import build_error_prompt, build_prompt, build_summary, prompt_overhead
+from services.response_budget import fit_results
+
+try:
+    import orjson  # Optional, much faster for large file contents and outputs
+except ImportError:
+    orjson = None
+
+TEXT = "text"
+JSON = "json"
+NDJSON = "ndjson"
+
+CONTENT_TYPES = {
+    TEXT: "text/html; charset=utf-8",
+    JSON: "application/json",
+    NDJSON: "application/x-ndjson",
+}
+
+MEDIA_TYPES = {
+    "application/json": JSON,
+    "application/x-ndjson": NDJSON,
+    "application/ndjson": NDJSON,
+    "application/jsonl": NDJSON,
+    "application/jsonlines": NDJSON,
+    "text/html": TEXT,
+    "text/plain": TEXT,
+    "text/*": TEXT,
+    "*/*": TEXT,
+}
+
+# Payload fields that are sent by reference when larger than the inline limit
+BLOB_FIELDS = ("content", "output", "error")
+
+
+def negotiate(accept):
+    """Response format for an Accept header value; the text prompt unless JSON is preferred"""
+    best, best_q = TEXT, 0.0
+    for item in (accept or "").split(","):
+        media, *params = item.split(";")
+        response_format = MEDIA_TYPES.get(media.strip().lower())
+        if response_format is None:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = response_format, q
+    return best
+
+
+def dumps(value):
+    """Serialize to compact UTF-8 JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(value, default=str)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+def _by_reference(value, session_id, inline_limit):
+    data = value.encode("utf-8")
+    if not inline_limit or len(data) <= inline_limit:
+        return value
+    blob_id = BLOB_STORE.put(data, session_id)
+    return {"ref": f"/blobs/{blob_id}", "bytes": len(data)}
+
+
+def _echo_parameters(parameters, inline_limit):
+    """Task parameters as sent, without large inline values such as write content or a sync manifest"""
+    echoed = {}
+    for key, value in parameters.items():
+        if inline_limit and isinstance(value, str) and len(value) > inline_limit:
+            value = {"omitted_bytes": len(value.encode("utf-8"))}
+        elif inline_limit and isinstance(value, (dict, list)) and value:
+            size = len(dumps(value))
+            if size > inline_limit:
+                value = {"omitted_bytes": size}
+        echoed[key] = value
+    return echoed
+
+
+def task_entry(result, session_id=None, inline_limit=RESPONSE_INLINE_BYTES):
+    """
+    Structured form of one task result.
+    :param result: Result dict produced by execute_task_tree
+    :param session_id: Session that owns blobs created for large payloads
+    :param inline_limit: Payloads above this many bytes are sent by reference, 0 inlines all
+    :return: dict
+    """
+    data = result.get("data") or {}
+    payload = {"message": data.get("message", str(result["description"]))}
+    for key, value in data.items():
+        if key in BLOB_FIELDS and isinstance(value, str):
+            value = _by_reference(value, session_id, inline_limit)
+        if key != "message":
+            payload[key] = value
+    entry = {
+        "id": result["id"],
+        "type": result["type"],
+        "status": "completed" if result["success"] else result.get("status", "failed"),
+        "parameters": _echo_parameters(result.get("parameters") or {}, inline_limit),
+        "result": payload,
+    }
+    for key in ("cache", "coalesced", "resumed", "timing"):
+        if key in result:
+            entry[key] = result[key]
+    return entry
+
+
+def summary_entry(session_id, results):
+    all_success = all(r["success"] for r in results)
+    summary, next_steps = build_summary(results)
+    return {
+        "session_id": session_id,
+        "status": "completed" if all_success else "failed",
+        "summary": summary,
+        "next_steps": next_steps,
+    }
+
+
+def build_json_response(session_id, results):
+    """Whole response as one JSON document"""
+    document = summary_entry(session_id, results)
+    document["response"] = [task_entry(r, session_id) for r in results]
+    return dumps(document)
+
+
+def build_ndjson_line(value):
+    return dumps(value) + b"\n"
+
+
+def build_ndjson_response(session_id, results):
+    """One line per task result, then the summary line"""
+    lines = [build_ndjson_line(task_entry(r, session_id)) for r in results]
+    lines.append(build_ndjson_line(summary_entry(session_id, results)))
+    return b"".join(lines)
+
+
+def build_json_error(message, details=""):
+    error = {"error": message}
+    if details:
+        error["details"] = details
+    return dumps(error)
+
+
+def build_response(response_format, session_id, results, budget=None):
+    """
+    Body of a successful /tasks response in the negotiated format.
+    :param budget: Bytes the text prompt may take; structured formats send large payloads by reference instead
+    """
+    if response_format == JSON:
+        return build_json_response(session_id, results)
+    if response_format == NDJSON:
+        return build_ndjson_response(session_id, results)
+    if budget:
+        results = fit_results(results, budget - prompt_overhead(results), session_id)
+    return build_prompt(results)
+
+
+def build_ended_response(response_format, session_id):
+    if response_format == TEXT:
+        return "Session ended"
+    body = {"session_id": session_id, "status": "ended"}
+    return dumps(body) if response_format == JSON else build_ndjson_line(body)
+
+
+def build_error_response(response_format, message, details=""):
+    if response_format == TEXT:
+        return build_error_prompt(message, details)
+    body = build_json_error(message, details)
+    return body if response_format == JSON else body + b"\n"
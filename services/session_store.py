@@ -0,0 +1,354 @@
+import hashlib
+import json
+import os
+import pickle
+import shlex
+import threading
+import time
+from collections import OrderedDict
+from config import (
+    BASE_DIR,
+    IDEMPOTENT_COMMANDS,
+    SESSION_TTL,
+    MAX_SESSIONS,
+    SESSION_CACHE_MAX_BYTES,
+    SESSION_RESULT_TTL,
+    SESSION_HASH_MAX_BYTES,
+)
+from logger import LOGGER
+from services.journal import ExecutionJournal
+from utils.path_policy import PATH_POLICY
+
+# Task types that never change the workspace
+READ_ONLY_TASKS = {"read", "list", "search", "archive"}
+# Read-only task types whose results are cached; an archive refers to a blob that expires on its own
+CACHED_TASKS = {"read", "list", "search"}
+
+
+def file_digest(path):
+    """sha256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Characters that let a shell chain, redirect or substitute past the whitelisted command
+SHELL_METACHARACTERS = set(";&|<>$`\n\r")
+# Options that make a whitelisted command write a file
+WRITING_OPTIONS = ("--output",)
+# Options under which `git branch` only lists branches; with anything else it may create one
+GIT_BRANCH_LIST_OPTIONS = {"-a", "--all", "-r", "--remotes", "-v", "-vv", "--verbose", "--show-current",
+                           "--no-color", "--no-column"}
+WHITELISTED_ARGV = [prefix.split() for prefix in IDEMPOTENT_COMMANDS]
+
+
+def _lists_branches(arguments):
+    # Positional arguments name a branch to create, unless --list turns them into patterns
+    patterns = "-l" in arguments or "--list" in arguments
+    return all(arg in GIT_BRANCH_LIST_OPTIONS or arg in ("-l", "--list") or (patterns and not arg.startswith("-"))
+               for arg in arguments)
+
+
+def is_idempotent_command(command):
+    """True if the command is whitelisted as free of side effects"""
+    if SHELL_METACHARACTERS.intersection(command):
+        return False
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return False
+    for prefix in WHITELISTED_ARGV:
+        if argv[:len(prefix)] != prefix:
+            continue
+        arguments = argv[len(prefix):]
+        if any(arg.startswith(WRITING_OPTIONS) for arg in arguments):
+            return False
+        if prefix == ["git", "branch"]:
+            return _lists_branches(arguments)
+        return True
+    return False
+
+
+def is_mutating(task):
+    """True if the task may change the workspace"""
+    if task.type in READ_ONLY_TASKS:
+        return False
+    if task.type == "exec":
+        return not is_idempotent_command(str(task.parameters.get("command", "")))
+    return True
+
+
+class WorkspaceGeneration:
+    """Count of workspace changes by tasks of any session, or seen from other workers"""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def bump(self):
+        with self.lock:
+            self.value += 1
+
+
+WORKSPACE_GENERATION = WorkspaceGeneration()
+
+
+class CacheEntry:
+    def __init__(self, description, size, expires=None, generation=None, fingerprint=None):
+        self.description = description
+        self.size = size
+        self.expires = expires  # Monotonic deadline, None for entries validated by fingerprint
+        self.generation = generation  # Workspace generation the entry is valid for, None if not tied to it
+        # (path, size, mtime_ns, digest) of the file or directory read, digest None for directories
+        self.fingerprint = fingerprint
+
+
+class Session:
+    """Per-session workspace state and result cache"""
+
+    def __init__(self, session_id):
+        self.id = session_id
+        self.cwd = BASE_DIR
+        self.created = time.monotonic()
+        self.last_access = self.created
+        self.results = OrderedDict()  # Cache key -> CacheEntry, least recently used first
+        self.file_hashes = {}  # Path -> (size, mtime_ns, digest) of files the session touched
+        self.journal = ExecutionJournal()  # Successful workspace changes, for resumed batches
+        self.shared_version = None  # Version of the shared state this worker last saw (multi-worker mode)
+        self.cache_bytes = 0
+        self.hash_bytes = 0  # Rough size of file_hashes
+        self.hits = 0
+        self.misses = 0
+
+    def dumps(self):
+        """State another worker needs to continue the session; cached results stay behind"""
+        return pickle.dumps({"cwd": self.cwd, "journal": self.journal}, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def cache_key(self, task):
+        """Return the cache key of a task, or None if its result must not be cached"""
+        parameters = {k: v for k, v in task.parameters.items() if k != "cache"}
+        if task.parameters.get("cache", True) is False:
+            return None
+        if task.type in CACHED_TASKS:
+            return (task.type, json.dumps(parameters, sort_keys=True, default=str))
+        if task.type == "exec" and "cwd" not in parameters and is_idempotent_command(str(parameters.get("command", ""))):
+            return (task.type, self.cwd, json.dumps(parameters, sort_keys=True, default=str))
+        return None
+
+    def _stat(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _fingerprint(self, path):
+        """Fingerprint a file, hashing it only if it is small"""
+        stat = self._stat(path)
+        if stat is None:
+            return None
+        size, mtime_ns = stat
+        known = self.file_hashes.get(path)
+        if known and known[:2] == stat:
+            digest = known[2]
+        elif size <= SESSION_HASH_MAX_BYTES:
+            try:
+                digest = file_digest(path)
+            except OSError:
+                return None
+            self._remember_hash(path, (size, mtime_ns, digest))
+        else:
+            digest = None
+        return path, size, mtime_ns, digest
+
+    def _is_valid(self, entry, now):
+        if entry.expires is not None and now > entry.expires:
+            return False
+        if entry.generation is not None and entry.generation != WORKSPACE_GENERATION.value:
+            return False
+        if entry.fingerprint is not None:
+            path, size, mtime_ns, digest = entry.fingerprint
+            stat = self._stat(path)
+            if stat is None:
+                return False
+            if stat == (size, mtime_ns):
+                return True
+            # Touched but maybe unchanged: compare content hashes when we have one
+            if digest is None or stat[0] != size:
+                return False
+            current = self._fingerprint(path)
+            if current is None or current[3] != digest:
+                return False
+            entry.fingerprint = current
+        return True
+
+    def lookup(self, key):
+        """Return the cached description for key, or None"""
+        entry = self.results.get(key)
+        if entry is None or not self._is_valid(entry, time.monotonic()):
+            if entry is not None:
+                self._discard(key)
+            self.misses += 1
+            return None
+        self.results.move_to_end(key)
+        self.hits += 1
+        return entry.description
+
+    def store(self, key, task, description, generation):
+        """
+        Cache the description of a successful task.
+        :param generation: WORKSPACE_GENERATION value from before the task ran
+        """
+        if key is None:
+            return 0
+        size = len(description) + 256  # Rough per-entry overhead
+        # Structured payloads of a TaskOutput hold their own copy of the content
+        size += sum(len(v) for v in getattr(description, "data", {}).values() if isinstance(v, str))
+        if task.type == "read":
+            path = PATH_POLICY.resolve(task.parameters.get("path"))
+            fingerprint = self._fingerprint(path) if path else None
+            if fingerprint is None:
+                return 0
+            entry = CacheEntry(description, size, fingerprint=fingerprint)
+        else:
+            fingerprint = None
+            if task.type == "list":
+                # Also catches entries added or removed outside the server
+                path = PATH_POLICY.resolve(task.parameters.get("path", "."))
+                stat = self._stat(path) if path else None
+                if stat is None:
+                    return 0
+                fingerprint = (path, stat[0], stat[1], None)
+            entry = CacheEntry(description, size, expires=time.monotonic() + SESSION_RESULT_TTL,
+                               generation=generation, fingerprint=fingerprint)
+        self._discard(key)
+        self.results[key] = entry
+        self.cache_bytes += size
+        return size
+
+    def record_mutation(self, task, succeeded=True):
+        """
+        Invalidate generation-bound results and remember the hash of the file a write left.
+        :param succeeded: False when the task failed, its path may hold anything now
+        """
+        WORKSPACE_GENERATION.bump()
+        if task.type == "write":
+            path = PATH_POLICY.resolve(task.parameters.get("path"))
+            if path is None:
+                return
+            if succeeded and task.file_hash is not None:
+                # Taken by the write itself, never from what is on disk afterwards
+                self._remember_hash(path, task.file_hash)
+            elif not succeeded or task.parameters.get("content") is None or task.parameters.get("mode", "w") != "w":
+                self._forget_hash(path)
+
+    def _remember_hash(self, path, fingerprint):
+        self._forget_hash(path)
+        self.file_hashes[path] = fingerprint
+        self.hash_bytes += len(path) + 160  # Key, hex digest and tuple overhead
+
+    def _forget_hash(self, path):
+        if self.file_hashes.pop(path, None) is not None:
+            self.hash_bytes -= len(path) + 160
+
+    def forget_hashes(self):
+        """Drop every remembered file hash, return the bytes freed"""
+        freed = self.hash_bytes
+        self.file_hashes.clear()
+        self.hash_bytes = 0
+        return freed
+
+    def _discard(self, key):
+        entry = self.results.pop(key, None)
+        if entry is not None:
+            self.cache_bytes -= entry.size
+        return entry
+
+    def evict_oldest(self):
+        """Drop the least recently used cached result, return the bytes freed"""
+        if not self.results:
+            return 0
+        key = next(iter(self.results))
+        return self._discard(key).size
+
+
+class SessionStore:
+    """
+    Sessions keyed by session_id, with TTL expiry, LRU eviction of whole
+    sessions beyond max_sessions, and a ceiling on cached result bytes.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS, max_bytes=SESSION_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self._sessions = OrderedDict()  # Least recently used first
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @property
+    def cache_bytes(self):
+        return sum(session.cache_bytes + session.hash_bytes for session in self._sessions.values())
+
+    def get(self, session_id):
+        """Return the session, creating it if needed"""
+        with self.lock:
+            now = time.monotonic()
+            self._expire(now)
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = Session(session_id)
+                self._sessions[session_id] = session
+                while len(self._sessions) > self.max_sessions:
+                    evicted_id, _ = self._sessions.popitem(last=False)
+                    LOGGER.info(f"Evicted session {evicted_id}")
+            else:
+                self._sessions.move_to_end(session_id)
+            session.last_access = now
+            return session
+
+    def restore(self, session_id, state, version):
+        """Replace a session with the state another worker left, or a fresh one if state is None"""
+        with self.lock:
+            self._sessions.pop(session_id, None)
+            session = self.get(session_id)
+            if state is not None:
+                saved = pickle.loads(state)
+                session.cwd = saved["cwd"]
+                session.journal = saved["journal"]
+            session.shared_version = version
+            return session
+
+    def drop(self, session_id):
+        with self.lock:
+            return self._sessions.pop(session_id, None)
+
+    def enforce_memory_limit(self):
+        """
+        Evict cached results, least recently used sessions first, until under max_bytes.
+        A session's file hashes go after its results.
+        """
+        with self.lock:
+            total = self.cache_bytes
+            for session in list(self._sessions.values()):
+                while total > self.max_bytes and session.results:
+                    total -= session.evict_oldest()
+                if total > self.max_bytes:
+                    total -= session.forget_hashes()
+                if total <= self.max_bytes:
+                    break
+
+    def _expire(self, now):
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.last_access <= self.ttl:
+                break
+            del self._sessions[session_id]
+            LOGGER.info(f"Session {session_id} expired")
+
+
+SESSION_STORE = SessionStore()
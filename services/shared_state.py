@@ -0,0 +1,297 @@
+"""
+State shared by the worker processes of a multi-worker deployment.
+
+Kept in a SQLite database in WAL mode, so no external service is needed and
+readers never block the single writer. It holds:
+
+- path locks: a task takes shared locks on the paths it reads and exclusive
+  locks on the paths it changes, all at once, so tasks of different workers
+  touching the same path (or a parent of it) never overlap;
+- session leases: a session runs batches on one worker at a time, and the
+  worker hands the session's journal over when it releases the lease;
+- a log of paths changed by tasks, so other workers drop what their file
+  cache and search index know about them;
+- payloads sent by reference, so GET /blobs works on any worker.
+
+Locks and leases of a worker that died are taken over by the next worker
+that runs into them.
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from config import CHANGE_LOG_SIZE, LOCK_POLL_INTERVAL, SHARED_STATE_PATH, WORKERS
+from logger import LOGGER
+from utils.io_executor import run_io
+
+MAX_POLL_INTERVAL = 0.05
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS path_locks (owner TEXT NOT NULL, pid INTEGER NOT NULL, path TEXT NOT NULL,
+                                       exclusive INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS path_locks_path ON path_locks (path);
+CREATE INDEX IF NOT EXISTS path_locks_owner ON path_locks (owner);
+CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, pid INTEGER NOT NULL, holders INTEGER NOT NULL,
+                                     version INTEGER NOT NULL, state BLOB);
+CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, pid INTEGER NOT NULL, path TEXT,
+                                    recursive INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS blobs (blob_id TEXT PRIMARY KEY, session_id TEXT, data BLOB NOT NULL,
+                                  size INTEGER NOT NULL, expires REAL NOT NULL);
+"""
+
+# Upper bound of every path key below a path, when the path is the root ("")
+PATH_KEY_MAX = "\U0010ffff"
+
+
+def _alive(pid):
+    """True if a process with this id exists (workers all run on this host)"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _ancestors(path):
+    """A path key and the keys of its parents, up to the root ""."""
+    keys = [""]
+    parts = path.split("/") if path else []
+    for i in range(1, len(parts) + 1):
+        keys.append("/".join(parts[:i]))
+    return keys
+
+
+class SharedState:
+    def __init__(self, path=SHARED_STATE_PATH):
+        self.path = path
+        self.pid = os.getpid()
+        self._local = threading.local()  # One connection per thread
+        self._owner_ids = iter(range(1, 1 << 62))
+        self.lock_waits = 0
+        self.lock_wait_seconds = 0.0
+        self.session_waits = 0
+        self.changes_applied = 0
+        self.caches_dropped = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+        self._seen_change = self._last_change()
+        self._changes_recorded = 0
+
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self.pid != os.getpid():
+            # Connections must not cross a fork
+            self.pid = os.getpid()
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")  # Durable enough for state that dies with the workers
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    # Path locks
+
+    def new_owner(self):
+        """Lock owner id for one task run, unique across workers"""
+        return f"{os.getpid()}:{next(self._owner_ids)}"
+
+    def _conflicts(self, db, owner, path, exclusive):
+        """Process ids holding locks that conflict with locking path"""
+        parents = _ancestors(path)
+        low, high = (path + "/", path + "0") if path else ("", PATH_KEY_MAX)
+        rows = db.execute(
+            f"SELECT DISTINCT pid FROM path_locks WHERE owner != ? AND (exclusive OR ?) AND "
+            f"(path IN ({','.join('?' * len(parents))}) OR (path >= ? AND path < ?))",
+            (owner, int(exclusive), *parents, low, high),
+        ).fetchall()
+        return [pid for pid, in rows]
+
+    def try_lock(self, owner, accesses):
+        """
+        Take every lock of a task, or none of them.
+        :param accesses: [(path key, exclusive)]
+        :return: True if the locks were taken
+        """
+        with self._transaction() as db:
+            for path, exclusive in accesses:
+                for pid in self._conflicts(db, owner, path, exclusive):
+                    if _alive(pid):
+                        return False
+                    db.execute("DELETE FROM path_locks WHERE pid = ?", (pid,))
+                    LOGGER.warning(f"Released path locks of dead worker {pid}")
+            db.executemany(
+                "INSERT INTO path_locks (owner, pid, path, exclusive) VALUES (?, ?, ?, ?)",
+                [(owner, self.pid, path, int(exclusive)) for path, exclusive in accesses],
+            )
+        return True
+
+    def unlock(self, owner):
+        with self._transaction() as db:
+            db.execute("DELETE FROM path_locks WHERE owner = ?", (owner,))
+
+    @asynccontextmanager
+    async def lock_paths(self, accesses):
+        """Hold the locks of a task while it runs, waiting for conflicting tasks of other workers"""
+        owner = self.new_owner()
+        start = None
+        delay = LOCK_POLL_INTERVAL
+        while not await run_io(self.try_lock, owner, accesses):
+            if start is None:
+                start = time.perf_counter()
+                self.lock_waits += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_POLL_INTERVAL)
+        if start is not None:
+            self.lock_wait_seconds += time.perf_counter() - start
+        try:
+            yield
+        finally:
+            # Shielded: the locks must go even when the task was cancelled
+            await asyncio.shield(run_io(self.unlock, owner))
+
+    # Session leases
+
+    def _try_lease(self, session_id, known_version):
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT pid, holders, version, CASE WHEN version IS ? THEN NULL ELSE state END "
+                "FROM sessions WHERE session_id = ?", (known_version, session_id)).fetchone()
+            if row is None:
+                db.execute("INSERT INTO sessions (session_id, pid, holders, version) VALUES (?, ?, 1, 0)",
+                           (session_id, self.pid))
+                return 0, None
+            pid, holders, version, state = row
+            if pid == self.pid:
+                # Batches of a session on one worker share its in-memory state
+                db.execute("UPDATE sessions SET holders = holders + 1 WHERE session_id = ?", (session_id,))
+            elif holders and _alive(pid):
+                return None
+            else:
+                db.execute("UPDATE sessions SET pid = ?, holders = 1 WHERE session_id = ?", (self.pid, session_id))
+            return version, state
+
+    async def acquire_session(self, session_id, known_version):
+        """
+        Wait until no other worker runs a batch of the session.
+        :param known_version: Version of the session state this worker holds, None if it holds none
+        :return: (version, state): state is None unless version differs from known_version
+        """
+        delay = LOCK_POLL_INTERVAL
+        waited = False
+        while True:
+            lease = await run_io(self._try_lease, session_id, known_version)
+            if lease is not None:
+                return lease
+            if not waited:
+                waited = True
+                self.session_waits += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_POLL_INTERVAL)
+
+    def release_session(self, session_id, state):
+        """Store the session state for the next worker and release the lease, return the new version"""
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE sessions SET holders = MAX(holders - 1, 0), version = version + 1, state = ? "
+                "WHERE session_id = ? AND pid = ?", (state, session_id, self.pid))
+            row = db.execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def drop_session(self, session_id):
+        with self._transaction() as db:
+            db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            db.execute("DELETE FROM blobs WHERE session_id = ?", (session_id,))
+
+    # Change log
+
+    def _last_change(self):
+        row = self._connection().execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        return row[0] if row else 0
+
+    def record_change(self, path, recursive=False):
+        """
+        Tell other workers a task changed a path.
+        :param path: Absolute path, None when anything may have changed (commands)
+        """
+        with self._transaction() as db:
+            seq = db.execute("INSERT INTO changes (pid, path, recursive) VALUES (?, ?, ?)",
+                             (self.pid, path, int(recursive))).lastrowid
+            self._changes_recorded += 1
+            if self._changes_recorded % 1000 == 0:
+                db.execute("DELETE FROM changes WHERE seq <= ?", (seq - CHANGE_LOG_SIZE,))
+
+    def pending_changes(self):
+        """
+        Paths other workers changed since the last call, as [(path, recursive)].
+        Returns None when this worker fell behind the log and must drop all its caches.
+        """
+        db = self._connection()
+        rows = db.execute("SELECT seq, pid, path, recursive FROM changes WHERE seq > ? ORDER BY seq",
+                          (self._seen_change,)).fetchall()
+        if not rows:
+            return []
+        complete = rows[0][0] == self._seen_change + 1
+        self._seen_change = rows[-1][0]
+        changes = [(path, bool(recursive)) for _, pid, path, recursive in rows if pid != self.pid]
+        if not complete or any(path is None for path, _ in changes):
+            self.caches_dropped += 1
+            return None
+        self.changes_applied += len(changes)
+        return changes
+
+    # Blobs
+
+    def put_blob(self, blob_id, data, session_id, ttl, max_bytes):
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("DELETE FROM blobs WHERE expires <= ?", (now,))
+            db.execute("INSERT INTO blobs (blob_id, session_id, data, size, expires) VALUES (?, ?, ?, ?, ?)",
+                       (blob_id, session_id, data, len(data), now + ttl))
+            total = db.execute("SELECT SUM(size) FROM blobs").fetchone()[0]
+            if total > max_bytes:
+                # Oldest first, keeping the new blob
+                for evicted_id, size in db.execute("SELECT blob_id, size FROM blobs ORDER BY expires").fetchall():
+                    if total <= max_bytes or evicted_id == blob_id:
+                        break
+                    db.execute("DELETE FROM blobs WHERE blob_id = ?", (evicted_id,))
+                    total -= size
+
+    def get_blob(self, blob_id):
+        row = self._connection().execute("SELECT data FROM blobs WHERE blob_id = ? AND expires > ?",
+                                         (blob_id, time.time())).fetchone()
+        return row[0] if row else None
+
+    def blob_bytes(self):
+        return self._connection().execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def stats(self):
+        db = self._connection()
+        return {
+            "path_locks": db.execute("SELECT COUNT(*) FROM path_locks").fetchone()[0],
+            "sessions_leased": db.execute("SELECT COUNT(*) FROM sessions WHERE holders > 0").fetchone()[0],
+            "lock_waits": self.lock_waits,
+            "lock_wait_seconds": round(self.lock_wait_seconds, 3),
+            "session_waits": self.session_waits,
+            "changes_applied": self.changes_applied,
+            "caches_dropped": self.caches_dropped,
+        }
+
+
+# Only used when several workers serve requests; a single worker keeps everything in memory
+SHARED_STATE = SharedState() if WORKERS > 1 else None
@@ -1,129 +1,341 @@
+import hashlib
 import os
+import re
 import shlex
+import shutil
 import subprocess
-from utils.file_utils import ensure_directory_exists, is_safe_path
-from config import BASE_DIR, MAX_FILE_SIZE, ALLOWED_COMMANDS  # Import constants
+from utils.bundles import (
+    ARCHIVE_FORMATS,
+    BundleError,
+    BundleLimits,
+    apply_entries,
+    decode_base64,
+    delete_unlisted,
+    iter_archive,
+    iter_manifest,
+    pack_directory,
+)
+from utils.fs_cache import FS_CACHE
+from utils.file_utils import (
+    content_matches,
+    ensure_directory_exists,
+    read_byte_range,
+    read_line_range,
+    read_tail,
+    read_tail_lines,
+    write_atomic,
+)
+from utils.io_executor import run_io
+from utils.listing import DirectoryLister, path_matcher
+from utils.patching import PatchError, apply_line_edits, apply_unified_diff
+from utils.path_policy import PATH_POLICY
+from utils.search_index import SEARCH_INDEX, required_literals
+from services.blob_store import BLOB_STORE
+from services.exec_engine import run_command
+from services.exec_pool import EXEC_POOL
+from services.shared_state import SHARED_STATE
+from services.instrumentation import BYTES_READ, BYTES_WRITTEN, EXEC_EXIT_CODES
+from config import (  # Import constants
+    BASE_DIR,
+    MAX_FILE_SIZE,
+    MAX_READ_BYTES,
+    LIST_MAX_ENTRIES,
+    LIST_DEFAULT_IGNORES,
+    ALLOWED_COMMANDS,
+    SEARCH_MAX_RESULTS,
+    SEARCH_SNIPPET_CHARS,
+    BUNDLE_MAX_ENTRIES,
+    BUNDLE_MAX_BYTES,
+)
 from logger import LOGGER
 
 class TaskConfig:
     BASE_DIR = BASE_DIR
     MAX_FILE_SIZE = MAX_FILE_SIZE
+    MAX_READ_BYTES = MAX_READ_BYTES
+    LIST_MAX_ENTRIES = LIST_MAX_ENTRIES
+    LIST_DEFAULT_IGNORES = LIST_DEFAULT_IGNORES
     ALLOWED_COMMANDS = ALLOWED_COMMANDS
+    PATH_POLICY = PATH_POLICY
+    FS_CACHE = FS_CACHE
+    SEARCH_INDEX = SEARCH_INDEX
+    SHARED_STATE = SHARED_STATE  # None unless several workers serve requests
+    SEARCH_MAX_RESULTS = SEARCH_MAX_RESULTS
+    SEARCH_SNIPPET_CHARS = SEARCH_SNIPPET_CHARS
+    BUNDLE_MAX_ENTRIES = BUNDLE_MAX_ENTRIES
+    BUNDLE_MAX_BYTES = BUNDLE_MAX_BYTES
 
-def execute_command(command, timeout=60, cwd=None):
+class TaskOutput(str):
     """
-    Execute shell command and get real-time output
-    
-    Args:
-        command: Command to execute
-        timeout: Timeout in seconds
-        cwd: Working directory
-    
-    Returns:
-        str: Command execution output
+    Description of a successful task that also carries its raw payload
+    (file content, command output) for structured responses. Behaves as the
+    plain description string everywhere else, including the result cache.
     """
-    try:
-        # Get system PATH
-        env = os.environ.copy()
-
-        process = subprocess.Popen(
-            command,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            cwd=cwd,
-            env=env
-        )
 
-        stdout_lines = []
-        while True:
-            output = process.stdout.readline()
-            if output == '' and process.poll() is not None:
-                break
-            if output:
-                print(output.strip())
-                stdout_lines.append(output)
-                LOGGER.info(f"Command output: {output.strip()}")
-
-        process.wait(timeout=timeout)
-        stdout_result = "".join(stdout_lines)
-        
-        if process.returncode != 0:
-            stderr = process.stderr.read()
-            raise subprocess.CalledProcessError(process.returncode, command, stdout_result, stderr)
-            
-        return stdout_result
+    def __new__(cls, description, **data):
+        output = super().__new__(cls, description)
+        output.data = {key: value for key, value in data.items() if value is not None}
+        return output
 
-    except subprocess.TimeoutExpired:
-        process.kill()
-        raise
+class CommandFailed(RuntimeError):
+    """A command exited with a non-zero code"""
+
+    def __init__(self, description, message, output, error, exit_code):
+        super().__init__(description)
+        self.data = {"message": message, "output": output, "error": error, "exit_code": exit_code}
+
+async def _changed(path, recursive=False):
+    """Drop what the file cache and the search index (of every worker) know about a path a task changed"""
+    TaskConfig.FS_CACHE.invalidate(path, recursive=recursive)
+    TaskConfig.SEARCH_INDEX.invalidate(path, recursive=recursive)
+    if TaskConfig.SHARED_STATE is not None:
+        await run_io(TaskConfig.SHARED_STATE.record_change, path, recursive)
+
+# Blocking helpers, run on the shared I/O executor
+
+def _write_file(path, mode, data, atomic=True, skip_unchanged=True, known=None):
+    """
+    Write bytes to path.
+    :return: (written, file_hash): written is False if the write was skipped because nothing
+        changed; file_hash is (size, mtime_ns, sha256) of the file a "w" write left, else None
+    """
+    if mode == "a":
+        if data:
+            with open(path, "ab") as f:
+                f.write(data)
+        return bool(data), None
+    if skip_unchanged and content_matches(path, data, known):
+        return False, None
+    if atomic:
+        stat = write_atomic(path, data)
+    else:
+        with open(path, "wb") as f:
+            f.write(data)
+            f.flush()
+            stat = os.fstat(f.fileno())
+    # Stat of the file as written, so the hash cannot be paired with someone else's change
+    return True, (stat.st_size, stat.st_mtime_ns, hashlib.sha256(data).hexdigest())
+
+def _patch_file(path, patch, edits, atomic=True):
+    """Apply a unified diff or line edits to a UTF-8 file, return (written, changes applied, new size)"""
+    if os.path.getsize(path) > TaskConfig.MAX_FILE_SIZE:
+        raise PatchError("File too large to patch")
+    with open(path, "rb") as f:
+        original = f.read()
+    text = original.decode("utf-8")
+    if patch is not None:
+        text, changes = apply_unified_diff(text, patch)
+    else:
+        text, changes = apply_line_edits(text, edits)
+    data = text.encode("utf-8")
+    if len(data) > TaskConfig.MAX_FILE_SIZE:
+        raise PatchError("Patched content too large")
+    if data == original:
+        return False, changes, len(data)
+    _write_file(path, "w", data, atomic, skip_unchanged=False)
+    return True, changes, len(data)
 
+def _read_window(path, mode, offset, length, start_line, end_line, lines, max_bytes):
+    # Small files are served from the cache, larger ones are read in chunks
+    source = TaskConfig.FS_CACHE.read(path)
+    if source is None:
+        source = path
+    if mode == "tail":
+        window = read_tail_lines(source, lines, max_bytes) if lines else read_tail(source, max_bytes)
+    elif mode == "head" and lines:
+        window = read_line_range(source, 1, lines, max_bytes)
+    elif start_line is not None or end_line is not None:
+        window = read_line_range(source, start_line or 1, end_line, max_bytes)
+    else:
+        window = read_byte_range(source, offset or 0, length, max_bytes)
+    return window, window.text()
+
+def _list_directory(path, max_entries, cursor, **options):
+    lister = DirectoryLister(path, scan=TaskConfig.FS_CACHE.scandir, **options)
+    entries, next_cursor = lister.page(max_entries, cursor)
+    return [entry.format() for entry in entries], [entry.as_dict() for entry in entries], next_cursor
+
+def _is_real_directory(path):
+    return os.path.isdir(path) and not os.path.islink(path)
+
+def _make_directory(path):
+    os.makedirs(path)
+    return os.path.isdir(path)
+
+def _bundle_limits():
+    return BundleLimits(TaskConfig.BUNDLE_MAX_ENTRIES, TaskConfig.BUNDLE_MAX_BYTES, TaskConfig.MAX_FILE_SIZE)
+
+def _resolver(root):
+    """Authorize each entry of a bundle below root on its own, as a write task would"""
+    return lambda rel_path: TaskConfig.PATH_POLICY.resolve(os.path.join(root, rel_path))
+
+def _lister_options(task):
+    ignore_defaults = task.parameters.get("ignore_defaults", True)
+    return {
+        "ignore_names": TaskConfig.LIST_DEFAULT_IGNORES if ignore_defaults else (),
+        "use_gitignore": bool(ignore_defaults),
+        "scan": TaskConfig.FS_CACHE.scandir,
+    }
+
+def _extract_archive(root, archive, archive_format, skip_unchanged, atomic, known):
+    entries = iter_archive(decode_base64(archive, "'archive'"), archive_format, _bundle_limits())
+    return apply_entries(entries, _resolver(root), skip_unchanged, atomic, known)
+
+def _sync_manifest(root, files, delete, skip_unchanged, atomic, known, lister_options):
+    listed = set()
+
+    def entries():
+        for entry in iter_manifest(files, _bundle_limits()):
+            listed.add(entry.path)
+            yield entry
+
+    report = apply_entries(entries(), _resolver(root), skip_unchanged, atomic, known)
+    if delete:
+        delete_unlisted(root, listed, report, **lister_options)
+    return report
+
+def _pack(root, archive_format, lister_options):
+    limits = _bundle_limits()
+    data, files = pack_directory(root, archive_format, limits, **lister_options)
+    return data, files, limits.bytes, hashlib.sha256(data).hexdigest()
 
 async def handle_write(task):
-    """Handle file write task"""
+    """
+    Handle file write task.
+    Takes full 'content', a unified diff ('patch') or line-range 'edits'.
+    Writes with mode "w" go through a temp file and an atomic rename, and are
+    skipped when the file already holds the same content.
+    """
     try:
         path = task.parameters.get("path")
         content = task.parameters.get("content")
+        patch = task.parameters.get("patch")
+        edits = task.parameters.get("edits")
         mode = task.parameters.get("mode", "w")
+        atomic = task.parameters.get("atomic", True) is not False
+        skip_unchanged = task.parameters.get("skip_unchanged", True) is not False
         
         LOGGER.info(f"Handling write task for path: {path}")
         
-        if not is_safe_path(TaskConfig.BASE_DIR, path):
+        if not path:
+            raise ValueError("Write task requires 'path'")
+        if sum(value is not None for value in (content, patch, edits)) != 1:
+            raise ValueError("Write task requires exactly one of 'content', 'patch' or 'edits'")
+        if mode not in ("w", "a"):
+            raise ValueError("'mode' must be \"w\" or \"a\"")
+        if content is not None and not isinstance(content, str):
+            raise ValueError("'content' must be a string")
+        if patch is not None and not isinstance(patch, str):
+            raise ValueError("'patch' must be a unified diff string")
+        if edits is not None and not isinstance(edits, list):
+            raise ValueError("'edits' must be a list")
+        
+        target = TaskConfig.PATH_POLICY.resolve(path)
+        if target is None:
             LOGGER.warning(f"Invalid file path attempt: {path}")
             raise ValueError("Invalid file path")
         
-        if len(content.encode()) > TaskConfig.MAX_FILE_SIZE:
-            raise ValueError("Content too large")
+        # Hash of the file this session read or wrote, saves re-reading it to compare
+        known = task.session.file_hashes.get(target) if task.session is not None else None
         
-        if not path:
-            raise ValueError("Write task requires 'path'")
         if content is None:
-            raise ValueError("Write task requires 'content'")
+            if not await run_io(os.path.isfile, target):
+                raise FileNotFoundError(f"File '{path}' not found.")
+            try:
+                written, changes, size = await run_io(_patch_file, target, patch, edits, atomic)
+            except PatchError as e:
+                raise ValueError(f"Failed to patch file '{path}': {str(e)}")
+            except (OSError, UnicodeDecodeError) as e:
+                raise IOError(f"Failed to patch file '{path}': {str(e)}")
+            finally:
+                await _changed(target)
+            unit = "hunk" if patch is not None else "edit"
+            if written:
+                BYTES_WRITTEN.inc(amount=size)
+            if not written:
+                return f"File '{path}' unchanged after applying {changes} {unit}(s), write skipped"
+            return f"File '{path}' patched successfully ({changes} {unit}(s) applied)"
         
-        await ensure_directory_exists(TaskConfig.BASE_DIR, path)
+        # Encode once: the same bytes are measured, compared and written
+        data = content.encode("utf-8")
+        if len(data) > TaskConfig.MAX_FILE_SIZE:
+            raise ValueError("Content too large")
+        
+        await ensure_directory_exists(target)
         
         try:
-            with open(path, mode, encoding="utf-8") as f:
-                f.write(content)
+            written, task.file_hash = await run_io(_write_file, target, mode, data, atomic, skip_unchanged, known)
         except Exception as e:
             raise IOError(f"Failed to write to file '{path}': {str(e)}")
-            
+        finally:
+            await _changed(target)
+        
+        if not written:
+            return f"File '{path}' unchanged, write skipped"
+        BYTES_WRITTEN.inc(amount=len(data))
         return f"File '{path}' written successfully"
     
     except Exception as e:
         LOGGER.error(f"Write operation failed: {str(e)}")
         raise
 
+def _int_parameter(task, name, default=None, minimum=0):
+    """Read an optional integer task parameter"""
+    value = task.parameters.get(name, default)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value < minimum:
+        raise ValueError(f"'{name}' must be an integer >= {minimum}")
+    return value
+
 async def handle_read(task):
     """
     Handle file read task.
+    Supports byte ranges (offset/length), line ranges (start_line/end_line),
+    head/tail modes (mode, lines) and a max_bytes budget. The file is read in
+    chunks, so memory use is bounded by the budget, not by the file size.
     :param task: dict containing task details
     :return: str success description
     """
     # Get task parameters
     path = task.parameters.get("path")
+    mode = task.parameters.get("mode")
 
     # Check required parameters
     if not path:
         raise ValueError("Read task requires 'path'.")
+    if mode not in (None, "head", "tail"):
+        raise ValueError("Read mode must be 'head' or 'tail'.")
+
+    offset = _int_parameter(task, "offset")
+    length = _int_parameter(task, "length")
+    start_line = _int_parameter(task, "start_line", minimum=1)
+    end_line = _int_parameter(task, "end_line", minimum=1)
+    lines = _int_parameter(task, "lines", minimum=1)
+    max_bytes = min(_int_parameter(task, "max_bytes", TaskConfig.MAX_READ_BYTES, minimum=1), TaskConfig.MAX_FILE_SIZE)
 
-    if not is_safe_path(TaskConfig.BASE_DIR, path):
+    target = TaskConfig.PATH_POLICY.resolve(path)
+    if target is None:
         LOGGER.warning(f"Unauthorized read attempt: {path}")
         raise ValueError("Invalid file path")
 
-    # Check if file exists
-    if not os.path.exists(path):
-        raise FileNotFoundError(f"File '{path}' not found.")
-
     # Read file
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            content = f.read()
+        window, content = await run_io(
+            _read_window, target, mode, offset, length, start_line, end_line, lines, max_bytes
+        )
+    except FileNotFoundError:
+        raise FileNotFoundError(f"File '{path}' not found.")
     except Exception as e:
         raise IOError(f"Failed to read from file '{path}': {str(e)}")
 
-    return f"File '{path}' read successfully. Content: {content}"
+    BYTES_READ.inc(amount=len(window.data))
+    if window.complete:
+        message = f"File '{path}' read successfully"
+    else:
+        # Make partial reads explicit, so the caller knows how to ask for the next window
+        message = f"File '{path}' read successfully ({window.describe()})"
+    return TaskOutput(f"{message}. Content: {content}", message=message, content=content)
 
 def is_command_allowed(command):
     """Verify if command is in whitelist"""
@@ -134,36 +346,53 @@ async def handle_exec(task):
     """Handle command execution task"""
     try:
         command = task.parameters.get("command")
-        timeout = min(task.parameters.get("timeout", 60), 120)  # Maximum 5 minutes
+        timeout = task.parameters.get("timeout", 60)
         
         LOGGER.info(f"Handling exec task with command: {command}")
         
+        # The engine waits and kills the process group on this value, so it must be a real duration
+        if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or not timeout > 0:
+            raise ValueError("'timeout' must be a positive number of seconds")
+        timeout = min(timeout, 120)  # Maximum 2 minutes
+        
         if not command or not is_command_allowed(command):
             LOGGER.warning(f"Unauthorized command attempt: {command}")
             raise ValueError("Command not allowed")
         
-        # Print current working directory and command to execute
-        current_directory = os.getcwd()
-        LOGGER.info(f"Current working directory: {current_directory}")
+        # Commands run in the session's working directory, which a 'cwd' parameter moves
+        session = getattr(task, "session", None)
+        cwd = session.cwd if session else TaskConfig.BASE_DIR
+        if task.parameters.get("cwd"):
+            cwd = TaskConfig.PATH_POLICY.resolve(task.parameters["cwd"])
+            if cwd is None:
+                LOGGER.warning(f"Invalid working directory attempt: {task.parameters['cwd']}")
+                raise ValueError("Invalid working directory")
+            if not await run_io(os.path.isdir, cwd):
+                raise FileNotFoundError(f"Directory '{task.parameters['cwd']}' not found")
+            if session:
+                session.cwd = cwd
+
+        # Print working directory and command to execute
+        LOGGER.info(f"Working directory: {cwd}")
         LOGGER.info(f"Executing command: {command}")
         
-        safe_command = shlex.split(command)
-        LOGGER.warning(f"safe_command: {safe_command}")
-        # result = subprocess.run(
-        #     # safe_command,
-        #     command,
-        #     text=True,
-        #     shell=True,
-        #     stdout=subprocess.PIPE,
-        #     stderr=subprocess.PIPE,
-        #     # check=False,
-        #     # timeout=timeout,
-        #     cwd=TaskConfig.BASE_DIR,
-        #     # env={},  # Clear environment variables
-        # )
-        stdout = execute_command(command, timeout, TaskConfig.BASE_DIR)
-        return f"Command '{command}' executed successfully. Output: {stdout}"
+        # Wait for a command slot: bounded globally and per session, served round-robin
+        async with EXEC_POOL.slot(session.id if session else None):
+            result = await run_command(command, timeout, cwd)
+        EXEC_EXIT_CODES.inc(result.returncode)
+        if result.returncode != 0:
+            message = f"Command '{command}' failed with exit code {result.returncode}"
+            raise CommandFailed(
+                f"{message}. Output: {result.stdout} Error: {result.stderr}",
+                message, result.stdout, result.stderr, result.returncode,
+            )
+        message = f"Command '{command}' executed successfully"
+        return TaskOutput(
+            f"{message}. Output: {result.stdout}",
+            message=message, output=result.stdout, error=result.stderr or None, exit_code=result.returncode,
+        )
     except subprocess.TimeoutExpired:
+        EXEC_EXIT_CODES.inc("timeout")
         LOGGER.error(f"Command timed out after {timeout} seconds")
         raise RuntimeError("Command execution timed out")
     except Exception as e:
@@ -181,20 +410,21 @@ async def handle_delete(task):
         if not path:
             raise ValueError("Delete task requires 'path'")
             
-        # Safety check
-        if not is_safe_path(TaskConfig.BASE_DIR, path):
+        # Safety check; a symlink is deleted itself, never its target
+        target = TaskConfig.PATH_POLICY.resolve(path, follow_symlinks=False)
+        if target is None:
             LOGGER.warning(f"Invalid file path attempt: {path}")
             raise ValueError("Invalid file path")
             
-        # Check if file exists
-        if not os.path.exists(path):
-            raise FileNotFoundError(f"File '{path}' not found")
-            
         # Delete file
         try:
-            os.remove(path)
+            await run_io(os.remove, target)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"File '{path}' not found")
         except Exception as e:
             raise IOError(f"Failed to delete file '{path}': {str(e)}")
+        finally:
+            await _changed(target)
             
         return f"File '{path}' deleted successfully"
         
@@ -214,23 +444,31 @@ async def handle_move(task):
         if not source or not destination:
             raise ValueError("Move task requires 'source' and 'destination'")
             
-        # Safety check
-        if not is_safe_path(TaskConfig.BASE_DIR, source) or not is_safe_path(TaskConfig.BASE_DIR, destination):
+        # Safety check; a rename moves or replaces a symlink itself, never its target
+        source_path = TaskConfig.PATH_POLICY.resolve(source, follow_symlinks=False)
+        destination_path = TaskConfig.PATH_POLICY.resolve(destination, follow_symlinks=False)
+        if source_path is None or destination_path is None:
             LOGGER.warning(f"Invalid file path attempt: {source} or {destination}")
             raise ValueError("Invalid file path")
             
         # Check if source file exists
-        if not os.path.exists(source):
+        if not await run_io(os.path.lexists, source_path):
             raise FileNotFoundError(f"Source file '{source}' not found")
+        moves_directory = await run_io(_is_real_directory, source_path)
             
         # Ensure destination directory exists
-        ensure_directory_exists(TaskConfig.BASE_DIR, destination)
+        await ensure_directory_exists(destination_path)
         
         # Move file
         try:
-            os.rename(source, destination)
+            await run_io(os.rename, source_path, destination_path)
+            # A moved directory invalidates the cached resolution of everything below it
+            TaskConfig.PATH_POLICY.invalidate(source_path)
         except Exception as e:
             raise IOError(f"Failed to move file from '{source}' to '{destination}': {str(e)}")
+        finally:
+            await _changed(source_path, recursive=moves_directory)
+            await _changed(destination_path, recursive=moves_directory)
             
         return f"File moved from '{source}' to '{destination}' successfully"
         
@@ -247,16 +485,22 @@ async def handle_copy(task):
         if not src_path or not dst_path:
             raise ValueError("Copy task requires both 'source' and 'destination' paths")
             
-        if not is_safe_path(TaskConfig.BASE_DIR, src_path) or not is_safe_path(TaskConfig.BASE_DIR, dst_path):
+        source = TaskConfig.PATH_POLICY.resolve(src_path)
+        destination = TaskConfig.PATH_POLICY.resolve(dst_path)
+        if source is None or destination is None:
             raise ValueError("Invalid file path")
             
-        if not os.path.exists(src_path):
+        if not await run_io(os.path.exists, source):
             raise FileNotFoundError(f"Source file '{src_path}' not found")
             
-        ensure_directory_exists(TaskConfig.BASE_DIR, os.path.dirname(dst_path))
+        await ensure_directory_exists(destination)
         
-        import shutil
-        shutil.copy2(src_path, dst_path)
+        # A destination directory receives the file under its own name
+        copied = destination
+        try:
+            copied = await run_io(shutil.copy2, source, destination)
+        finally:
+            await _changed(copied)
         
         return f"File copied from '{src_path}' to '{dst_path}' successfully"
         
@@ -265,52 +509,122 @@ async def handle_copy(task):
         raise
 
 async def handle_list(task):
-    """Handle directory listing task"""
+    """
+    Handle directory listing task.
+    Entries are streamed with os.scandir in depth-first order and returned one
+    page (max_entries) at a time; pass the returned cursor to get the next page.
+    Supports max_depth, include/exclude globs, default ignores (.git,
+    node_modules, .gitignore patterns) and optional sizes/mtimes (details).
+    """
     try:
         path = task.parameters.get("path", ".")
         recursive = task.parameters.get("recursive", False)
+        max_depth = _int_parameter(task, "max_depth", minimum=1)
+        max_entries = _int_parameter(task, "max_entries", TaskConfig.LIST_MAX_ENTRIES, minimum=1)
+        cursor = task.parameters.get("cursor")
+        ignore_defaults = task.parameters.get("ignore_defaults", True)
+        
+        if cursor is not None and not isinstance(cursor, str):
+            raise ValueError("'cursor' must be a string")
+        if not recursive:
+            max_depth = 1
         
-        if not is_safe_path(TaskConfig.BASE_DIR, path):
+        target = TaskConfig.PATH_POLICY.resolve(path)
+        if target is None:
             raise ValueError("Invalid directory path")
             
-        if not os.path.exists(path):
+        if not await run_io(TaskConfig.FS_CACHE.exists, target):
             raise FileNotFoundError(f"Directory '{path}' not found")
-            
-        result = []
-        if recursive:
-            for root, dirs, filenames in os.walk(path):
-                rel_path = os.path.relpath(root, path)
-                if rel_path == ".":
-                    prefix = ""
-                else:
-                    prefix = rel_path + "/"
-                    
-                # Add directories
-                for d in dirs:
-                    result.append(f"📁 {prefix}{d}/")
-                    
-                # Add files
-                for f in filenames:
-                    result.append(f"📄 {prefix}{f}")
-        else:
-            entries = os.listdir(path)
-            for entry in sorted(entries):
-                full_path = os.path.join(path, entry)
-                if os.path.isdir(full_path):
-                    result.append(f"📁 {entry}/")
-                else:
-                    result.append(f"📄 {entry}")
+        
+        result, entries, next_cursor = await run_io(
+            _list_directory,
+            target,
+            max_entries,
+            cursor,
+            max_depth=max_depth,
+            include=task.parameters.get("include"),
+            exclude=task.parameters.get("exclude"),
+            ignore_names=TaskConfig.LIST_DEFAULT_IGNORES if ignore_defaults else (),
+            use_gitignore=bool(ignore_defaults),
+            details=bool(task.parameters.get("details", False)),
+        )
                     
         if not result:
+            if cursor:
+                return f"No more entries in directory '{path}'"
             return f"Directory '{path}' is empty"
             
-        files_str = "\n".join(sorted(result))
-        return f"Contents of directory '{path}':\n{files_str}"
+        files_str = "\n".join(result)
+        listing = f"Contents of directory '{path}':\n{files_str}"
+        if next_cursor is not None:
+            listing += (f"\n... listing truncated after {len(result)} entries; "
+                        f"pass \"cursor\": \"{next_cursor}\" to continue")
+        return TaskOutput(listing, message=f"Contents of directory '{path}'", entries=entries, cursor=next_cursor)
             
     except Exception as e:
         LOGGER.error(f"List operation failed: {str(e)}")
         raise
 
+async def handle_search(task):
+    """
+    Handle code search task.
+    Finds lines matching a literal 'query' (or a regular expression with
+    "regex": true) in the text files under 'path'. Candidate files come from
+    the trigram index, so only files that can match are read. Returns at most
+    max_results file:line snippets, with optional context lines.
+    """
+    try:
+        query = task.parameters.get("query")
+        path = task.parameters.get("path", ".")
+        regex = task.parameters.get("regex", False) is True
+        case_sensitive = task.parameters.get("case_sensitive", True) is not False
+        max_results = _int_parameter(task, "max_results", TaskConfig.SEARCH_MAX_RESULTS, minimum=1)
+        context = _int_parameter(task, "context", 0)
+
+        LOGGER.info(f"Handling search task for {query!r} in {path}")
+
+        if not isinstance(query, str) or not query:
+            raise ValueError("Search task requires a non-empty 'query'")
+        try:
+            pattern = re.compile(query if regex else re.escape(query), 0 if case_sensitive else re.IGNORECASE)
+        except re.error as e:
+            raise ValueError(f"Invalid regular expression: {str(e)}")
+        include = path_matcher(task.parameters.get("include"), task.parameters.get("exclude"))
+
+        target = TaskConfig.PATH_POLICY.resolve(path)
+        if target is None:
+            raise ValueError("Invalid search path")
+        if not await run_io(TaskConfig.FS_CACHE.exists, target):
+            raise FileNotFoundError(f"Path '{path}' not found")
+        prefix = os.path.relpath(target, TaskConfig.SEARCH_INDEX.root).replace(os.sep, "/")
+
+        matches, scanned, truncated = await run_io(
+            TaskConfig.SEARCH_INDEX.search,
+            pattern,
+            required_literals(query, regex, case_sensitive),
+            "" if prefix == "." else prefix,
+            include,
+            max_results,
+            context,
+            TaskConfig.SEARCH_SNIPPET_CHARS,
+        )
+
+        if not matches:
+            return TaskOutput(f"No matches for {query!r} in '{path}'",
+                              message=f"No matches for {query!r} in '{path}'", matches=[])
+        message = f"Found {len(matches)} match(es) for {query!r} in '{path}' ({scanned} file(s) searched)"
+        separator = "\n--\n" if context else "\n"
+        listing = f"{message}:\n" + separator.join(match.format() for match in matches)
+        if truncated:
+            listing += (f"\n... results truncated after {len(matches)} matches; "
+                        f"narrow the query or 'path', or raise \"max_results\"")
+        return TaskOutput(listing, message=message, matches=[match.as_dict() for match in matches],
+                          truncated=truncated or None)
+
+    except Exception as e:
+        LOGGER.error(f"Search operation failed: {str(e)}")
+        raise
+
 async def handle_mkdir(task):
     """Handle directory creation task"""
     try:
@@ -323,20 +637,21 @@ async def handle_mkdir(task):
             raise ValueError("Mkdir task requires 'path'")
             
         # Safety check
-        if not is_safe_path(TaskConfig.BASE_DIR, path):
+        target = TaskConfig.PATH_POLICY.resolve(path)
+        if target is None:
             LOGGER.warning(f"Invalid directory path attempt: {path}")
             raise ValueError("Invalid directory path")
         
         # Check if directory already exists
-        if os.path.exists(path):
+        if await run_io(TaskConfig.FS_CACHE.exists, target):
             LOGGER.info(f"Directory '{path}' already exists")
             return f"Directory '{path}' already exists"
             
-        # Create directory
+        # Create directory, then verify that it was created successfully
         try:
-            os.makedirs(path)
-            # Verify if directory was created successfully
-            if os.path.exists(path) and os.path.isdir(path):
+            created = await run_io(_make_directory, target)
+            await _changed(target)
+            if created:
                 LOGGER.info(f"Directory '{path}' created successfully")
                 return f"Directory '{path}' created successfully"
             else:
@@ -348,6 +663,156 @@ async def handle_mkdir(task):
         LOGGER.error(f"Mkdir operation failed: {str(e)}")
         raise
 
+def _bundle_options(task):
+    """Destination, skip_unchanged, atomic and known file hashes of an extract or sync task"""
+    path = task.parameters.get("path", ".")
+    target = TaskConfig.PATH_POLICY.resolve(path)
+    if target is None:
+        LOGGER.warning(f"Invalid directory path attempt: {path}")
+        raise ValueError("Invalid directory path")
+    skip_unchanged = task.parameters.get("skip_unchanged", True) is not False
+    atomic = task.parameters.get("atomic", True) is not False
+    # Hashes of files this session already wrote or read, save re-reading them to compare
+    known = task.session.file_hashes if task.session is not None else None
+    return path, target, skip_unchanged, atomic, known
+
+def _bundle_output(message, report):
+    """Result of an extract or sync task; paths that need the caller's attention are listed in the text too"""
+    summary = (f"{len(report.written)} written, {report.unchanged} unchanged, "
+               f"{report.directories} director(ies) created")
+    if report.deleted:
+        summary += f", {len(report.deleted)} deleted"
+    message = f"{message}: {summary}"
+    lines = [message]
+    if report.stale:
+        lines.append(f"Missing or different from their sha256, send their content: {', '.join(report.stale)}")
+    if report.skipped:
+        lines.append(f"Links and special files skipped: {', '.join(report.skipped)}")
+    return TaskOutput("\n".join(lines), message=message, **report.as_dict())
+
+async def _apply_bundle(target, apply, *args):
+    """Run a blocking bundle function on the I/O executor, then drop what the caches knew below target"""
+    report = None
+    try:
+        report = await run_io(apply, target, *args)
+    finally:
+        if report is None or report.written or report.directories or report.deleted:
+            await _changed(target, recursive=True)
+    BYTES_WRITTEN.inc(amount=report.bytes_written)
+    return report
+
+async def handle_extract(task):
+    """
+    Handle archive extraction task.
+    Unpacks a base64 tar, tar.gz or zip 'archive' into the directory 'path'
+    in one pass on the I/O executor, in place of one write task per file:
+    every entry is checked against the path policy, each missing directory
+    is created once, files that already hold the same content are skipped
+    and the others are written atomically. Links are not extracted.
+    """
+    try:
+        archive = task.parameters.get("archive")
+        archive_format = task.parameters.get("format")
+
+        LOGGER.info(f"Handling extract task into {task.parameters.get('path', '.')}")
+
+        if not archive:
+            raise ValueError("Extract task requires a base64 'archive'")
+        if archive_format is not None and archive_format not in ARCHIVE_FORMATS:
+            raise ValueError(f"'format' must be one of {', '.join(ARCHIVE_FORMATS)}")
+        path, target, skip_unchanged, atomic, known = _bundle_options(task)
+
+        try:
+            report = await _apply_bundle(target, _extract_archive, archive, archive_format,
+                                         skip_unchanged, atomic, known)
+        except BundleError as e:
+            raise ValueError(f"Failed to extract archive into '{path}': {str(e)}")
+        except OSError as e:
+            raise IOError(f"Failed to extract archive into '{path}': {str(e)}")
+        return _bundle_output(f"Archive extracted into '{path}'", report)
+
+    except Exception as e:
+        LOGGER.error(f"Extract operation failed: {str(e)}")
+        raise
+
+async def handle_sync(task):
+    """
+    Handle manifest sync task.
+    'files' maps paths below 'path' to their text content, to
+    {"base64": ...} for binary files, or to {"sha256": ...} alone to check
+    a file without sending it; those that are missing or differ are
+    reported, so the caller can send just their content. Applied like an
+    extract task; with "delete": true, files not in the manifest are removed.
+    """
+    try:
+        files = task.parameters.get("files")
+        delete = task.parameters.get("delete", False) is True
+
+        LOGGER.info(f"Handling sync task for {task.parameters.get('path', '.')}")
+
+        if not isinstance(files, dict):
+            raise ValueError("Sync task requires 'files', an object of path -> content")
+        path, target, skip_unchanged, atomic, known = _bundle_options(task)
+
+        try:
+            report = await _apply_bundle(target, _sync_manifest, files, delete, skip_unchanged, atomic,
+                                         known, _lister_options(task))
+        except BundleError as e:
+            raise ValueError(f"Failed to sync '{path}': {str(e)}")
+        except OSError as e:
+            raise IOError(f"Failed to sync '{path}': {str(e)}")
+        return _bundle_output(f"Synced {report.files} file(s) into '{path}'", report)
+
+    except Exception as e:
+        LOGGER.error(f"Sync operation failed: {str(e)}")
+        raise
+
+async def handle_archive(task):
+    """
+    Handle archive task.
+    Packs the files under 'path' (or the file at 'path') into a tar.gz, tar
+    or zip archive, skipping what a list task would (include/exclude globs,
+    ignore_defaults) and links. The archive is sent by reference: GET
+    /blobs/<id> downloads it, and an extract task accepts it base64-encoded.
+    """
+    try:
+        path = task.parameters.get("path", ".")
+        archive_format = task.parameters.get("format", "tar.gz")
+        include = task.parameters.get("include")
+        exclude = task.parameters.get("exclude")
+
+        LOGGER.info(f"Handling archive task for {path}")
+
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError(f"'format' must be one of {', '.join(ARCHIVE_FORMATS)}")
+        path_matcher(include, exclude)  # Validates the globs
+
+        target = TaskConfig.PATH_POLICY.resolve(path)
+        if target is None:
+            raise ValueError("Invalid directory path")
+        if not await run_io(TaskConfig.FS_CACHE.exists, target):
+            raise FileNotFoundError(f"Path '{path}' not found")
+
+        try:
+            data, files, size, digest = await run_io(
+                _pack, target, archive_format, dict(_lister_options(task), include=include, exclude=exclude)
+            )
+        except BundleError as e:
+            raise ValueError(f"Failed to archive '{path}': {str(e)}")
+        except Exception as e:
+            raise IOError(f"Failed to archive '{path}': {str(e)}")
+
+        BYTES_READ.inc(amount=size)
+        blob_id = await run_io(BLOB_STORE.put, data, task.session.id if task.session is not None else None)
+        ref = f"/blobs/{blob_id}"
+        message = f"Archived {files} file(s) from '{path}' as {archive_format} ({len(data)} bytes)"
+        return TaskOutput(f"{message}, download: GET {ref}", message=message, files=files,
+                          archive={"ref": ref, "bytes": len(data), "format": archive_format, "sha256": digest})
+
+    except Exception as e:
+        LOGGER.error(f"Archive operation failed: {str(e)}")
+        raise
+
 # Task handler mapping
 TASK_HANDLERS = {
     "write": handle_write,
@@ -357,5 +822,9 @@ TASK_HANDLERS = {
     "move": handle_move,  # Add move handler
     "copy": handle_copy,
     "list": handle_list,
+    "search": handle_search,
     "mkdir": handle_mkdir,  # Add mkdir handler
+    "extract": handle_extract,
+    "sync": handle_sync,
+    "archive": handle_archive,
 }
\ No newline at end of file
@@ -0,0 +1,236 @@
+import json
+import os
+from services.session_store import is_idempotent_command
+from services.task_tree import topological_order
+from logger import LOGGER
+
+# Task types whose duplicates within a batch can share one result
+DEDUPLICABLE_TASKS = {"read", "list", "search", "archive", "exec"}
+
+# Marker for tasks that may touch any path (commands)
+ANY_PATH = object()
+
+
+def _path_key(path):
+    """Lexically normalised path as a tuple of components, None if unusable"""
+    if not isinstance(path, str) or not path:
+        return None
+    normalized = os.path.normpath(path).replace("\\", "/").strip("/")
+    if normalized in ("", "."):
+        return ()
+    return tuple(normalized.split("/"))
+
+
+def task_paths(node):
+    """
+    Return (reads, writes): the path parameters a task reads and changes, as given.
+    A command is reported as ANY_PATH, since its effects cannot be known.
+    """
+    parameters = node.parameters if isinstance(node.parameters, dict) else {}
+    if node.type in ("read", "list", "search", "archive"):
+        return [parameters.get("path", None if node.type == "read" else ".")], []
+    if node.type in ("write", "delete", "mkdir"):
+        return [], [parameters.get("path")]
+    if node.type in ("extract", "sync"):
+        return [], [parameters.get("path", ".")]
+    if node.type == "move":
+        return [], [parameters.get("source"), parameters.get("destination")]
+    if node.type == "copy":
+        return [parameters.get("source")], [parameters.get("destination")]
+    if node.type == "exec" and "cwd" not in parameters and is_idempotent_command(str(parameters.get("command", ""))):
+        return [ANY_PATH], []
+    # Other commands, and unknown types, may change anything
+    return [], [ANY_PATH]
+
+
+def task_accesses(node):
+    """Return (reads, writes): the path keys a task reads and changes, ANY_PATH for commands"""
+    reads, writes = task_paths(node)
+    return ([path if path is ANY_PATH else _path_key(path) for path in reads],
+            [path if path is ANY_PATH else _path_key(path) for path in writes])
+
+
+class _PathState:
+    """Trie node: last task that changed this path and tasks that read it since"""
+
+    __slots__ = ("children", "writer", "readers")
+
+    def __init__(self):
+        self.children = {}
+        self.writer = None  # (sequence, node)
+        self.readers = []
+
+    def walk(self):
+        stack = [self]
+        while stack:
+            state = stack.pop()
+            yield state
+            stack.extend(state.children.values())
+
+
+class TaskGraphOptimizer:
+    """
+    Rewrite a validated task graph before execution.
+
+    - mkdir tasks with the same dependencies are merged into the deepest one,
+      which creates the parents as well;
+    - tasks touching the same path (or a parent of it) without a declared
+      dependency between them are ordered as in the request, so a read never
+      races a write; commands touch unknown paths and are left to depends_on;
+    - identical read/list/idempotent exec tasks that see the same state of
+      their paths are run once and the result is shared.
+
+    Added dependencies always follow the existing topological order, so
+    explicit depends_on relations are kept and no cycle can appear.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.dependencies = {id(node): set(node.depends_on) for node in nodes}
+        self.added_edges = 0
+        for node in nodes:
+            node.depends_on = list(node.depends_on)  # Never mutate the request payload
+
+    def add_edge(self, parent, child):
+        deps = self.dependencies[id(child)]
+        if parent is child or parent.id in deps:
+            return
+        deps.add(parent.id)
+        child.depends_on.append(parent.id)
+        parent.children.append(child)
+        self.added_edges += 1
+
+    def coalesce(self, node, primary):
+        node.coalesced_into = primary
+        self.add_edge(primary, node)
+
+    def merge_mkdirs(self):
+        """Coalesce each mkdir into the deepest mkdir below it that has the same dependencies"""
+        groups = {}
+        for node in topological_order(self.nodes):
+            if node.type == "mkdir":
+                key = _path_key(node.parameters.get("path") if isinstance(node.parameters, dict) else None)
+                if key:
+                    groups.setdefault(frozenset(self.dependencies[id(node)]), []).append((key, node))
+        merged = 0
+        for group in groups.values():
+            survivors = {}  # Path key -> deepest mkdir creating it
+            for key, node in sorted(group, key=lambda item: -len(item[0])):
+                for depth in range(len(key), 0, -1):
+                    survivors.setdefault(key[:depth], node)
+            for key, node in group:
+                survivor = survivors[key]
+                if survivor is not node:
+                    self.coalesce(node, survivor)
+                    merged += 1
+        return merged
+
+    def order_conflicts(self):
+        """Order conflicting path accesses and share results of identical reads"""
+        root = _PathState()
+        sequence = 0  # Counts tasks that change something, in topological order
+        last_command = 0  # Sequence of the newest command that may have changed anything
+        seen = {}  # (type, parameters, state) -> first task
+        shared = 0
+
+        for node in topological_order(self.nodes):
+            reads, writes = task_accesses(node)
+            if ANY_PATH in writes:
+                # The paths a command touches are unknown: it is only ordered by depends_on
+                sequence += 1
+                last_command = sequence
+                continue
+
+            latest = last_command  # Newest change this task may observe
+            if ANY_PATH in reads:
+                latest = sequence
+            for key in reads:
+                if key is None or key is ANY_PATH:
+                    continue
+                latest = max(latest, self._after_writers(root, key, node))
+                self._state(root, key).readers.append(node)
+            if writes:
+                sequence += 1
+            for key in writes:
+                if key is None:
+                    continue
+                self._after_accesses(root, key, node)
+                state = self._state(root, key)
+                state.writer = (sequence, node)
+                state.readers = []
+                state.children = {}  # Everything below is ordered before this task now
+
+            if node.type in DEDUPLICABLE_TASKS and not writes and node.coalesced_into is None:
+                try:
+                    signature = (node.type, json.dumps(node.parameters, sort_keys=True), latest)
+                except (TypeError, ValueError):
+                    continue
+                primary = seen.setdefault(signature, node)
+                if primary is not node:
+                    self.coalesce(node, primary)
+                    shared += 1
+        return shared
+
+    def _state(self, root, key):
+        state = root
+        for part in key:
+            state = state.children.setdefault(part, _PathState())
+        return state
+
+    def _ancestors(self, root, key):
+        """States of the path and of every parent of it that has been seen"""
+        state = root
+        yield state
+        for part in key:
+            state = state.children.get(part)
+            if state is None:
+                return
+            yield state
+
+    def _below(self, root, key):
+        """States strictly below the path"""
+        state = root
+        for part in key:
+            state = state.children.get(part)
+            if state is None:
+                return
+        for child in state.children.values():
+            yield from child.walk()
+
+    def _after_writers(self, root, key, node):
+        """Make a reader wait for earlier changes of its path, return the newest one"""
+        latest = 0
+        for state in self._conflicting(root, key):
+            if state.writer is not None:
+                self.add_edge(state.writer[1], node)
+                latest = max(latest, state.writer[0])
+        return latest
+
+    def _after_accesses(self, root, key, node):
+        """Make a writer wait for earlier reads and changes of its path"""
+        for state in self._conflicting(root, key):
+            if state.writer is not None:
+                self.add_edge(state.writer[1], node)
+            for reader in state.readers:
+                self.add_edge(reader, node)
+
+    def _conflicting(self, root, key):
+        yield from self._ancestors(root, key)
+        yield from self._below(root, key)
+
+    def run(self):
+        merged = self.merge_mkdirs()
+        shared = self.order_conflicts()
+        if merged or shared or self.added_edges:
+            LOGGER.info(f"Task graph optimized: {merged} mkdir(s) merged, {shared} duplicate(s) shared, "
+                        f"{self.added_edges} dependencies added")
+        return [node for node in self.nodes if node.coalesced_into is not None]
+
+
+def optimize_task_graph(nodes):
+    """
+    Coalesce redundant tasks and order conflicting ones.
+    :param nodes: Every node of a validated task graph
+    :return: The nodes that were coalesced into another task
+    """
+    return TaskGraphOptimizer(nodes).run()
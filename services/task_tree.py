@@ -1,93 +1,339 @@
 import asyncio
+import heapq
+import itertools
+import time
+from config import MAX_CONCURRENT_TASKS, GLOBAL_MAX_CONCURRENT_TASKS, FAILURE_POLICY
+from services.instrumentation import (
+    CACHE_LOOKUPS,
+    TASKS,
+    TASKS_IN_FLIGHT,
+    TASK_DURATION,
+    TASK_QUEUE_TIME,
+)
+from utils.concurrency import ConcurrencyLimiter
+
+# Process-wide cap on handlers running at the same time, shared by all requests
+GLOBAL_TASK_LIMITER = ConcurrencyLimiter(GLOBAL_MAX_CONCURRENT_TASKS)
+
+# What a failed task does to the rest of its batch, see execute_task_tree
+FAILURE_POLICIES = ("skip_dependents", "fail_fast", "continue")
 
 class TaskNode:
-    def __init__(self, task):
+    def __init__(self, task, position=0):
         self.id = task["id"]
         self.type = task["type"]
         self.parameters = task.get("parameters", {})
         self.depends_on = task.get("depends_on", [])
+        self.declared_depends_on = self.depends_on  # As sent; the optimizer may add ordering dependencies
+        self.on_failure = task.get("on_failure")  # Overrides the batch's failure policy for this task
+        self.execution_order = task.get("execution_order")
+        self.priority = task.get("priority", 1)  # Weight of the task's share of the response budget
+        self.position = position  # Index of the task in the request
         self.children = []
         self.executed = False
+        self.session = None  # Session the task runs in, set by the pipeline
+        self.cache_status = None  # "hit" or "miss" for cacheable tasks
+        self.coalesced_into = None  # Task whose execution also covers this one, set by the optimizer
+        self.result = None  # Result dict once the task has finished
+        self.fingerprint = None  # Hash of the task's inputs, set by the pipeline for the journal
+        self.resume = False  # May reuse a journaled result instead of running
+        self.resumed = False  # Result was taken from the session's journal
+        self.file_hash = None  # (size, mtime_ns, sha256) of the file a write task left, set by its handler
+
+    def sort_key(self):
+        """Tie-break key among ready tasks: execution_order first, then request position"""
+        order = self.execution_order
+        return (order is None, order if isinstance(order, (int, float)) else 0, self.position)
 
     def __repr__(self):
         return f"TaskNode(id={self.id}, type={self.type})"
 
 
-async def check_circular_dependency(nodes):
-    """Check for circular dependencies"""
-    visited = set()
-    path = set()
-    
-    async def dfs(node_id):
-        if node_id in path:
-            raise ValueError(f"Circular dependency detected involving task {node_id}")
-        if node_id in visited:
-            return
-            
-        visited.add(node_id)
-        path.add(node_id)
-        
-        node = nodes[node_id]
-        for dep_id in node.depends_on:
-            await dfs(dep_id)
-            
-        path.remove(node_id)
+def _unfinished_dependency(nodes, node, remaining):
+    """First dependency of node that Kahn's algorithm could not order"""
+    for dep_id in node.depends_on:
+        try:
+            if remaining.get(dep_id):
+                return nodes[dep_id]
+        except TypeError:
+            continue  # Unhashable id, already reported as unknown
+    raise AssertionError(f"Task {node.id} has no unfinished dependency")
+
+
+def find_cycle(nodes, remaining):
+    """
+    Return a dependency cycle as a list of task ids, walking only nodes that
+    Kahn's algorithm could not order. Each of them still has an unfinished
+    dependency among the others, so following dependencies must revisit a node.
+    """
+    start = next(node for node in nodes.values() if remaining[node.id])
+    seen = {}
+    path = []
+    node = start
+    while node.id not in seen:
+        seen[node.id] = len(path)
+        path.append(node.id)
+        node = _unfinished_dependency(nodes, node, remaining)
+    cycle = path[seen[node.id]:]
+    # Show the cycle in execution direction: each task is followed by a task that depends on it
+    cycle.reverse()
+    return cycle + [cycle[0]]
 
-    for node_id in nodes:
-        await dfs(node_id)
+
+def validate_task_graph(nodes):
+    """
+    Check that the dependency graph is a DAG in one iterative pass (Kahn's algorithm).
+    Runs in O(tasks + dependencies) without recursion, so long chains are fine.
+    Dependencies on unknown tasks must already have been left out of the children lists.
+    :param nodes: Dict of task id to TaskNode with children linked
+    :return: Error message naming the tasks on a cycle, or None
+    """
+    remaining = {node_id: 0 for node_id in nodes}
+    for node in nodes.values():
+        for child in node.children:
+            remaining[child.id] += 1
+    ready = [node for node in nodes.values() if not remaining[node.id]]
+    ordered = 0
+    while ready:
+        node = ready.pop()
+        ordered += 1
+        for child in node.children:
+            remaining[child.id] -= 1
+            if not remaining[child.id]:
+                ready.append(child)
+
+    if ordered == len(nodes):
+        return None
+    cycle = find_cycle(nodes, remaining)
+    return f"Circular dependency detected: {' -> '.join(str(i) for i in cycle)}"
 
 
 async def build_task_tree(tasks):
     """
     Build the task execution tree.
+    Duplicate ids, unknown dependencies and cycles are collected in one pass
+    and reported together as a single ValueError.
     :param tasks: List of tasks from JSON
     :return: List of root nodes
     """
-    nodes = {task["id"]: TaskNode(task) for task in tasks}
-    
-    # Check for circular dependencies
-    await check_circular_dependency(nodes)
+    nodes = {}
+    errors = []
+    duplicates = []
+    for position, task in enumerate(tasks):
+        node = TaskNode(task, position)
+        try:
+            if node.id in nodes:
+                duplicates.append(node.id)
+                continue
+        except TypeError:
+            raise ValueError(f"Invalid task id: {node.id!r}")
+        if not isinstance(node.depends_on, list):
+            raise ValueError(f"'depends_on' of task {node.id} must be a list.")
+        if node.on_failure is not None and node.on_failure not in FAILURE_POLICIES:
+            errors.append(f"'on_failure' of task {node.id} must be one of: {', '.join(FAILURE_POLICIES)}.")
+        if isinstance(node.priority, bool) or not isinstance(node.priority, (int, float)) or node.priority <= 0:
+            errors.append(f"'priority' of task {node.id} must be a positive number.")
+        nodes[node.id] = node
+    if duplicates:
+        errors.append(f"Duplicate task id(s): {', '.join(str(i) for i in dict.fromkeys(duplicates))}")
 
     # Establish parent-child relationships
     for node in nodes.values():
         for dep_id in node.depends_on:
-            parent = nodes.get(dep_id)
+            try:
+                parent = nodes.get(dep_id)
+            except TypeError:
+                parent = None
             if not parent:
-                raise ValueError(f"Dependency task {dep_id} not found for task {node.id}.")
+                errors.append(f"Dependency task {dep_id} not found for task {node.id}.")
+                continue
             parent.children.append(node)
 
+    # Check for circular dependencies
+    cycle_error = validate_task_graph(nodes)
+    if cycle_error:
+        errors.append(cycle_error)
+    if errors:
+        raise ValueError("; ".join(errors))
+
     # Find root nodes (tasks with no dependencies)
     root_nodes = [node for node in nodes.values() if not node.depends_on]
     return root_nodes
 
 
-async def execute_task_tree(root_nodes, handle_task):
+def collect_nodes(root_nodes):
+    """Return every node reachable from the roots, each exactly once"""
+    seen = set()
+    nodes = []
+    stack = list(reversed(root_nodes))
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        nodes.append(node)
+        stack.extend(reversed(node.children))
+    return nodes
+
+
+def topological_order(nodes):
+    """
+    Deterministic topological order of the nodes.
+    A task becomes ready once all of its dependencies are done; ready tasks
+    are ordered by execution_order, then by their position in the request.
+    """
+    counter = itertools.count()
+    remaining = {id(node): len(node.depends_on) for node in nodes}
+    ready = [(node.sort_key(), next(counter), node) for node in nodes if not remaining[id(node)]]
+    heapq.heapify(ready)
+    ordered = []
+    while ready:
+        _, _, node = heapq.heappop(ready)
+        ordered.append(node)
+        for child in node.children:
+            remaining[id(child)] -= 1
+            if not remaining[id(child)]:
+                heapq.heappush(ready, (child.sort_key(), next(counter), child))
+    return ordered
+
+
+async def execute_task_tree(root_nodes, handle_task, max_concurrency=None, on_result=None,
+                            failure_policy=None, deadline=None):
     """
     Execute tasks in the task tree.
+    A task starts once all of its dependencies have finished; independent tasks
+    run concurrently, up to max_concurrency for this request and the global limit.
+    What a failure does to the rest of the batch depends on the failure policy
+    (or the task's own on_failure):
+    - "skip_dependents": tasks that declared a dependency on it, directly or
+      through other skipped tasks, are reported as skipped;
+    - "fail_fast": running tasks are cancelled and nothing else is started;
+    - "continue": every other task still runs.
     :param root_nodes: List of root nodes
     :param handle_task: Task execution function
-    :return: List of execution results
+    :param max_concurrency: Per-request limit, defaults to MAX_CONCURRENT_TASKS
+    :param on_result: Optional callback invoked with each result as soon as its task finishes
+    :param failure_policy: Default policy of the batch, defaults to FAILURE_POLICY
+    :param deadline: Seconds the whole batch may run; outstanding tasks are then cancelled
+    :return: List of execution results, in topological order
     """
-    results = []
-
-    async def execute_node(node):
-        if node.executed:
-            return
-
-        # Execute the current task first
-        try:
-            result = await handle_task(node)
-            results.append({"id": node.id, "type": node.type, "success": True, "description": result})
-        except Exception as e:
-            results.append({"id": node.id, "type": node.type, "success": False, "description": str(e)})
+    nodes = collect_nodes(root_nodes)
+    limit = max(1, min(max_concurrency or MAX_CONCURRENT_TASKS, MAX_CONCURRENT_TASKS))
+    failure_policy = failure_policy or FAILURE_POLICY
+    end = time.monotonic() + deadline if deadline else None
+    counter = itertools.count()
+    remaining = {id(node): len(node.depends_on) for node in nodes}
+    ready = [(node.sort_key(), next(counter), node) for node in nodes if not remaining[id(node)]]
+    heapq.heapify(ready)
+    results = {}
+    blocked = {}  # id(node) -> id of the failed task that rules it out
+    # Wall-clock and monotonic time at which each task became ready
+    queued = dict.fromkeys((id(node) for _, _, node in ready), (time.time(), time.perf_counter()))
 
+    def finish(node, result):
+        result["parameters"] = node.parameters
+        result["priority"] = node.priority
+        results[id(node)] = result
+        TASKS.inc(node.type, result["status"])
+        node.result = result
         node.executed = True
+        if on_result:
+            on_result(result)
+
+    def not_run(node, status, description):
+        finish(node, {"id": node.id, "type": node.type, "success": False, "status": status,
+                      "description": description})
 
-        # Then execute all child nodes
+    def release(node):
+        failed = not node.result["success"]
+        cause = blocked.get(id(node), node.id)
         for child in node.children:
-            await execute_node(child)
+            if failed and node.id in child.declared_depends_on and (
+                    id(node) in blocked or (node.on_failure or failure_policy) == "skip_dependents"):
+                blocked.setdefault(id(child), cause)
+            remaining[id(child)] -= 1
+            if not remaining[id(child)]:
+                queued[id(child)] = (time.time(), time.perf_counter())
+                heapq.heappush(ready, (child.sort_key(), next(counter), child))
+
+    async def execute_node(node):
+        async with GLOBAL_TASK_LIMITER:
+            started = time.perf_counter()
+            TASKS_IN_FLIGHT.inc()
+            try:
+                output = await handle_task(node)
+                result = {"id": node.id, "type": node.type, "success": True, "status": "success",
+                          "description": output}
+            except Exception as e:
+                output = e
+                result = {"id": node.id, "type": node.type, "success": False, "status": "failed",
+                          "description": str(e)}
+            finally:
+                TASKS_IN_FLIGHT.dec()
+        if getattr(output, "data", None):
+            # Raw payload (content, command output) for structured responses
+            result["data"] = output.data
+        finished = time.perf_counter()
+        queued_at, queued_mark = queued[id(node)]
+        result["timing"] = {
+            "queued_at": round(queued_at, 6),
+            "started_at": round(queued_at + (started - queued_mark), 6),
+            "finished_at": round(queued_at + (finished - queued_mark), 6),
+            "queue_ms": round((started - queued_mark) * 1e3, 3),
+            "run_ms": round((finished - started) * 1e3, 3),
+        }
+        TASK_QUEUE_TIME.observe(started - queued_mark, node.type)
+        TASK_DURATION.observe(finished - started, node.type)
+        if node.cache_status:
+            result["cache"] = node.cache_status
+            CACHE_LOOKUPS.inc(node.cache_status)
+        if node.coalesced_into is not None:
+            result["coalesced"] = node.coalesced_into.id
+        if node.resumed:
+            result["resumed"] = True
+        finish(node, result)
+        return node
+
+    running = {}  # Future -> node
+    abort_reason = None
+    try:
+        while ready or running:
+            if end is not None and time.monotonic() >= end:
+                abort_reason = f"batch deadline of {deadline} s exceeded"
+                break
+            # Start as many ready tasks as the per-request limit allows
+            while ready and len(running) < limit:
+                _, _, node = heapq.heappop(ready)
+                if id(node) in blocked:
+                    not_run(node, "skipped", f"Skipped because task {blocked[id(node)]} failed")
+                    release(node)
+                    continue
+                running[asyncio.ensure_future(execute_node(node))] = node
+            if not running:
+                continue
+
+            timeout = None if end is None else max(0, end - time.monotonic())
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                future.result()
+                if not node.result["success"] and (node.on_failure or failure_policy) == "fail_fast":
+                    abort_reason = abort_reason or f"task {node.id} failed"
+                release(node)
+            if abort_reason:
+                break
+    finally:
+        for future in running:
+            future.cancel()
 
-    for root in root_nodes:
-        await execute_node(root)
+    if abort_reason:
+        # Wait for the cancelled handlers, so their commands are killed before the response goes out
+        await asyncio.gather(*running, return_exceptions=True)
+        for node in running.values():
+            if id(node) not in results:
+                not_run(node, "cancelled", f"Cancelled while running: {abort_reason}")
+        for node in topological_order(nodes):
+            if id(node) not in results:
+                not_run(node, "cancelled", f"Cancelled before it started: {abort_reason}")
 
-    return results
+    return [results[id(node)] for node in topological_order(nodes) if id(node) in results]
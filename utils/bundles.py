@@ -0,0 +1,362 @@
+import base64
+import binascii
+import hashlib
+import io
+import os
+import stat
+import tarfile
+import zipfile
+from utils.file_utils import content_matches, file_sha256, write_atomic
+from utils.listing import DirectoryLister
+
+ARCHIVE_FORMATS = ("tar.gz", "tar", "zip")
+GZIP_LEVEL = 6  # tarfile defaults to 9, much slower for a few percent
+
+# Entry kinds
+FILE = "file"
+DIRECTORY = "directory"
+OTHER = "other"  # Links and special files, never extracted
+
+
+class BundleError(ValueError):
+    """An archive or manifest that cannot be applied"""
+
+
+class BundleEntry:
+    __slots__ = ("path", "kind", "data", "sha256", "executable")
+
+    def __init__(self, path, kind, data=None, sha256=None, executable=False):
+        self.path = path  # Relative to the bundle root, "/"-separated
+        self.kind = kind
+        self.data = data  # None for a manifest entry that only gives the hash
+        self.sha256 = sha256  # Expected hex digest, if the sender gave one
+        self.executable = executable
+
+
+class BundleReport:
+    """What applying a bundle did, entry by entry"""
+
+    def __init__(self):
+        self.written = []
+        self.unchanged = 0
+        self.directories = 0  # Created
+        self.bytes_written = 0
+        self.stale = []  # Hash-only entries whose file is missing or differs
+        self.skipped = []  # Links and special files
+        self.deleted = []
+
+    @property
+    def files(self):
+        return len(self.written) + self.unchanged + len(self.stale)
+
+    def as_dict(self):
+        return {
+            "written": self.written,
+            "unchanged": self.unchanged,
+            "directories_created": self.directories,
+            "stale": self.stale,
+            "skipped": self.skipped,
+            "deleted": self.deleted,
+        }
+
+
+def entry_path(name):
+    """
+    Normalised relative path of an archive or manifest entry, "" for the root.
+    Raises BundleError for absolute paths and paths that climb out with "..".
+    """
+    if not isinstance(name, str) or "\0" in name:
+        raise BundleError(f"Invalid entry name {name!r}")
+    normalized = name.replace("\\", "/")
+    if normalized.startswith("/") or (len(normalized) > 1 and normalized[1] == ":"):
+        raise BundleError(f"Entry '{name}' has an absolute path")
+    parts = [part for part in normalized.split("/") if part not in ("", ".")]
+    if ".." in parts:
+        raise BundleError(f"Entry '{name}' points outside the target directory")
+    return "/".join(parts)
+
+
+def decode_base64(value, field):
+    """Bytes of a base64 field; field names it in errors"""
+    if not isinstance(value, str):
+        raise BundleError(f"{field} must be a base64 string")
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        raise BundleError(f"{field} is not valid base64")
+
+
+def detect_format(data):
+    """Archive format from the leading bytes, None if unknown"""
+    if data[:4] in (b"PK\x03\x04", b"PK\x05\x06"):
+        return "zip"
+    if data[:2] == b"\x1f\x8b":
+        return "tar.gz"
+    if data[257:262] == b"ustar":
+        return "tar"
+    return None
+
+
+class BundleLimits:
+    """Entry count and unpacked size of one bundle, checked as entries are read"""
+
+    def __init__(self, max_entries, max_bytes, max_file_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.entries = 0
+        self.bytes = 0
+
+    def add(self, path, size=0):
+        self.entries += 1
+        self.bytes += size
+        if self.entries > self.max_entries:
+            raise BundleError(f"More than {self.max_entries} entries")
+        if size > self.max_file_size:
+            raise BundleError(f"Entry '{path}' is larger than {self.max_file_size} bytes")
+        if self.bytes > self.max_bytes:
+            raise BundleError(f"More than {self.max_bytes} bytes once unpacked")
+
+
+def iter_archive(data, archive_format, limits):
+    """
+    Yield the entries of a tar, tar.gz or zip archive in one pass.
+    Tar archives are read as a stream; sizes are checked before each member is read.
+    """
+    archive_format = archive_format or detect_format(data)
+    if archive_format == "zip":
+        yield from _iter_zip(data, limits)
+    elif archive_format in ("tar", "tar.gz"):
+        yield from _iter_tar(data, "r|gz" if archive_format == "tar.gz" else "r|", limits)
+    else:
+        raise BundleError("Unknown archive format, expected tar, tar.gz or zip")
+
+
+def _iter_tar(data, mode, limits):
+    try:
+        with tarfile.open(fileobj=io.BytesIO(data), mode=mode) as archive:
+            for member in archive:
+                path = entry_path(member.name)
+                if not path:
+                    continue
+                if member.isdir():
+                    limits.add(path)
+                    yield BundleEntry(path, DIRECTORY)
+                elif member.isreg():
+                    limits.add(path, member.size)
+                    yield BundleEntry(path, FILE, archive.extractfile(member).read(),
+                                      executable=bool(member.mode & 0o100))
+                else:
+                    yield BundleEntry(path, OTHER)
+    except (tarfile.TarError, EOFError, OSError) as e:
+        raise BundleError(f"Invalid tar archive: {str(e)}")
+
+
+def _iter_zip(data, limits):
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            infos = archive.infolist()
+            if len(infos) > limits.max_entries:
+                raise BundleError(f"More than {limits.max_entries} entries")
+            for info in infos:
+                path = entry_path(info.filename)
+                if not path:
+                    continue
+                mode = info.external_attr >> 16
+                if info.is_dir():
+                    limits.add(path)
+                    yield BundleEntry(path, DIRECTORY)
+                elif stat.S_ISLNK(mode):
+                    yield BundleEntry(path, OTHER)
+                else:
+                    limits.add(path, info.file_size)
+                    with archive.open(info) as f:
+                        # The header may understate the size, never read past the limit
+                        content = f.read(limits.max_file_size + 1)
+                    if len(content) != info.file_size:
+                        raise BundleError(f"Entry '{path}' does not match its recorded size")
+                    yield BundleEntry(path, FILE, content, executable=bool(mode & 0o100))
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, EOFError, OSError, NotImplementedError) as e:
+        raise BundleError(f"Invalid zip archive: {str(e)}")
+
+
+def iter_manifest(files, limits):
+    """
+    Yield the entries of a manifest: a dict of path -> text content, or of
+    path -> {"content": text} / {"base64": bytes} with an optional "sha256",
+    or just {"sha256": ...} to check a file without sending it. Paths ending
+    with "/" are directories.
+    """
+    if not isinstance(files, dict):
+        raise BundleError("'files' must be an object of path -> content")
+    if len(files) > limits.max_entries:
+        raise BundleError(f"More than {limits.max_entries} entries")
+    for name, value in files.items():
+        path = entry_path(name)
+        if not path:
+            raise BundleError(f"Invalid entry name {name!r}")
+        if name.endswith("/"):
+            if value not in (None, {}):
+                raise BundleError(f"Directory entry '{name}' cannot have content")
+            limits.add(path)
+            yield BundleEntry(path, DIRECTORY)
+            continue
+        if isinstance(value, str):
+            value = {"content": value}
+        if not isinstance(value, dict):
+            raise BundleError(f"Entry '{name}' must be a string or an object")
+        content, encoded, digest = value.get("content"), value.get("base64"), value.get("sha256")
+        if content is not None and encoded is not None:
+            raise BundleError(f"Entry '{name}' has both 'content' and 'base64'")
+        if digest is not None and not isinstance(digest, str):
+            raise BundleError(f"'sha256' of entry '{name}' must be a hex string")
+        if content is not None:
+            if not isinstance(content, str):
+                raise BundleError(f"'content' of entry '{name}' must be a string")
+            data = content.encode("utf-8")
+        elif encoded is not None:
+            data = decode_base64(encoded, f"'base64' of entry '{name}'")
+        elif digest is not None:
+            data = None
+        else:
+            raise BundleError(f"Entry '{name}' needs 'content', 'base64' or 'sha256'")
+        limits.add(path, len(data) if data is not None else 0)
+        yield BundleEntry(path, FILE, data, digest.lower() if digest else None,
+                          executable=value.get("executable") is True)
+
+
+def _ensure_directory(directory, existing, report):
+    """Create a directory and its missing parents, once per bundle"""
+    if directory in existing:
+        return
+    missing = []
+    parent = directory
+    while parent not in existing and not os.path.isdir(parent):
+        missing.append(parent)
+        parent = os.path.dirname(parent)
+    if missing:
+        os.makedirs(directory, exist_ok=True)
+        report.directories += len(missing)
+    while directory not in existing:
+        existing.add(directory)
+        if directory == parent:
+            break
+        directory = os.path.dirname(directory)
+
+
+def apply_entries(entries, resolve, skip_unchanged=True, atomic=True, known=None):
+    """
+    Apply bundle entries to the filesystem in one pass.
+    :param entries: BundleEntry iterable
+    :param resolve: Absolute target of an entry path, None if the path is not allowed
+    :param known: Optional path -> (size, mtime_ns, sha256) of files already hashed
+    :return: BundleReport
+    """
+    report = BundleReport()
+    existing = set()  # Directories known to exist
+    known = known or {}
+    for entry in entries:
+        if entry.kind == OTHER:
+            report.skipped.append(entry.path)
+            continue
+        target = resolve(entry.path)
+        if target is None:
+            raise BundleError(f"Invalid path '{entry.path}'")
+        if entry.kind == DIRECTORY:
+            _ensure_directory(target, existing, report)
+            continue
+
+        if entry.data is None:
+            if not _hash_matches(target, entry.sha256, known.get(target)):
+                report.stale.append(entry.path)
+            else:
+                report.unchanged += 1
+            continue
+        if entry.sha256 is not None and hashlib.sha256(entry.data).hexdigest() != entry.sha256:
+            raise BundleError(f"Content of entry '{entry.path}' does not match its sha256")
+        if skip_unchanged and content_matches(target, entry.data, known.get(target)):
+            report.unchanged += 1
+            continue
+        _ensure_directory(os.path.dirname(target), existing, report)
+        if atomic:
+            write_atomic(target, entry.data)
+        else:
+            with open(target, "wb") as f:
+                f.write(entry.data)
+        if entry.executable:
+            mode = os.stat(target).st_mode
+            os.chmod(target, mode | (mode & 0o444) >> 2)  # Executable wherever readable
+        report.written.append(entry.path)
+        report.bytes_written += len(entry.data)
+    return report
+
+
+def _hash_matches(path, digest, known):
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return False
+    if not stat.S_ISREG(stat_result.st_mode):
+        return False
+    if known is not None and tuple(known[:2]) == (stat_result.st_size, stat_result.st_mtime_ns):
+        return known[2] == digest
+    return file_sha256(path) == digest
+
+
+def delete_unlisted(root, listed, report, **lister_options):
+    """Remove the files below root that are not in listed (relative paths); directories are kept"""
+    for entry in DirectoryLister(root, **lister_options).iter_entries():
+        if not entry.is_dir and entry.path not in listed:
+            os.remove(os.path.join(root, entry.path))
+            report.deleted.append(entry.path)
+
+
+def pack_directory(root, archive_format, limits, **lister_options):
+    """
+    Pack the files below root (or the file at root) into an archive.
+    Links and special files are left out.
+    :return: (archive bytes, number of files packed)
+    """
+    buffer = io.BytesIO()
+    if os.path.isdir(root):
+        entries = ((entry.path, entry.is_dir) for entry in DirectoryLister(root, **lister_options).iter_entries())
+        base = root
+    else:
+        entries = [(os.path.basename(root), False)]
+        base = os.path.dirname(root)
+    files = 0
+    if archive_format == "zip":
+        archive = zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED)
+    else:
+        options = {"compresslevel": GZIP_LEVEL} if archive_format == "tar.gz" else {}
+        archive = tarfile.open(fileobj=buffer, mode="w:gz" if archive_format == "tar.gz" else "w", **options)
+    with archive:
+        for rel_path, is_dir in entries:
+            path = os.path.join(base, rel_path)
+            stat_result = os.lstat(path)
+            if stat.S_ISDIR(stat_result.st_mode):
+                limits.add(rel_path)
+            elif stat.S_ISREG(stat_result.st_mode):
+                limits.add(rel_path, stat_result.st_size)
+                files += 1
+            else:
+                continue  # Links and special files
+            if archive_format == "zip":
+                archive.write(path, rel_path)
+            else:
+                _add_to_tar(archive, path, rel_path, stat_result)
+    return buffer.getvalue(), files
+
+
+def _add_to_tar(archive, path, rel_path, stat_result):
+    # Built from the lstat we already have; TarFile.add would look up user and group names for every file
+    info = tarfile.TarInfo(rel_path)
+    info.mode = stat_result.st_mode & 0o7777
+    info.mtime = int(stat_result.st_mtime)
+    if stat.S_ISDIR(stat_result.st_mode):
+        info.type = tarfile.DIRTYPE
+        archive.addfile(info)
+        return
+    info.size = stat_result.st_size
+    with open(path, "rb") as f:
+        archive.addfile(info, f)
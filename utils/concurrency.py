@@ -0,0 +1,76 @@
+import asyncio
+import threading
+from collections import deque
+
+
+class ConcurrencyLimiter:
+    """
+    Counting semaphore that can be shared between event loops.
+
+    Flask runs every async view on its own event loop in a worker thread, so a
+    plain asyncio.Semaphore cannot enforce a process-wide limit. Waiters are
+    woken with call_soon_threadsafe on the loop they are waiting on.
+    """
+
+    def __init__(self, limit):
+        if limit < 1:
+            raise ValueError("Concurrency limit must be at least 1")
+        self.limit = limit
+        self._in_use = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def in_use(self):
+        return self._in_use
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._in_use < self.limit and not self._waiters:
+                self._in_use += 1
+                return
+            waiter = loop.create_future()
+            self._waiters.append((loop, waiter))
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._waiters.remove((loop, waiter))
+                    granted = False
+                except ValueError:
+                    # The slot was already handed over to us
+                    granted = waiter.done() and not waiter.cancelled()
+            if granted:
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # Hand the slot directly to the next waiter
+                loop, waiter = self._waiters.popleft()
+            else:
+                self._in_use -= 1
+                return
+        loop.call_soon_threadsafe(self._grant, waiter)
+
+    def _grant(self, waiter):
+        if waiter.done():
+            # The waiter was cancelled before it could take the slot
+            self.release()
+        else:
+            waiter.set_result(None)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
@@ -1,6 +1,9 @@
+import hashlib
+import io
 import os
+import tempfile
 from pathlib import Path
-import asyncio
+from utils.io_executor import run_io
 
 def is_safe_path(base_dir, path):
     """Verify if the file path is safe"""
@@ -11,10 +14,268 @@ def is_safe_path(base_dir, path):
     except (TypeError, ValueError):
         return False
 
-async def ensure_directory_exists(base_dir, path):
-    """Safely ensure the directory exists"""
-    if not is_safe_path(base_dir, path):
-        raise ValueError("Invalid path")
+async def ensure_directory_exists(path):
+    """
+    Ensure the parent directory of path exists.
+    :param path: Absolute path already authorized by the path policy
+    """
     directory = os.path.dirname(path)
-    if not os.path.exists(directory):
-        await asyncio.to_thread(os.makedirs, directory, exist_ok=True)
+    await run_io(os.makedirs, directory, exist_ok=True)
+
+# Size of each chunk when scanning files
+READ_CHUNK_SIZE = 64 * 1024
+
+# Permission bits for new files, as open() would apply them
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def content_matches(path, data, known=None):
+    """
+    True if the file at path already holds exactly data.
+    A size mismatch is decided from stat alone; known is an optional
+    (size, mtime_ns, sha256) of the file that saves reading it again.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat.st_size != len(data):
+        return False
+    digest = hashlib.sha256(data).hexdigest()
+    if known is not None and tuple(known[:2]) == (stat.st_size, stat.st_mtime_ns):
+        return known[2] == digest
+    return file_sha256(path) == digest
+
+def file_sha256(path):
+    """Hex sha256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_atomic(path, data):
+    """
+    Write data to a temporary file next to path and rename it over path,
+    so readers see either the old or the new content, never a partial file.
+    :return: os.stat_result of the written file, taken before anything else could change it
+    """
+    directory, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            written = os.fstat(f.fileno())
+        try:
+            os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+        except FileNotFoundError:
+            os.chmod(temp_path, 0o666 & ~_UMASK)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return written
+
+
+class ReadWindow:
+    """A bounded slice of a file, with enough position information to request the next one"""
+
+    def __init__(self, data, start, end, file_size, truncated=False, first_line=None, last_line=None):
+        self.data = data
+        self.start = start  # Byte offset of the first returned byte
+        self.end = end  # Byte offset just past the last returned byte
+        self.file_size = file_size
+        self.truncated = truncated  # True if the byte budget cut the requested range short
+        self.first_line = first_line
+        self.last_line = last_line
+
+    @property
+    def complete(self):
+        """True if the window covers the whole file"""
+        return self.start == 0 and self.end >= self.file_size
+
+    def text(self):
+        data = self.data
+        if self.end < self.file_size:
+            data = _trim_partial_utf8(data)
+        return data.decode("utf-8", errors="replace")
+
+    def describe(self):
+        """Human-readable position of the window, including how to fetch the next one"""
+        parts = []
+        if self.first_line is not None:
+            if self.last_line < self.first_line:
+                parts.append(f"no lines at or after line {self.first_line}")
+            else:
+                parts.append(f"lines {self.first_line}-{self.last_line}")
+        parts.append(f"bytes {self.start}-{self.end} of {self.file_size}")
+        if self.truncated:
+            parts.append("truncated by max_bytes")
+        if self.start > 0 and self.first_line is None:
+            parts.append(f"earlier content ends at offset={self.start}")
+        if self.end < self.file_size:
+            hint = f"next window: offset={self.end}"
+            if self.last_line is not None:
+                hint += f" or start_line={self.last_line + 1}"
+            parts.append(hint)
+        return ", ".join(parts)
+
+
+def _size(source):
+    """Size of a file given by path, or by its content already in memory"""
+    return len(source) if isinstance(source, bytes) else os.path.getsize(source)
+
+
+def _open(source):
+    """The read_* functions take a path, or the whole content of a cached file as bytes"""
+    return io.BytesIO(source) if isinstance(source, bytes) else open(source, "rb")
+
+
+def _trim_partial_utf8(data):
+    """Drop an incomplete UTF-8 sequence left at the end of a cut window"""
+    for back in range(1, min(4, len(data)) + 1):
+        byte = data[-back]
+        if byte & 0xC0 == 0x80:
+            continue  # Continuation byte, keep looking for the lead byte
+        if byte & 0x80:
+            expected = 2 if byte & 0xE0 == 0xC0 else 3 if byte & 0xF0 == 0xE0 else 4
+            if back < expected:
+                return data[:-back]
+        break
+    return data
+
+
+def read_byte_range(path, offset=0, length=None, max_bytes=None):
+    """Read at most min(length, max_bytes) bytes starting at offset"""
+    file_size = _size(path)
+    offset = max(0, min(offset, file_size))
+    wanted = file_size - offset if length is None else max(0, min(length, file_size - offset))
+    size = wanted if max_bytes is None else min(wanted, max_bytes)
+    with _open(path) as f:
+        f.seek(offset)
+        data = f.read(size)
+    return ReadWindow(data, offset, offset + len(data), file_size, truncated=size < wanted)
+
+
+def read_tail(path, max_bytes):
+    """Read the last max_bytes bytes of the file"""
+    file_size = _size(path)
+    window = read_byte_range(path, max(0, file_size - max_bytes), max_bytes=max_bytes)
+    window.truncated = window.start > 0
+    return window
+
+
+def read_line_range(path, start_line=1, end_line=None, max_bytes=None):
+    """
+    Read lines start_line..end_line (1-based, inclusive) in chunks,
+    so memory is bounded by max_bytes regardless of the file size.
+    """
+    file_size = _size(path)
+    start_line = max(1, start_line)
+    line_no = 1
+    position = 0  # Byte offset of the start of the current chunk
+    window_start = 0 if start_line == 1 else None
+    kept = []
+    kept_size = 0
+    line_mark = (0, 0)  # (len(kept), kept_size) where the current line started
+    last_line = start_line - 1  # Last complete line in the window
+    truncated = False
+
+    with _open(path) as f:
+        done = False
+        while not done:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            line_begin = 0
+            while line_begin < len(chunk):
+                newline = chunk.find(b"\n", line_begin)
+                line_end = len(chunk) if newline < 0 else newline + 1
+                if line_no >= start_line:
+                    if window_start is None:
+                        window_start = position + line_begin
+                    piece = chunk[line_begin:line_end]
+                    if max_bytes is not None and kept_size + len(piece) > max_bytes:
+                        truncated = True
+                        done = True
+                        if last_line < start_line:
+                            # A single line is larger than the budget, return its head
+                            kept.append(piece[:max_bytes - kept_size])
+                            kept_size = max_bytes
+                        else:
+                            # Stop at the end of the last complete line
+                            del kept[line_mark[0]:]
+                            kept_size = line_mark[1]
+                        break
+                    kept.append(piece)
+                    kept_size += len(piece)
+                if newline < 0:
+                    # Line continues in the next chunk
+                    break
+                if line_no >= start_line:
+                    last_line = line_no
+                    line_mark = (len(kept), kept_size)
+                line_no += 1
+                if end_line is not None and line_no > end_line:
+                    done = True
+                    break
+                line_begin = line_end
+            position += len(chunk)
+
+    if window_start is None:
+        window_start = file_size
+    if not truncated and kept_size > line_mark[1]:
+        # The file ends without a trailing newline
+        last_line = line_no
+    data = b"".join(kept)
+    return ReadWindow(data, window_start, window_start + len(data), file_size, truncated,
+                      first_line=start_line, last_line=last_line)
+
+
+def read_tail_lines(path, count, max_bytes=None):
+    """Read the last count lines by scanning backwards from the end of the file"""
+    file_size = _size(path)
+    budget = file_size if max_bytes is None else min(file_size, max_bytes)
+    position = file_size
+    newlines = 0
+    chunks = []
+    read_size = 0
+    with _open(path) as f:
+        # A trailing newline terminates the last line, it does not start a new one
+        if file_size:
+            f.seek(file_size - 1)
+            if f.read(1) == b"\n":
+                newlines = -1
+        while position > 0 and read_size < budget:
+            step = min(READ_CHUNK_SIZE, position, budget - read_size)
+            position -= step
+            f.seek(position)
+            chunk = f.read(step)
+            chunks.append(chunk)
+            read_size += step
+            newlines += chunk.count(b"\n")
+            if newlines >= count:
+                break
+
+    data = b"".join(reversed(chunks))
+    start = position
+    truncated = False
+    if newlines >= count:
+        # Drop everything before the start of the first wanted line
+        cut = len(data)
+        for _ in range(count + (1 if data.endswith(b"\n") else 0)):
+            cut = data.rfind(b"\n", 0, cut)
+        data = data[cut + 1:]
+        start = file_size - len(data)
+    elif position > 0:
+        # The budget ran out before count lines were found, start at a line boundary
+        truncated = True
+        newline = data.find(b"\n")
+        if newline >= 0:
+            data = data[newline + 1:]
+            start = file_size - len(data)
+    return ReadWindow(data, start, file_size, file_size, truncated)
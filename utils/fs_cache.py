@@ -0,0 +1,298 @@
+import os
+import stat as stat_module
+import threading
+from collections import OrderedDict
+from config import BASE_DIR, FS_CACHE_MAX_BYTES, FS_CACHE_MAX_FILE_BYTES, FS_CACHE_WATCH
+from logger import LOGGER
+
+try:
+    from watchdog import events as watch_events
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # Optional: without it every cached entry is validated with a stat
+    FileSystemEventHandler = object
+    Observer = None
+
+# Rough memory cost of an entry besides its content
+ENTRY_OVERHEAD = 256
+
+# Watch events that do not change anything (our own reads produce them)
+IGNORED_EVENTS = {"opened", "closed_no_write"}
+
+# Event types to subscribe to, so reads are not even reported (watchdog 4+)
+CHANGE_EVENTS = (
+    "FileCreatedEvent", "DirCreatedEvent", "FileDeletedEvent", "DirDeletedEvent", "FileModifiedEvent",
+    "DirModifiedEvent", "FileMovedEvent", "DirMovedEvent", "FileClosedEvent",
+)
+
+# Stat of an entry that was filled by lstat() only
+UNKNOWN = object()
+
+
+def _stat(path):
+    """(size, mtime_ns, is_dir) of path, None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return st.st_size, st.st_mtime_ns, stat_module.S_ISDIR(st.st_mode)
+
+
+class _Entry:
+    __slots__ = ("stat", "content", "listing", "lstat", "size")
+
+    def __init__(self):
+        self.stat = UNKNOWN  # (size, mtime_ns, is_dir), or None for a missing path
+        self.content = None  # Whole file content, small regular files only
+        self.listing = None  # Sorted [(name, is_dir)] of a directory
+        self.lstat = None  # Listing details (size, mtime) of the path itself
+        self.size = 0  # Accounted by FileCache._store
+
+
+class EntryStat:
+    __slots__ = ("st_size", "st_mtime")
+
+    def __init__(self, size, mtime):
+        self.st_size = size
+        self.st_mtime = mtime
+
+
+class CachedDirEntry:
+    """The part of os.DirEntry that DirectoryLister uses, served from the cache"""
+
+    __slots__ = ("name", "path", "_is_dir", "_cache")
+
+    def __init__(self, cache, directory, name, is_dir):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._is_dir = is_dir
+        self._cache = cache
+
+    def is_dir(self, follow_symlinks=True):
+        return self._is_dir
+
+    def stat(self, follow_symlinks=True):
+        return self._cache.lstat(self.path)
+
+
+class _Invalidator(FileSystemEventHandler):
+    def __init__(self, cache):
+        self.cache = cache
+
+    def on_any_event(self, event):
+        if event.event_type in IGNORED_EVENTS:
+            return
+        self.cache.invalidate(event.src_path, recursive=event.is_directory)
+        if getattr(event, "dest_path", None):
+            self.cache.invalidate(event.dest_path, recursive=event.is_directory)
+
+
+class FileCache:
+    """
+    Metadata, directory listings and small file contents under root, kept in
+    an LRU bounded by max_bytes.
+
+    With watchdog installed, entries are dropped by filesystem events (inotify
+    on Linux) and hits cost no syscalls. Otherwise stats are not cached, and
+    contents and listings are validated against the size/mtime of the path on
+    every hit. Handlers of this server invalidate what they change themselves,
+    so their own writes are seen at once either way.
+    """
+
+    def __init__(self, root=BASE_DIR, max_bytes=FS_CACHE_MAX_BYTES, max_file_bytes=FS_CACHE_MAX_FILE_BYTES,
+                 watch=FS_CACHE_WATCH):
+        self.root = os.path.realpath(root)
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.watch = watch and Observer is not None and max_bytes > 0
+        self.watching = False
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Bumped by every invalidation; a fill that raced one is not stored
+        self.generation = 0
+        self._entries = OrderedDict()  # Least recently used first
+        self._lock = threading.Lock()
+        self._observer = None
+
+    def _start_watch(self):
+        with self._lock:
+            if self._observer is not None:
+                return
+            self._observer = Observer()
+            self._observer.daemon = True
+            try:
+                try:
+                    event_filter = [getattr(watch_events, name) for name in CHANGE_EVENTS]
+                    self._observer.schedule(_Invalidator(self), self.root, recursive=True, event_filter=event_filter)
+                except (AttributeError, TypeError):
+                    self._observer.schedule(_Invalidator(self), self.root, recursive=True)
+                self._observer.start()
+            except Exception as e:  # Missing root, inotify watch limits, ...
+                LOGGER.warning(f"File cache cannot watch {self.root}, validating with stat instead: {str(e)}")
+                return
+            self.watching = True
+
+    def _get(self, path):
+        if self.watch and self._observer is None:
+            self._start_watch()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+            return entry
+
+    def _store(self, path, generation, **fields):
+        if not self.max_bytes:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            entry = self._entries.get(path)
+            if entry is None:
+                entry = self._entries[path] = _Entry()
+            else:
+                self._entries.move_to_end(path)
+            for name, value in fields.items():
+                setattr(entry, name, value)
+            size = ENTRY_OVERHEAD + len(entry.content or b"") + sum(len(n) + 64 for n, _ in entry.listing or ())
+            self.total_bytes += size - entry.size
+            entry.size = size
+            while self.total_bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= evicted.size
+
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def stat(self, path):
+        """(size, mtime_ns, is_dir) of path, None if it does not exist"""
+        if not self.watching:
+            return _stat(path)  # A cached stat could only be validated by another stat
+        entry = self._get(path)
+        if entry is not None and entry.stat is not UNKNOWN:
+            self._count(True)
+            return entry.stat
+        self._count(False)
+        generation = self.generation
+        info = _stat(path)
+        self._store(path, generation, stat=info)
+        return info
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def isdir(self, path):
+        info = self.stat(path)
+        return info is not None and info[2]
+
+    def lstat(self, path):
+        """Size and mtime of a directory entry, without following symlinks"""
+        entry = self._get(path) if self.watching else None
+        if entry is not None and entry.lstat is not None:
+            self._count(True)
+            return entry.lstat
+        generation = self.generation
+        st = os.lstat(path)
+        details = EntryStat(st.st_size, st.st_mtime)
+        if self.watching:
+            self._count(False)
+            self._store(path, generation, lstat=details)
+        return details
+
+    def read(self, path):
+        """
+        Whole content of a small regular file.
+        Returns None for directories and files larger than max_file_bytes.
+        :raises FileNotFoundError: If the path does not exist
+        """
+        generation = self.generation
+        entry = self._get(path)
+        if self.watching and entry is not None and entry.content is not None:
+            self._count(True)
+            return entry.content
+        info = _stat(path)
+        if info is None:
+            raise FileNotFoundError(f"No such file: '{path}'")
+        if info[2] or info[0] > self.max_file_bytes:
+            return None
+        if entry is not None and entry.content is not None and entry.stat == info:
+            self._count(True)
+            return entry.content
+        self._count(False)
+        with open(path, "rb") as f:
+            data = f.read(self.max_file_bytes + 1)
+        if len(data) != info[0]:
+            return None  # Changed while reading, let the caller read it the usual way
+        self._store(path, generation, stat=info, content=data)
+        return data
+
+    def scandir(self, path):
+        """Entries of a directory, sorted by name; raises like os.scandir"""
+        generation = self.generation
+        entry = self._get(path)
+        info = None
+        if entry is not None and entry.listing is not None:
+            # Adding, removing or renaming an entry changes the directory's mtime
+            if self.watching or entry.stat == (info := _stat(path)):
+                self._count(True)
+                return [CachedDirEntry(self, path, name, is_dir) for name, is_dir in entry.listing]
+        self._count(False)
+        if info is None:
+            info = _stat(path)
+        listing = []
+        with os.scandir(path) as it:
+            for dir_entry in it:
+                try:
+                    is_dir = dir_entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+                listing.append((dir_entry.name, is_dir))
+        listing.sort()
+        self._store(path, generation, stat=info, listing=listing)
+        return [CachedDirEntry(self, path, name, is_dir) for name, is_dir in listing]
+
+    def invalidate(self, path, recursive=False):
+        """
+        Forget a path and its ancestors, whose listings (and existence, when
+        the change created them) change with it.
+        :param recursive: Also forget everything below path (moved or deleted directories)
+        """
+        path = os.path.normpath(path)
+        keys = [path]
+        parent = os.path.dirname(path)
+        while parent != keys[-1] and (parent + os.sep).startswith(self.root):
+            keys.append(parent)
+            parent = os.path.dirname(parent)
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self.total_bytes -= entry.size
+            if recursive:
+                prefix = path + os.sep
+                for key in [k for k in self._entries if k.startswith(prefix)]:
+                    self.total_bytes -= self._entries.pop(key).size
+
+    def clear(self):
+        """Forget everything, e.g. after a command that may have changed any file"""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "watching": int(self.watching),
+        }
+
+
+FS_CACHE = FileCache()
@@ -0,0 +1,83 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import IO_THREADS
+
+
+class IOExecutor:
+    """
+    Shared, sized thread pool for blocking filesystem work.
+
+    Handlers await run() instead of calling blocking os/shutil functions on
+    the event loop, so slow filesystems overlap instead of serialising.
+    Tracks queue depth and saturation for the metrics endpoint.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="io")
+        self._lock = threading.Lock()
+        self.queued = 0  # Submitted, waiting for a worker
+        self.active = 0  # Running on a worker
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.saturated = 0  # Submissions that found every worker busy
+        self.max_queue_depth = 0
+
+    def _call(self, func, args, kwargs):
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+        try:
+            return func(*args, **kwargs)
+        except BaseException:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+
+    async def run(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) on the pool and await its result"""
+        with self._lock:
+            self.submitted += 1
+            if self.active + self.queued >= self.max_workers:
+                self.saturated += 1
+            self.queued += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queued)
+        future = self._executor.submit(self._call, func, args, kwargs)
+        future.add_done_callback(self._on_done)
+        return await asyncio.wrap_future(future)
+
+    def _on_done(self, future):
+        if future.cancelled():
+            # Cancelled before a worker picked it up
+            with self._lock:
+                self.queued -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "active": self.active,
+                "queued": self.queued,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "saturated": self.saturated,
+                "max_queue_depth": self.max_queue_depth,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+IO_EXECUTOR = IOExecutor(IO_THREADS)
+
+
+async def run_io(func, *args, **kwargs):
+    """Run a blocking filesystem call on the shared I/O executor"""
+    return await IO_EXECUTOR.run(func, *args, **kwargs)
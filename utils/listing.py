@@ -0,0 +1,199 @@
+import fnmatch
+import os
+import time
+
+
+class GitIgnore:
+    """
+    Minimal .gitignore matcher: name patterns, anchored paths and
+    directory-only patterns. Negations are not supported and are skipped.
+    """
+
+    def __init__(self, lines=()):
+        self.patterns = []  # (pattern, anchored, directory_only)
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#") or line.startswith("!"):
+                continue
+            directory_only = line.endswith("/")
+            line = line.rstrip("/")
+            anchored = "/" in line
+            self.patterns.append((line.lstrip("/"), anchored, directory_only))
+
+    @classmethod
+    def load(cls, directory):
+        try:
+            with open(os.path.join(directory, ".gitignore"), "r", encoding="utf-8", errors="replace") as f:
+                return cls(f.read().splitlines())
+        except OSError:
+            return cls()
+
+    def matches(self, rel_path, is_dir):
+        name = rel_path.rsplit("/", 1)[-1]
+        for pattern, anchored, directory_only in self.patterns:
+            if directory_only and not is_dir:
+                continue
+            if fnmatch.fnmatch(rel_path if anchored else name, pattern):
+                return True
+        return False
+
+
+class ListEntry:
+    __slots__ = ("path", "is_dir", "size", "mtime")
+
+    def __init__(self, path, is_dir, size=None, mtime=None):
+        self.path = path  # Relative to the listing root, "/"-separated
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+
+    def format(self):
+        if self.is_dir:
+            line = f"📁 {self.path}/"
+        else:
+            line = f"📄 {self.path}"
+        details = []
+        if self.size is not None and not self.is_dir:
+            details.append(f"{self.size} bytes")
+        if self.mtime is not None:
+            details.append(time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.mtime)))
+        return f"{line} ({', '.join(details)})" if details else line
+
+    def as_dict(self):
+        entry = {"path": self.path, "type": "directory" if self.is_dir else "file"}
+        if self.size is not None and not self.is_dir:
+            entry["size"] = self.size
+        if self.mtime is not None:
+            entry["mtime"] = self.mtime
+        return entry
+
+
+def _as_patterns(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return value
+    raise ValueError("Glob patterns must be a string or a list of strings")
+
+
+def path_matcher(include=None, exclude=None):
+    """
+    Return a callable telling whether a relative file path passes the
+    include/exclude globs, matched the way DirectoryLister does: against the
+    path or the name, with excluded directories excluding their contents.
+    """
+    include, exclude = _as_patterns(include), _as_patterns(exclude)
+
+    def matches(rel_path):
+        parts = rel_path.split("/")
+        for depth in range(1, len(parts) + 1):
+            prefix = "/".join(parts[:depth])
+            if any(fnmatch.fnmatch(prefix, p) or fnmatch.fnmatch(parts[depth - 1], p) for p in exclude):
+                return False
+        return not include or any(fnmatch.fnmatch(rel_path, p) or fnmatch.fnmatch(parts[-1], p) for p in include)
+
+    return matches
+
+
+class DirectoryLister:
+    """
+    Stream directory entries with os.scandir in a stable depth-first order
+    (entries of each directory sorted by name, a directory followed by its
+    contents). Memory is bounded by the current path's directories and the
+    page size, not by the size of the tree.
+    """
+
+    def __init__(self, root, max_depth=None, include=None, exclude=None, ignore_names=(),
+                 use_gitignore=True, details=False, scan=None):
+        self.root = root
+        self.max_depth = max_depth
+        self.include = _as_patterns(include)
+        self.exclude = _as_patterns(exclude)
+        self.ignore_names = set(ignore_names)
+        self.gitignore = GitIgnore.load(root) if use_gitignore else GitIgnore()
+        self.details = details
+        self.scan = scan or os.scandir  # Called with a directory, returns its entries
+
+    def _matches(self, patterns, rel_path, name):
+        return any(fnmatch.fnmatch(rel_path, p) or fnmatch.fnmatch(name, p) for p in patterns)
+
+    def _skipped(self, rel_path, name, is_dir):
+        """Excluded entries are neither listed nor descended into"""
+        return (name in self.ignore_names
+                or self._matches(self.exclude, rel_path, name)
+                or self.gitignore.matches(rel_path, is_dir))
+
+    def _scan(self, directory):
+        try:
+            if self.scan is not os.scandir:
+                return sorted(self.scan(directory), key=lambda e: e.name)
+            with os.scandir(directory) as it:
+                return sorted(it, key=lambda e: e.name)
+        except (PermissionError, NotADirectoryError, FileNotFoundError):
+            return []
+
+    def iter_entries(self, cursor=None):
+        """
+        Yield ListEntry objects after the cursor (the path of the last entry of
+        the previous page), in traversal order.
+        """
+        cursor_parts = cursor.strip("/").split("/") if cursor else []
+        # One generator per directory on the current path
+        pending = [self._walk(self.root, "", 1, cursor_parts)]
+        while pending:
+            try:
+                item = next(pending[-1])
+            except StopIteration:
+                pending.pop()
+                continue
+            if isinstance(item, tuple):
+                pending.append(self._walk(*item))
+            else:
+                yield item
+
+    def _walk(self, directory, prefix, depth, cursor_parts):
+        """
+        Yield the entries of one directory; a tuple asks the caller to walk a
+        subdirectory next (keeps the traversal iterative).
+        """
+        for entry in self._scan(directory):
+            name = entry.name
+            if cursor_parts:
+                if name < cursor_parts[0]:
+                    continue
+                if name > cursor_parts[0]:
+                    cursor_parts = []
+            rel_path = prefix + name
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                is_dir = False
+            if self._skipped(rel_path, name, is_dir):
+                continue
+
+            resume_inside = bool(cursor_parts)  # name == cursor_parts[0]
+            if not resume_inside and (not self.include or self._matches(self.include, rel_path, name)):
+                if self.details:
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                        yield ListEntry(rel_path, is_dir, stat.st_size, stat.st_mtime)
+                    except OSError:
+                        yield ListEntry(rel_path, is_dir)
+                else:
+                    yield ListEntry(rel_path, is_dir)
+
+            if is_dir and (self.max_depth is None or depth < self.max_depth):
+                yield (entry.path, rel_path + "/", depth + 1, cursor_parts[1:] if resume_inside else [])
+            if resume_inside:
+                cursor_parts = []
+
+    def page(self, max_entries, cursor=None):
+        """Return (entries, next_cursor); next_cursor is None on the last page"""
+        entries = []
+        for entry in self.iter_entries(cursor):
+            if len(entries) == max_entries:
+                return entries, entries[-1].path
+            entries.append(entry)
+        return entries, None
@@ -0,0 +1,122 @@
+import re
+
+HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+class PatchError(ValueError):
+    """A patch does not apply to the current file content"""
+
+
+def _split_lines(text):
+    """Split text into lines that keep their line endings"""
+    return text.splitlines(keepends=True)
+
+
+def _strip_eol(line):
+    return line.rstrip("\r\n")
+
+
+def parse_unified_diff(diff):
+    """
+    Parse a unified diff for a single file into hunks.
+    Each hunk is (old_start, old_lines, new_lines) where old_lines/new_lines
+    are lists of line texts without line endings. File headers are ignored.
+    """
+    hunks = []
+    current = None
+    for line in diff.splitlines():
+        match = HUNK_HEADER.match(line)
+        if match:
+            current = (int(match.group(1)), [], [])
+            hunks.append(current)
+            continue
+        if current is None or line.startswith("\\"):
+            # Headers before the first hunk, "\ No newline at end of file"
+            continue
+        if line.startswith("-"):
+            current[1].append(line[1:])
+        elif line.startswith("+"):
+            current[2].append(line[1:])
+        elif line.startswith(" ") or line == "":
+            current[1].append(line[1:])
+            current[2].append(line[1:])
+        else:
+            raise PatchError(f"Invalid line in unified diff: {line[:80]!r}")
+    if not hunks:
+        raise PatchError("Patch contains no hunks")
+    return hunks
+
+
+def _find_hunk(lines, old_lines, expected):
+    """Index where old_lines match, preferring the position closest to expected"""
+    size = len(old_lines)
+    last = len(lines) - size
+    for distance in range(0, max(expected, last - expected) + 1):
+        for start in (expected - distance, expected + distance):
+            if 0 <= start <= last and all(
+                    _strip_eol(lines[start + i]) == old_lines[i] for i in range(size)):
+                return start
+    return None
+
+
+def apply_unified_diff(text, diff):
+    """Apply a unified diff to text, return (new_text, hunks applied)"""
+    lines = _split_lines(text)
+    newline = "\r\n" if lines and lines[0].endswith("\r\n") else "\n"
+    ends_with_newline = not lines or lines[-1].endswith(("\n", "\r"))
+    hunks = parse_unified_diff(diff)
+    offset = 0
+    for number, (old_start, old_lines, new_lines) in enumerate(hunks, 1):
+        # A hunk with no old lines inserts after line old_start
+        expected = max(old_start - 1, 0) + offset if old_lines else old_start + offset
+        start = _find_hunk(lines, old_lines, min(expected, len(lines)))
+        if start is None:
+            raise PatchError(f"Hunk {number} does not match the file (expected at line {old_start})")
+        replacement = [line + newline for line in new_lines]
+        lines[start:start + len(old_lines)] = replacement
+        offset += len(new_lines) - len(old_lines)
+    result = "".join(lines)
+    if not ends_with_newline and result.endswith(newline):
+        result = result[:-len(newline)]
+    return result, len(hunks)
+
+
+def apply_line_edits(text, edits):
+    """
+    Replace line ranges of text.
+    Each edit is {"start_line", "end_line", "content"} with 1-based, inclusive
+    lines numbered against the original text; end_line = start_line - 1
+    inserts before start_line. Edits may not overlap.
+    """
+    lines = _split_lines(text)
+    newline = "\r\n" if lines and lines[0].endswith("\r\n") else "\n"
+    ranges = []
+    for edit in edits:
+        if not isinstance(edit, dict):
+            raise PatchError("Each edit must be an object")
+        start = edit.get("start_line")
+        end = edit.get("end_line", start)
+        content = edit.get("content", "")
+        if (isinstance(start, bool) or not isinstance(start, int) or isinstance(end, bool)
+                or not isinstance(end, int) or not isinstance(content, str)):
+            raise PatchError("Edits require integer 'start_line'/'end_line' and string 'content'")
+        if start < 1 or end < start - 1 or start > len(lines) + 1 or end > len(lines):
+            raise PatchError(f"Edit range {start}-{end} is outside the file ({len(lines)} lines)")
+        ranges.append((start, end, content))
+
+    ranges.sort(key=lambda r: (r[0], r[1]))
+    for (_, previous_end, _), (start, _, _) in zip(ranges, ranges[1:]):
+        if start <= previous_end:
+            raise PatchError("Edits overlap")
+
+    # Apply from the bottom so earlier line numbers stay valid
+    for start, end, content in reversed(ranges):
+        replacement = _split_lines(content)
+        # Keep the replaced block's last line terminated unless it ends a file without a final newline
+        if replacement and not replacement[-1].endswith(("\n", "\r")) and (
+                end < len(lines) or (lines and lines[-1].endswith(("\n", "\r")))):
+            replacement[-1] += newline
+        if start > 1 and not lines[start - 2].endswith(("\n", "\r")):
+            lines[start - 2] += newline
+        lines[start - 1:end] = replacement
+    return "".join(lines), len(ranges)
@@ -0,0 +1,91 @@
+import os
+import threading
+from config import BASE_DIR
+
+
+class PathPolicy:
+    """
+    Authorize task paths against a base directory.
+
+    The base directory is resolved once. Each path is normalised lexically,
+    and the real path of its parent directory is cached. A cached parent is
+    re-validated with a single stat (device and inode must still match), so
+    a directory replaced by a symlink is resolved again. The final path
+    component is checked with lstat, so a symlink pointing outside the base
+    directory is rejected.
+    """
+
+    def __init__(self, base_dir, max_entries=4096):
+        self.base_dir = os.path.realpath(base_dir)
+        self._base_key = os.path.normcase(self.base_dir)
+        self.max_entries = max_entries
+        self._parents = {}  # Lexical parent directory -> (real path, st_dev, st_ino)
+        self._lock = threading.Lock()
+
+    def _inside(self, real_path):
+        key = os.path.normcase(real_path)
+        return key == self._base_key or key.startswith(self._base_key.rstrip(os.sep) + os.sep)
+
+    def _real_parent(self, parent):
+        """Real path of a directory, from the cache when it is still the same directory"""
+        try:
+            stat = os.stat(parent)
+        except OSError:
+            stat = None
+        cached = self._parents.get(parent)
+        if cached is not None and stat is not None and cached[1:] == (stat.st_dev, stat.st_ino):
+            return cached[0]
+
+        real = os.path.realpath(parent)
+        if stat is not None:
+            with self._lock:
+                if len(self._parents) >= self.max_entries:
+                    self._parents.clear()
+                self._parents[parent] = (real, stat.st_dev, stat.st_ino)
+        return real
+
+    def resolve(self, path, follow_symlinks=True):
+        """
+        Return the absolute real path of a path relative to the base directory,
+        or None if it is empty or escapes the base directory.
+        :param follow_symlinks: False resolves only the parent directory, so a
+            symlink in the last component is returned as the link itself
+            (deleting or moving a link acts on the link, not its target)
+        """
+        if not path or not isinstance(path, str) or "\0" in path:
+            return None
+        lexical = os.path.normpath(os.path.join(self.base_dir, path))
+        if not self._inside(lexical):
+            return None
+        if lexical == self.base_dir:
+            return self.base_dir
+
+        parent, name = os.path.split(lexical)
+        real = os.path.join(self._real_parent(parent), name)
+        if not follow_symlinks:
+            return real if self._inside(real) else None
+        try:
+            if os.path.islink(real):
+                real = os.path.realpath(real)
+        except OSError:
+            return None
+        return real if self._inside(real) else None
+
+    def relative(self, real_path):
+        """Path relative to the base directory, for messages"""
+        return os.path.relpath(real_path, self.base_dir)
+
+    def invalidate(self, path=None):
+        """Forget cached directories at or below path, or everything when path is None"""
+        with self._lock:
+            if path is None:
+                self._parents.clear()
+                return
+            prefix = os.path.normpath(os.path.join(self.base_dir, path))
+            for key in [k for k, v in self._parents.items()
+                        if k == prefix or k.startswith(prefix + os.sep)
+                        or v[0] == prefix or v[0].startswith(prefix + os.sep)]:
+                del self._parents[key]
+
+
+PATH_POLICY = PathPolicy(BASE_DIR)
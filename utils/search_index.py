@@ -0,0 +1,448 @@
+"""
+Trigram index of the text files under the base directory, for search tasks.
+
+Every indexed file is a document; each distinct 3-byte sequence of its
+lowercased content maps to the ascending ids of the documents containing
+it. A query is reduced to the literal runs every match must contain, their
+trigrams select the candidate files, and only those are scanned with the
+real pattern, so results are exact.
+
+The index is updated lazily: handlers report the paths they change, and
+the next search re-indexes just those files. Changes made outside the
+server are found by a rescan (one lstat per file, re-reading only files
+whose size or mtime changed) at most every SEARCH_RESCAN_INTERVAL seconds.
+The index is saved to SEARCH_INDEX_PATH, so a restart only re-reads what
+changed in between.
+"""
+import os
+import pickle
+import re
+import stat as stat_module
+import threading
+import time
+from array import array
+from config import (
+    BASE_DIR,
+    LIST_DEFAULT_IGNORES,
+    SEARCH_INDEX_PATH,
+    SEARCH_MAX_FILE_BYTES,
+    SEARCH_RESCAN_INTERVAL,
+)
+from logger import LOGGER
+from utils.file_utils import write_atomic
+from utils.fs_cache import FS_CACHE
+from utils.listing import DirectoryLister, GitIgnore
+
+# Bumped whenever the saved format changes; older files are ignored
+INDEX_VERSION = 1
+
+# Files with a NUL byte in their first bytes are treated as binary and not indexed
+BINARY_SNIFF_BYTES = 8192
+
+# Postings are rebuilt without dead document ids once they make up this share
+COMPACT_RATIO = 0.5
+COMPACT_MIN_DEAD = 1000
+
+
+def trigrams(data):
+    """Distinct 3-byte sequences of data, as tuples of byte values (cheaper to build than slices)"""
+    return set(zip(data, data[1:], data[2:]))
+
+
+def _skip_class(pattern, i):
+    """Index just past the character class starting at pattern[i] == '['"""
+    i += 1
+    if pattern[i:i + 1] == "^":
+        i += 1
+    if pattern[i:i + 1] == "]":
+        i += 1  # A leading ] is a member, not the end
+    while i < len(pattern) and pattern[i] != "]":
+        i += 2 if pattern[i] == "\\" else 1
+    return i + 1
+
+
+# A whole escape sequence: hex, unicode, named and octal escapes and backreferences
+# span more than two characters, none of which is a literal to look up
+ESCAPE = re.compile(r"\\(?:x[0-9a-fA-F]{0,2}|u[0-9a-fA-F]{0,4}|U[0-9a-fA-F]{0,8}|N\{[^}]*\}|[0-9]+|.?)", re.DOTALL)
+
+
+def _skip_group(pattern, i):
+    """Index just past the group starting at pattern[i] == '('"""
+    depth = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            i += 2
+            continue
+        if c == "[":
+            i = _skip_class(pattern, i)
+            continue
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return i
+
+
+def required_literals(pattern, regex=True, case_sensitive=True):
+    """
+    Byte strings (lowercased) that every match of the query contains.
+    Regular expressions are scanned conservatively: alternation at the top
+    level gives up, groups and classes end a literal run, and a character
+    made optional by a quantifier is dropped. An empty list means no
+    filtering is possible and every file is a candidate.
+    """
+    if not regex:
+        runs = [pattern]
+    else:
+        if re.compile(pattern).flags & re.VERBOSE:
+            return []
+        runs, run = [], ""
+        i, n = 0, len(pattern)
+        while i < n:
+            c = pattern[i]
+            literal = None
+            if c == "|":
+                return []  # Any branch may match
+            if c == "\\":
+                escaped = pattern[i + 1:i + 2]
+                if escaped and not escaped.isalnum():
+                    literal = escaped
+                i = ESCAPE.match(pattern, i).end()
+            elif c == "[":
+                i = _skip_class(pattern, i)
+            elif c == "(":
+                i = _skip_group(pattern, i)
+            else:
+                if c not in ".^$*+?{}":
+                    literal = c
+                i += 1
+
+            optional = repeated = False
+            quantifier = pattern[i:i + 1]
+            if quantifier in ("*", "?"):
+                optional = True
+                i += 1
+            elif quantifier == "+":
+                repeated = True
+                i += 1
+            elif quantifier == "{":
+                bounds = re.match(r"\{(\d*)(?:,\d*)?\}", pattern[i:])
+                if bounds:
+                    optional = not bounds.group(1) or int(bounds.group(1)) == 0
+                    repeated = not optional
+                    i += bounds.end()
+            if pattern[i:i + 1] in ("?", "+") and (optional or repeated):
+                i += 1  # Lazy or possessive form
+
+            if literal is not None and not optional:
+                run += literal
+                if repeated:
+                    runs.append(run)
+                    run = ""
+            elif run:
+                runs.append(run)
+                run = ""
+        runs.append(run)
+
+    literals = []
+    for run in runs:
+        # The index only folds ASCII case, so other characters cannot be looked up case-insensitively
+        parts = [run] if case_sensitive else re.split(r"[^\x00-\x7f]+", run)
+        literals.extend(part.encode("utf-8").lower() for part in parts if len(part.encode("utf-8")) >= 3)
+    return literals
+
+
+def _walk_key(rel_path):
+    return rel_path.split("/")
+
+
+class SearchMatch:
+    __slots__ = ("path", "line", "text", "before", "after")
+
+    def __init__(self, path, line, text, before=(), after=()):
+        self.path = path  # Relative to the base directory, "/"-separated
+        self.line = line
+        self.text = text
+        self.before = before  # Context lines above, oldest first
+        self.after = after
+
+    def format(self):
+        lines = [f"{self.path}-{self.line - len(self.before) + i}- {text}" for i, text in enumerate(self.before)]
+        lines.append(f"{self.path}:{self.line}: {self.text}")
+        lines.extend(f"{self.path}-{self.line + 1 + i}- {text}" for i, text in enumerate(self.after))
+        return "\n".join(lines)
+
+    def as_dict(self):
+        entry = {"path": self.path, "line": self.line, "text": self.text}
+        if self.before or self.after:
+            entry["before"] = list(self.before)
+            entry["after"] = list(self.after)
+        return entry
+
+
+def _snippet(line, column, max_chars):
+    """The line, cut to max_chars around the match column"""
+    if len(line) <= max_chars:
+        return line
+    start = max(0, min(column - max_chars // 4, len(line) - max_chars))
+    return ("…" if start else "") + line[start:start + max_chars] + ("…" if start + max_chars < len(line) else "")
+
+
+class SearchIndex:
+    def __init__(self, root=BASE_DIR, path=SEARCH_INDEX_PATH, max_file_bytes=SEARCH_MAX_FILE_BYTES,
+                 rescan_interval=SEARCH_RESCAN_INTERVAL, ignore_names=LIST_DEFAULT_IGNORES):
+        self.root = os.path.realpath(root)
+        self.path = path
+        self.max_file_bytes = max_file_bytes
+        self.rescan_interval = rescan_interval
+        self.ignore_names = set(ignore_names)
+        self.files = {}  # Relative path -> (size, mtime_ns, doc id or None when not indexed)
+        self.docs = {}  # Doc id -> relative path, live documents only
+        self.postings = {}  # Trigram -> array of doc ids, ascending, may hold dead ids
+        self.next_doc = 0
+        self.dead = 0
+        self.pending = set()  # Relative paths reported changed since the last update
+        self.rescan_due = True
+        self.last_rescan = 0.0
+        self.unsaved = 0
+        self.loaded = False
+        self.gitignore = GitIgnore()
+        self._ordered = None  # Live documents' paths in walk order, rebuilt after changes
+        self._lock = threading.Lock()
+
+    def invalidate(self, path, recursive=False):
+        """
+        Report a changed path (absolute), re-indexed on the next search.
+        :param recursive: A directory changed, rescan the tree
+        """
+        rel = os.path.relpath(path, self.root).replace(os.sep, "/")
+        with self._lock:
+            if recursive or rel == "." or rel.rsplit("/", 1)[-1] == ".gitignore":
+                self.rescan_due = True
+            elif not rel.startswith("../"):
+                self.pending.add(rel)
+
+    def invalidate_all(self):
+        """Anything may have changed, e.g. after a command"""
+        with self._lock:
+            self.rescan_due = True
+
+    # Called with the lock held
+
+    def _ignored(self, rel):
+        parts = rel.split("/")
+        for depth in range(1, len(parts) + 1):
+            prefix = "/".join(parts[:depth])
+            if parts[depth - 1] in self.ignore_names or self.gitignore.matches(prefix, depth < len(parts)):
+                return True
+        return False
+
+    def _remove(self, rel):
+        known = self.files.pop(rel, None)
+        if known is not None and known[2] is not None:
+            del self.docs[known[2]]
+            self._ordered = None
+            self.dead += 1
+        if known is not None:
+            self.unsaved += 1
+
+    def _add(self, rel, st):
+        """(Re-)index a file whose lstat changed"""
+        self._remove(rel)
+        doc = None
+        if stat_module.S_ISREG(st.st_mode) and st.st_size <= self.max_file_bytes:
+            try:
+                with open(os.path.join(self.root, rel), "rb") as f:
+                    data = f.read(self.max_file_bytes + 1)
+            except OSError:
+                data = None
+            if data is not None and b"\0" not in data[:BINARY_SNIFF_BYTES]:
+                doc = self.next_doc
+                self.next_doc += 1
+                self.docs[doc] = rel
+                self._ordered = None
+                postings = self.postings
+                for trigram in trigrams(data.lower()):
+                    ids = postings.get(trigram)
+                    if ids is None:
+                        ids = postings[trigram] = array("I")
+                    ids.append(doc)
+        # Symlinks and special files are remembered but not read
+        self.files[rel] = (st.st_size, st.st_mtime_ns, doc)
+        self.unsaved += 1
+
+    def _refresh(self, rel):
+        try:
+            st = os.lstat(os.path.join(self.root, rel))
+        except OSError:
+            st = None
+        if st is None or stat_module.S_ISDIR(st.st_mode) or self._ignored(rel):
+            self._remove(rel)
+        elif self.files.get(rel, (None, None))[:2] != (st.st_size, st.st_mtime_ns):
+            self._add(rel, st)
+
+    def _rescan(self):
+        self.gitignore = GitIgnore.load(self.root)
+        lister = DirectoryLister(self.root, ignore_names=self.ignore_names)
+        seen = set()
+        for entry in lister.iter_entries():
+            if entry.is_dir:
+                continue
+            seen.add(entry.path)
+            self._refresh(entry.path)
+        for rel in [rel for rel in self.files if rel not in seen]:
+            self._remove(rel)
+        self.pending.clear()
+        self.rescan_due = False
+        self.last_rescan = time.monotonic()
+
+    def _compact(self):
+        live = self.docs
+        for trigram in list(self.postings):
+            ids = array("I", (doc for doc in self.postings[trigram] if doc in live))
+            if ids:
+                self.postings[trigram] = ids
+            else:
+                del self.postings[trigram]
+        self.dead = 0
+
+    def _load(self):
+        self.loaded = True
+        if not self.path:
+            return
+        try:
+            with open(self.path, "rb") as f:
+                saved = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            LOGGER.warning(f"Ignoring unreadable search index {self.path}: {str(e)}")
+            return
+        if saved.get("version") != INDEX_VERSION or saved.get("root") != self.root:
+            return
+        self.files, self.docs, self.postings = saved["files"], saved["docs"], saved["postings"]
+        self._ordered = None
+        self.next_doc, self.dead = saved["next_doc"], saved["dead"]
+
+    def _save(self):
+        self.unsaved = 0
+        if not self.path:
+            return
+        state = {"version": INDEX_VERSION, "root": self.root, "files": self.files, "docs": self.docs,
+                 "postings": self.postings, "next_doc": self.next_doc, "dead": self.dead}
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            write_atomic(self.path, pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+        except OSError as e:
+            LOGGER.warning(f"Failed to save search index {self.path}: {str(e)}")
+
+    def update(self):
+        """Bring the index up to date; blocking, run it on the I/O executor"""
+        with self._lock:
+            if not self.loaded:
+                self._load()
+            if self.rescan_due or time.monotonic() - self.last_rescan > self.rescan_interval:
+                started = time.perf_counter()
+                self._rescan()
+                LOGGER.info(f"Search index rescanned: {len(self.docs)} files indexed, "
+                            f"{len(self.postings)} trigrams ({(time.perf_counter() - started) * 1000:.0f} ms)")
+                if self.unsaved:
+                    self._save()
+            else:
+                for rel in self.pending:
+                    self._refresh(rel)
+                self.pending.clear()
+            if self.dead >= COMPACT_MIN_DEAD and self.dead > COMPACT_RATIO * (self.dead + len(self.docs)):
+                self._compact()
+
+    def candidates(self, literals, prefix=""):
+        """Sorted relative paths that may contain all literals, limited to prefix (a file or a directory)"""
+        with self._lock:
+            docs = None
+            lists = [self.postings.get(t) for literal in literals for t in trigrams(literal)]
+            if any(ids is None for ids in lists):
+                return []
+            for ids in sorted(lists, key=len):
+                # Candidates are verified anyway: stop once a list is too long to narrow them cheaply
+                if len(ids) > (len(self.docs) if docs is None else 16 * len(docs)) // 2:
+                    break
+                docs = set(ids) if docs is None else docs.intersection(ids)
+                if not docs:
+                    return []
+            if self._ordered is None:
+                # Component-wise order is the order list tasks walk the tree in
+                self._ordered = sorted(self.docs.values(), key=_walk_key)
+            if docs is None:
+                paths = self._ordered
+            elif len(docs) * 8 < len(self._ordered):
+                paths = sorted((self.docs[d] for d in docs if d in self.docs), key=_walk_key)
+            else:
+                wanted = {self.docs[d] for d in docs if d in self.docs}
+                paths = [p for p in self._ordered if p in wanted]
+            if not prefix:
+                return list(paths)
+            below = prefix + "/"
+            return [p for p in paths if p == prefix or p.startswith(below)]
+
+    def search(self, pattern, literals, prefix="", include=None, max_results=100, context=0, max_chars=200):
+        """
+        Return (matches, files_scanned, truncated): at most max_results lines
+        matching the compiled pattern, one match per line, in path order.
+        :param literals: Output of required_literals for the query
+        :param prefix: Only this relative file or the files below this directory, "" for all
+        :param include: Callable taking a relative path, False to skip the file
+        """
+        self.update()
+        matches = []
+        scanned = 0
+        for rel in self.candidates(literals, prefix):
+            if include is not None and not include(rel):
+                continue
+            path = os.path.join(self.root, rel)
+            try:
+                data = FS_CACHE.read(path)
+                if data is None:
+                    with open(path, "rb") as f:
+                        data = f.read(self.max_file_bytes + 1)
+            except OSError:
+                continue  # Deleted since it was indexed
+            scanned += 1
+            text = data.decode("utf-8", errors="replace")
+            lines = None
+            last_line = 0
+            line, position = 1, 0
+            for match in pattern.finditer(text):
+                line += text.count("\n", position, match.start())
+                position = match.start()
+                if line == last_line:
+                    continue
+                last_line = line
+                if len(matches) == max_results:
+                    return matches, scanned, True
+                line_start = text.rfind("\n", 0, position) + 1
+                line_end = text.find("\n", position)
+                line_text = text[line_start:line_end if line_end >= 0 else len(text)].rstrip("\r")
+                before = after = ()
+                if context:
+                    if lines is None:
+                        lines = [l.rstrip("\r") for l in text.split("\n")]
+                    before = tuple(_snippet(l, 0, max_chars) for l in lines[max(0, line - 1 - context):line - 1])
+                    after = tuple(_snippet(l, 0, max_chars) for l in lines[line:line + context])
+                matches.append(SearchMatch(rel, line, _snippet(line_text, position - line_start, max_chars),
+                                           before, after))
+        return matches, scanned, False
+
+    def stats(self):
+        return {
+            "files": len(self.files),
+            "documents": len(self.docs),
+            "trigrams": len(self.postings),
+            "pending": len(self.pending),
+        }
+
+
+SEARCH_INDEX = SearchIndex()